@@ -1,2 +1,2 @@
-from astropile.benchmark.dataset import AstroPile, CrossMatchedAstroPile
+from astropile.benchmark.dataset import AstroPile, CrossMatchedAstroPile, HDF5Dataset, HealpixBlockSampler
 from astropile.benchmark.models.image import ConvolutionalModel
\ No newline at end of file
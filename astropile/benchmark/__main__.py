@@ -0,0 +1,22 @@
+"""Benchmarks of AstroPile, run with `python -m astropile.benchmark <command> [options]`.
+
+Commands:
+    loading: Data loading throughput of the parent samples.
+    model: Training throughput of the image models.
+"""
+import sys
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    if len(args) == 0 or args[0] not in ('loading', 'model'):
+        print(__doc__)
+        sys.exit(0 if len(args) > 0 and args[0] in ('-h', '--help') else 2)
+
+    if args[0] == 'loading':
+        from astropile.benchmark.loading import main as command
+    else:
+        from astropile.benchmark.throughput import main as command
+    command(args[1:])
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,262 @@
 import torch
 import lightning as L
 import datasets 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler
 import typing as T
 import os
+import numpy as np
+import h5py
+from datasets.distributed import split_dataset_by_node
+
+from astropile.utils import cross_match_datasets, is_cross_match, load_cross_match
+from astropile.hdf5_utils import read_rows, is_shared_column
+from astropile.benchmark.dataset_utils import get_split_indices, compute_split_indices, flatten_dataset
+
+def collate_batch(batch: T.Dict[str, T.Any]) -> T.Dict[str, T.Any]:
+    """ Collate a batch read at once with `dataset[indices]`.
+
+    Lists of tensors are stacked, and flattened column names (e.g. `image.array`) 
+    are nested back into dictionaries, so that models can access `batch['image']['array']`.
+    """
+    collated = {}
+    for key, value in batch.items():
+        if isinstance(value, list) and len(value) > 0 and isinstance(value[0], torch.Tensor):
+            value = torch.stack(value)
+        *parents, name = key.split('.')
+        node = collated
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[name] = value
+    return collated
+
+def batched_dataloader(dataset, 
+                       batch_size: int, 
+                       shuffle: bool = False, 
+                       drop_last: bool = True, 
+                       sampler: T.Optional[torch.utils.data.Sampler] = None,
+                       **kwargs) -> DataLoader:
+    """ Build a DataLoader reading whole batches at once with `dataset[indices]`.
+
+    The sampler yields lists of indices, so that each batch is fetched with a single 
+    indexing of the dataset and collated with `collate_batch`, instead of being read 
+    row by row and collated with `default_collate`. A custom sampler of single indices, 
+    e.g. `HealpixBlockSampler`, can be given instead of `shuffle`.
+    """
+    if sampler is None:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, 
+                      sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last),
+                      batch_size=None, 
+                      collate_fn=collate_batch,
+                      **kwargs)
+
+
+class HealpixBlockSampler(torch.utils.data.Sampler):
+    def __init__(self, 
+                 groups: T.Optional[np.ndarray] = None,
+                 num_samples: T.Optional[int] = None,
+                 block_size: int = 1024,
+                 shuffle_buffer_size: int = 8192,
+                 seed: int = 42,
+                 num_replicas: int = 1,
+                 rank: int = 0):
+        """ Sampler shuffling blocks of rows instead of single rows, for near-sequential reads.
+
+        Each epoch, the order of the groups (e.g. healpix cells or files) is shuffled, and so 
+        is the order of the blocks of `block_size` consecutive rows in each group. Indices are 
+        then mixed by a shuffle buffer of `shuffle_buffer_size` indices.
+
+        The order only depends on the seed and epoch, which is incremented at each iteration
+        or set with `set_epoch`, so that all DDP ranks and DataLoader workers agree on it. 
+        Each of `num_replicas` ranks reads a contiguous part of the shuffled blocks, otherwise 
+        Lightning's distributed sampler wrapper splits the batches across ranks.
+
+        Args:
+            groups (np.ndarray, optional): Group of each row of the dataset. Defaults to None (a single group).
+            num_samples (int, optional): Number of rows of the dataset, required if `groups` is None.
+            block_size (int, optional): Number of consecutive rows per block. Defaults to 1024.
+            shuffle_buffer_size (int, optional): Size of the shuffle buffer. Defaults to 8192.
+            seed (int, optional): Seed of the shuffling. Defaults to 42.
+            num_replicas (int, optional): Number of ranks the blocks are distributed over. Defaults to 1.
+            rank (int, optional): Rank of the current process. Defaults to 0.
+        """
+        if groups is None:
+            groups = np.zeros(num_samples, dtype=int)
+        groups = np.asarray(groups)
+        # Rows of each group, in dataset order
+        order = np.argsort(groups, kind='stable')
+        _, starts = np.unique(groups[order], return_index=True)
+        self._group_rows = np.split(order, starts[1:])
+        self.block_size = block_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._num_samples = len(groups)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _indices(self, rng):
+        blocks = []
+        for g in rng.permutation(len(self._group_rows)):
+            rows = self._group_rows[g]
+            num_blocks = int(np.ceil(len(rows) / self.block_size))
+            for b in rng.permutation(num_blocks):
+                blocks.append(rows[b * self.block_size:(b + 1) * self.block_size])
+        indices = np.concatenate(blocks) if len(blocks) > 0 else np.zeros(0, dtype=int)
+        # Each rank gets a contiguous part of the shuffled blocks
+        return np.array_split(indices, self.num_replicas)[self.rank]
+
+    def __len__(self):
+        return len(np.array_split(np.arange(self._num_samples), self.num_replicas)[self.rank])
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        self.epoch += 1
+        buffer = []
+        for idx in self._indices(rng).tolist():
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(idx)
+                continue
+            # Yield a random element of the buffer and replace it
+            j = rng.integers(len(buffer))
+            yield buffer[j]
+            buffer[j] = idx
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+class HDF5Dataset(torch.utils.data.Dataset):
+    def __init__(self, files: T.List[str], keys: T.List[str], id_key: str = 'object_id'):
+        """ PyTorch Dataset reading rows of AstroPile parent sample HDF5 files directly.
+
+        Each worker opens its own handle to the files. Contiguous, uncompressed numerical
+        columns are memory-mapped and read without going through h5py, other columns are
+        read with h5py. Columns shared by all the rows of a file (e.g. the DESI wavelength
+        grid) are read once per file and repeated for each row. Numerical columns are 
+        returned as tensors, and string columns (e.g. `object_id`) as Python strings.
+
+        Indexing with a list of indices reads all the rows at once, and returns a 
+        dictionary of stacked tensors.
+
+        Args:
+            files (List[str]): Paths to the HDF5 files, e.g. `<survey>/healpix=*/001-of-001.hdf5`.
+            keys (List[str]): Names of the columns to read.
+            id_key (str, optional): Name of the object id column, giving the number of rows of
+                each file. Files without it use the first requested column with one value per row.
+                Defaults to 'object_id'.
+        """
+        super().__init__()
+        self.files = list(files)
+        self.keys = list(keys)
+        lengths = []
+        for filename in self.files:
+            with h5py.File(filename, 'r') as data:
+                if id_key not in data:
+                    id_key = next(k for k in self.keys if not is_shared_column(data[k]))
+                lengths.append(len(data[id_key]))
+        self._offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self._columns = None
+
+    @classmethod
+    def from_builder(cls, builder: datasets.DatasetBuilder, keys: T.List[str], split: str = 'train'):
+        """ Build the dataset from the data files of an AstroPile dataset builder.
+        """
+        return cls(builder.config.data_files[split], keys)
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def __getstate__(self):
+        # Open handles and memory maps are not shared with the workers
+        state = self.__dict__.copy()
+        state['_columns'] = None
+        return state
+
+    def _open_columns(self, filename: str):
+        data = h5py.File(filename, 'r')
+        columns, shared = {}, {}
+        for k in self.keys:
+            dset = data[k]
+            if is_shared_column(dset):
+                shared[k] = dset[()]
+                continue
+            offset = dset.id.get_offset()
+            if (offset is not None and dset.chunks is None and dset.compression is None 
+                and dset.dtype.kind in 'biuf'):
+                # Contiguous data can be read directly from the file
+                columns[k] = np.memmap(filename, dtype=dset.dtype, mode='r', 
+                                       offset=offset, shape=dset.shape)
+            else:
+                columns[k] = dset
+        return data, columns, shared
+
+    def _get_columns(self, file_idx: int):
+        # Handles are opened lazily, in the process that reads them
+        if self._columns is None or self._columns[0] != os.getpid():
+            self._columns = (os.getpid(), {})
+        handles = self._columns[1]
+        if file_idx not in handles:
+            handles[file_idx] = self._open_columns(self.files[file_idx])
+        return handles[file_idx]
+
+    def _to_batch(self, value):
+        if value.dtype.kind in 'SO':
+            return [v.decode('utf-8') if isinstance(v, bytes) else v for v in value]
+        if not value.dtype.isnative:
+            value = value.astype(value.dtype.newbyteorder('='))
+        return torch.from_numpy(np.ascontiguousarray(value))
+
+    def _get_batch(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if np.any((indices < 0) | (indices >= len(self))):
+            raise IndexError(f"Indices out of range for dataset of size {len(self)}")
+        file_idx = np.searchsorted(self._offsets, indices, side='right') - 1
+
+        # Rows are read file by file, then put back in the requested order
+        parts = []
+        for i in np.unique(file_idx):
+            rows = indices[file_idx == i] - self._offsets[i]
+            data, columns, shared = self._get_columns(i)
+            h5_keys = [k for k, column in columns.items() if not isinstance(column, np.memmap)]
+            part = read_rows(data, rows, h5_keys)
+            for k, column in columns.items():
+                if isinstance(column, np.memmap):
+                    part[k] = column[rows]
+            for k, value in shared.items():
+                part[k] = np.broadcast_to(value, (len(rows), *value.shape))
+            parts.append(part)
+        order = np.argsort(np.argsort(file_idx, kind='stable'))
+        return {k: self._to_batch(np.concatenate([part[k] for part in parts])[order]) for k in self.keys}
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, np.ndarray, torch.Tensor)):
+            # Batched read of several rows, returning stacked tensors
+            return self._get_batch(idx)
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"Index {idx} out of range for dataset of size {len(self)}")
+        file_idx = int(np.searchsorted(self._offsets, idx, side='right')) - 1
+        row = idx - int(self._offsets[file_idx])
+        _, columns, shared = self._get_columns(file_idx)
+        example = {}
+        for k in self.keys:
+            value = shared[k] if k in shared else columns[k][row]
+            if isinstance(value, bytes):
+                example[k] = value.decode('utf-8')
+            elif isinstance(value, str):
+                example[k] = value
+            else:
+                value = np.array(value)
+                if not value.dtype.isnative:
+                    value = value.astype(value.dtype.newbyteorder('='))
+                example[k] = torch.from_numpy(value)
+        return example
 
-from astropile.utils import cross_match_datasets
 
 class AstroPile(L.LightningDataModule):
     def __init__(
@@ -16,48 +267,124 @@ class AstroPile(L.LightningDataModule):
             num_workers: int = 0, 
             test_size: float = 0.1,
             local_astropile_root: str = None,
-            config_name: T.Optional[str]=None):
+            config_name: T.Optional[str]=None,
+            hdf5_keys: T.Optional[T.List[str]]=None,
+            pin_memory: bool = False,
+            seed: int = 42,
+            split_by_healpix: bool = False,
+            sampler: str = 'random',
+            block_size: int = 1024,
+            shuffle_buffer_size: int = 8192):
         """ Lightning DataModule for AstroPile datasets.
+
+        Batches are read at once with `dataset[indices]`, and copied to pinned 
+        memory by the DataLoader if `pin_memory` is True.
+
+        The train, val and test splits are sets of sorted row indices, computed once 
+        for a given dataset and seed and cached on disk. With `split_by_healpix=True`, 
+        whole healpix cells are assigned to each split to avoid spatial leakage.
+
+        The train rows are shuffled uniformly with `sampler='random'`, or by blocks of 
+        `block_size` rows within shuffled healpix cells followed by a shuffle buffer 
+        with `sampler='healpix_block'`, see `HealpixBlockSampler`.
+
+        If `hdf5_keys` is given, these columns are read directly from the HDF5 files 
+        of a local parent sample with `HDF5Dataset`, instead of going through Arrow.
         """
         super().__init__()
         self.save_hyperparameters()
 
+    def _setup_hdf5(self):
+        """ Setup datasets reading the parent sample HDF5 files directly.
+        """
+        if self.hparams.local_astropile_root is None:
+            raise ValueError("Reading HDF5 files directly requires a local_astropile_root.")
+        dataset_path = os.path.join(self.hparams.local_astropile_root, self.hparams.name)
+        builder = datasets.load_dataset_builder(dataset_path, 
+                                                name=self.hparams.config_name,
+                                                trust_remote_code=True)
+        dset = HDF5Dataset.from_builder(builder, self.hparams.hdf5_keys)
+
+        # Files are stored per healpix cell, so rows are grouped by file
+        lengths = np.diff(dset._offsets)
+        splits = self._split_indices(fingerprint=f"{dset.files}-{lengths.tolist()}", 
+                                     num_rows=len(dset),
+                                     groups=lambda: np.repeat(np.arange(len(lengths)), lengths))
+        self.train_dataset, self.val_dataset, self.test_dataset = [
+            torch.utils.data.Subset(dset, splits[split]) for split in ['train', 'val', 'test']]
+        self._train_groups = lambda: np.searchsorted(dset._offsets, splits['train'], side='right') - 1
+
+    def _split_indices(self, fingerprint, num_rows, groups):
+        """ Return the cached row indices of the splits, `groups` being called only if needed.
+        """
+        return get_split_indices(fingerprint, 
+                                 num_rows, 
+                                 test_size=self.hparams.test_size,
+                                 seed=self.hparams.seed,
+                                 groups=groups() if self.hparams.split_by_healpix else None)
+
     def setup(self, stage=None):
         """ Setup the dataset.
         """
+        if self.hparams.hdf5_keys is not None:
+            self._setup_hdf5()
+            return
+
         if self.hparams.local_astropile_root is not None:
             dataset_path = os.path.join(self.hparams.local_astropile_root, self.hparams.name)
-            try:
-                dset = datasets.load_dataset(dataset_path, trust_remote_code=True)
-            except ValueError:
-                dset = datasets.load_from_disk(dataset_path)
+            if is_cross_match(dataset_path):
+                # Sharded output of the cross-matching, which must be complete
+                dset = load_cross_match(dataset_path)
+            else:
+                try:
+                    dset = datasets.load_dataset(dataset_path, trust_remote_code=True)
+                except ValueError:
+                    dset = datasets.load_from_disk(dataset_path)
         else:
             dset = datasets.load_dataset(self.hparams.name)
+        if isinstance(dset, datasets.DatasetDict):
+            dset = dset['train']
         
+        # Nested features are flattened so that batches of rows are read as stacked tensors
+        dset = flatten_dataset(dset)
         dset.set_format("torch")
 
-        # Apply shuffling at the top level
-        dset = dset.shuffle(seed=42)
+        # Spliting dataset into train, val, and test sets of sorted indices,
+        # shuffling is left to the train DataLoader
+        splits = self._split_indices(fingerprint=dset._fingerprint,
+                                     num_rows=len(dset),
+                                     groups=lambda: dset.with_format('numpy')['healpix'])
+        self.train_dataset, self.val_dataset, self.test_dataset = [
+            dset.select(splits[split]) for split in ['train', 'val', 'test']]
+        self._train_groups = lambda: (self.train_dataset.with_format('numpy')['healpix'] 
+                                      if 'healpix' in self.train_dataset.column_names else None)
 
-        # Spliting dataset into train, val, and test sets
-        dset = dset.train_test_split(test_size=self.hparams.test_size)
-        dset, self.test_dataset = dset['train'], dset['test']
-        dset = dset.train_test_split(test_size=self.hparams.test_size)
-        self.train_dataset, self.val_dataset = dset['train'], dset['test']
+    def _dataloader(self, dataset, shuffle=False, sampler=None):
+        return batched_dataloader(dataset, 
+                                  batch_size=self.hparams.batch_size, 
+                                  shuffle=shuffle,
+                                  sampler=sampler,
+                                  drop_last=True,
+                                  num_workers=self.hparams.num_workers,
+                                  pin_memory=self.hparams.pin_memory)
 
     def train_dataloader(self):
-        return DataLoader(self.train_dataset, 
-                          batch_size=self.hparams.batch_size, 
-                          num_workers=self.hparams.num_workers, 
-                          shuffle=True,
-                          drop_last=True)
+        if self.hparams.sampler == 'healpix_block':
+            sampler = HealpixBlockSampler(groups=self._train_groups(),
+                                          num_samples=len(self.train_dataset),
+                                          block_size=self.hparams.block_size,
+                                          shuffle_buffer_size=self.hparams.shuffle_buffer_size,
+                                          seed=self.hparams.seed)
+            return self._dataloader(self.train_dataset, sampler=sampler)
+        elif self.hparams.sampler != 'random':
+            raise ValueError(f"Unknown sampler {self.hparams.sampler}, expected 'random' or 'healpix_block'.")
+        return self._dataloader(self.train_dataset, shuffle=True)
 
     def val_dataloader(self):
-        return DataLoader(self.val_dataset, batch_size=self.hparams.batch_size, drop_last=True, num_workers=self.hparams.num_workers)
+        return self._dataloader(self.val_dataset)
 
     def test_dataloader(self):
-        return DataLoader(self.test_dataset, batch_size=self.hparams.batch_size, num_workers=self.hparams.num_workers, drop_last=True)
-
+        return self._dataloader(self.test_dataset)
 
 class CrossMatchedAstroPile(L.LightningDataModule):
     def __init__(
@@ -71,9 +398,16 @@ class CrossMatchedAstroPile(L.LightningDataModule):
             matching_radius: float = 1.0,
             cache_dir: str = None,
             left_config_name: T.Optional[str]=None,
-            right_config_name: T.Optional[str]=None):
+            right_config_name: T.Optional[str]=None,
+            streaming: bool = False,
+            shuffle_buffer_size: int = 1000,
+            pin_memory: bool = False):
         """ Lightning DataModule for datasets resulting from cross-matching of parent 
         samples.
+
+        With `streaming=True`, the matched catalog is split into train, val and test 
+        sets, and examples are read lazily from the parent samples instead of being 
+        written to the cache first.
         """
         super().__init__()
         self.save_hyperparameters()
@@ -86,53 +420,81 @@ class CrossMatchedAstroPile(L.LightningDataModule):
         right_path = os.path.join(self.hparams.local_astropile_root, self.hparams.right)
 
         # Build the cross-matched dataset
-        left = datasets.load_dataset_builder(left_path, trust_remote_code=True)
+        left = datasets.load_dataset_builder(left_path, 
+                                             name=self.hparams.left_config_name if self.hparams.left_config_name is not None else None,
+                                             trust_remote_code=True)
         right = datasets.load_dataset_builder(right_path, 
                                               name=self.hparams.right_config_name if self.hparams.right_config_name is not None else None,
                                               trust_remote_code=True)
-        if self.hparams.left_config_name is not None:
-            configs = [self.hparams.left_config_name]
-        else:
-            configs = left.builder_configs
-            configs = [config for config in configs if config != "all"]
-
-        # Let's process each config separately
-        # This is because the cross-matching currently only works if a singe file
-        # exists for a given healpix cell. With the way we store SDSS for instance,
-        # several surveys can overlap on the sky, and that causes problems. So here
-        # as a temporary fix, we process sub-configs one by one.
-        dsets = []
-        for i, config in enumerate(configs):
-            print("Processing config from left dataset: ", config)
-            left = datasets.load_dataset_builder(left_path, config, trust_remote_code=True)
-            dset = cross_match_datasets(
-                left,
-                right,
-                matching_radius=self.hparams.matching_radius,  # In arcsecs
-                cache_dir=self.hparams.cache_dir,
-                num_proc=self.hparams.num_workers
-            )
-            dsets.append(dset)
-
-        # Concatenate all the datasets
-        dset = datasets.concatenate_datasets(dsets)
+
+        if self.hparams.streaming:
+            self._setup_streaming(left, right)
+            return
+
+        # Configs combining several surveys (e.g. SDSS, DESI) can store several
+        # files per healpix cell, which the cross-matching handles directly
+        dset = cross_match_datasets(
+            left,
+            right,
+            matching_radius=self.hparams.matching_radius,  # In arcsecs
+            cache_dir=self.hparams.cache_dir,
+            num_proc=self.hparams.num_workers
+        )
         
-        dset = dset.with_format("torch")
+        # Nested features are flattened so that batches of rows are read as stacked tensors
+        dset = flatten_dataset(dset).with_format("torch")
+
+        # Spliting dataset into train, val, and test sets of sorted indices,
+        # shuffling is left to the train DataLoader
+        splits = get_split_indices(dset._fingerprint, len(dset), test_size=self.hparams.test_size)
+        self.train_dataset, self.val_dataset, self.test_dataset = [
+            dset.select(splits[split]) for split in ['train', 'val', 'test']]
+
+    def _setup_streaming(self, left, right):
+        """ Setup streaming datasets from splits of the matched catalog.
+        """
+        matched_catalog = cross_match_datasets(
+            left,
+            right,
+            matching_radius=self.hparams.matching_radius,  # In arcsecs
+            return_catalog_only=True,
+            num_proc=self.hparams.num_workers
+        )
+
+        # Spliting the catalog into train, val, and test sets, sorted rows 
+        # keeping the reads of each healpix group together
+        splits = compute_split_indices(len(matched_catalog), test_size=self.hparams.test_size)
 
-        # Apply shuffling at the top level
-        dset = dset.shuffle(seed=42)
+        for split, rows in splits.items():
+            dset = cross_match_datasets(left, 
+                                        right, 
+                                        matched_catalog=matched_catalog[rows],
+                                        streaming=True)
+            if split == 'train':
+                dset = dset.shuffle(seed=42, buffer_size=self.hparams.shuffle_buffer_size)
+            if self.trainer is not None and self.trainer.world_size > 1:
+                dset = split_dataset_by_node(dset, rank=self.trainer.global_rank, world_size=self.trainer.world_size)
+            setattr(self, f'{split}_dataset', dset.with_format("torch"))
 
-        # Spliting dataset into train, val, and test sets
-        dset = dset.train_test_split(test_size=self.hparams.test_size)
-        dset, self.test_dataset = dset['train'], dset['test']
-        dset = dset.train_test_split(test_size=self.hparams.test_size)
-        self.train_dataset, self.val_dataset = dset['train'], dset['test']
+    def _dataloader(self, dataset, shuffle=False):
+        if self.hparams.streaming:
+            return DataLoader(dataset, 
+                              batch_size=self.hparams.batch_size, 
+                              num_workers=self.hparams.num_workers, 
+                              pin_memory=self.hparams.pin_memory,
+                              drop_last=True)
+        return batched_dataloader(dataset, 
+                                  batch_size=self.hparams.batch_size, 
+                                  shuffle=shuffle,
+                                  drop_last=True,
+                                  num_workers=self.hparams.num_workers,
+                                  pin_memory=self.hparams.pin_memory)
 
     def train_dataloader(self):
-        return DataLoader(self.train_dataset, batch_size=self.hparams.batch_size, num_workers=self.hparams.num_workers, drop_last=True)
+        return self._dataloader(self.train_dataset, shuffle=True)
 
     def val_dataloader(self):
-        return DataLoader(self.val_dataset, batch_size=self.hparams.batch_size, num_workers=self.hparams.num_workers, drop_last=True)
+        return self._dataloader(self.val_dataset)
 
     def test_dataloader(self):
-        return DataLoader(self.test_dataset, batch_size=self.hparams.batch_size, num_workers=self.hparams.num_workers, drop_last=True)
\ No newline at end of file
+        return self._dataloader(self.test_dataset)
@@ -1,8 +1,15 @@
+import os
+import hashlib
+import functools
+import operator
+import numpy as np
 import torch
 import tqdm
+import datasets
 from torch.utils.data import DataLoader
 from datasets.arrow_dataset import Dataset as HF_Dataset
-from typing import Tuple, Any
+from datasets.features.features import generate_from_arrow_type
+from typing import Tuple, Any, Dict, Optional
 
 def split_dataset(
         dataset: HF_Dataset, 
@@ -24,6 +31,320 @@ def split_dataset(
         raise ValueError('Split method not implemented yet.')
     return train_test_split['train'], train_test_split['test']
 
+def flatten_dataset(dataset: HF_Dataset) -> HF_Dataset:
+    """
+    Flattens the nested features of a dataset, e.g. `image.array` instead of `image` / `array`,
+    so that batches of rows are read as stacked tensors.
+
+    Fixed-length sequences of dictionaries are stored as variable-length lists, which do not
+    match their declared features once flattened, so the features of the flattened dataset
+    are inferred from its storage.
+
+    Parameters:
+    - dataset: The dataset to flatten.
+
+    Returns:
+    - The flattened dataset, with the same format type as the input dataset.
+    """
+    flat = dataset.flatten()
+    features = datasets.Features({field.name: generate_from_arrow_type(field.type)
+                                  for field in flat.data.schema})
+    if features != flat.features:
+        flat = HF_Dataset(flat.data, 
+                          info=datasets.DatasetInfo(features=features),
+                          indices_table=flat._indices,
+                          fingerprint=flat._fingerprint)
+    return flat.with_format(dataset.format["type"])
+
+def _split_sizes(num_rows: int, test_size: float) -> Tuple[int, int]:
+    """
+    Returns the number of (test, val) rows, with the same proportions as
+    train_test_split applied twice.
+    """
+    n_test = int(np.ceil(test_size * num_rows))
+    n_val = int(np.ceil(test_size * (num_rows - n_test)))
+    return n_test, n_val
+
+def compute_split_indices(
+        num_rows: int,
+        test_size: float = 0.1,
+        seed: int = 42,
+        groups: Optional[np.ndarray] = None
+        ) -> Dict[str, np.ndarray]:
+    """
+    Computes deterministic train, val and test row indices.
+
+    Parameters:
+    - num_rows: The number of rows of the dataset.
+    - test_size: The fraction of rows in the test set, and of the remaining rows in the val set.
+    - seed: The seed of the random split.
+    - groups: Optional group of each row (e.g. its healpix index). If given, whole groups
+      are assigned to the splits, so that neighbouring objects do not leak across splits.
+
+    Returns:
+    - A dictionary of sorted row indices for the 'train', 'val' and 'test' splits.
+    """
+    rng = np.random.default_rng(seed)
+    n_test, n_val = _split_sizes(num_rows, test_size)
+    if groups is None:
+        index = rng.permutation(num_rows)
+        splits = {'test': index[:n_test],
+                  'val': index[n_test:n_test + n_val],
+                  'train': index[n_test + n_val:]}
+    else:
+        unique_groups, inverse, counts = np.unique(groups, return_inverse=True, return_counts=True)
+        order = rng.permutation(len(unique_groups))
+        # Groups are assigned in random order until each split reaches its size
+        end = np.cumsum(counts[order])
+        assignment = np.full(len(unique_groups), 2)
+        assignment[order[end - counts[order] < n_test + n_val]] = 1
+        assignment[order[end - counts[order] < n_test]] = 0
+        row_assignment = assignment[inverse.ravel()]
+        splits = {name: np.flatnonzero(row_assignment == i) for i, name in enumerate(['test', 'val', 'train'])}
+    # Sorted indices keep the reads of each split as contiguous as possible
+    return {name: np.sort(index) for name, index in splits.items()}
+
+def get_split_indices(
+        fingerprint: str,
+        num_rows: int,
+        test_size: float = 0.1,
+        seed: int = 42,
+        groups: Optional[np.ndarray] = None,
+        cache_dir: Optional[str] = None
+        ) -> Dict[str, np.ndarray]:
+    """
+    Returns deterministic train, val and test row indices, cached on disk.
+
+    The indices are computed once with `compute_split_indices`, and saved in `cache_dir`
+    under a key combining the dataset fingerprint, the seed, the test size and whether
+    the split is grouped.
+
+    Parameters:
+    - fingerprint: A string identifying the content of the dataset, e.g. `Dataset._fingerprint`.
+    - num_rows: The number of rows of the dataset.
+    - test_size: The fraction of rows in the test set, and of the remaining rows in the val set.
+    - seed: The seed of the random split.
+    - groups: Optional group of each row (e.g. its healpix index), see `compute_split_indices`.
+    - cache_dir: The directory of the cached indices. Defaults to `astropile_splits` in the datasets cache.
+
+    Returns:
+    - A dictionary of sorted row indices for the 'train', 'val' and 'test' splits.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(datasets.config.HF_DATASETS_CACHE, 'astropile_splits')
+    key = hashlib.sha1(f"{fingerprint}-{num_rows}-{test_size}-{seed}-{groups is not None}".encode()).hexdigest()
+    cache_filename = os.path.join(cache_dir, f"splits-{key}.npz")
+    if os.path.exists(cache_filename):
+        with np.load(cache_filename) as cached:
+            return {name: cached[name] for name in cached.files}
+
+    splits = compute_split_indices(num_rows, test_size=test_size, seed=seed, groups=groups)
+    try:
+        # Writing to a temporary file first so that concurrent jobs never read a partial file
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_filename = f"{cache_filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, **splits)
+        os.replace(tmp_filename, cache_filename)
+    except OSError:
+        pass
+    return splits
+
+class RunningStatistics:
+    """
+    Per-channel statistics of a stream of batches, computed in a single pass.
+
+    Means and variances are updated with the parallel algorithm of Chan et al., so that
+    statistics of batches of any size, or computed on different workers, are merged
+    exactly and stably. Percentiles are estimated from a bottom-k sketch: each value gets
+    a random priority and the `sketch_size` values of lowest priority are kept, which is
+    a uniform sample of the stream that can also be merged.
+
+    Samples of shape (C, ...) have C channels, scalars and 1D samples a single one.
+
+    Parameters:
+    - sketch_size: The number of values per channel kept to estimate percentiles.
+    - seed: The seed of the random priorities of the sketch.
+    """
+    def __init__(self, sketch_size: int = 10000, seed: int = 0):
+        self.sketch_size = sketch_size
+        self.generator = torch.Generator().manual_seed(seed)
+        self.count = None
+
+    def _init(self, n_channels: int):
+        self.count = torch.zeros(n_channels, dtype=torch.float64)
+        self.mean = torch.zeros(n_channels, dtype=torch.float64)
+        self.m2 = torch.zeros(n_channels, dtype=torch.float64)
+        self.min = torch.full((n_channels,), float('inf'), dtype=torch.float64)
+        self.max = torch.full((n_channels,), float('-inf'), dtype=torch.float64)
+        self.nan_count = torch.zeros(n_channels, dtype=torch.float64)
+        self.sketch = torch.zeros(n_channels, 0, dtype=torch.float64)
+        self.priorities = torch.zeros(n_channels, 0, dtype=torch.float64)
+
+    def update(self, batch: torch.Tensor):
+        """
+        Updates the statistics with a batch of samples of shape (B, ...).
+        """
+        batch = torch.as_tensor(batch).detach().cpu().to(torch.float64)
+        if batch.dim() >= 3:
+            x = batch.transpose(0, 1).reshape(batch.shape[1], -1)
+        else:
+            x = batch.reshape(1, -1)
+        if self.count is None:
+            self._init(x.shape[0])
+
+        nan = torch.isnan(x)
+        count = (~nan).sum(dim=1).to(torch.float64)
+        mean = torch.where(nan, 0, x).sum(dim=1) / count.clamp(min=1)
+        m2 = torch.where(nan, 0, x - mean[:, None]).pow(2).sum(dim=1)
+        other = (count, mean, m2, 
+                 torch.where(nan, float('inf'), x).amin(dim=1), 
+                 torch.where(nan, float('-inf'), x).amax(dim=1),
+                 nan.sum(dim=1).to(torch.float64))
+        priorities = torch.rand(x.shape, generator=self.generator, dtype=torch.float64)
+        self._merge(other, x, torch.where(nan, float('inf'), priorities))
+
+    def merge(self, other: 'RunningStatistics'):
+        """
+        Merges the statistics of another stream, e.g. computed by another worker.
+        """
+        if other.count is None:
+            return
+        if self.count is None:
+            self._init(other.count.shape[0])
+        self._merge((other.count, other.mean, other.m2, other.min, other.max, other.nan_count),
+                    other.sketch, other.priorities)
+
+    def _merge(self, other, sketch, priorities):
+        count, mean, m2, vmin, vmax, nan_count = other
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total.clamp(min=1)
+        self.m2 = self.m2 + m2 + delta**2 * self.count * count / total.clamp(min=1)
+        self.count = total
+        self.min = torch.minimum(self.min, vmin)
+        self.max = torch.maximum(self.max, vmax)
+        self.nan_count = self.nan_count + nan_count
+
+        # Keep the values of lowest priority in the sketch
+        sketch = torch.cat([self.sketch, sketch], dim=1)
+        priorities = torch.cat([self.priorities, priorities], dim=1)
+        k = min(self.sketch_size, sketch.shape[1])
+        self.priorities, index = torch.topk(priorities, k, dim=1, largest=False)
+        self.sketch = torch.gather(sketch, 1, index)
+
+    def compute(self, percentiles: Tuple[float, ...] = (1., 50., 99.)) -> Dict[str, Any]:
+        """
+        Returns a dictionary of per-channel `count`, `mean`, `std`, `min`, `max`, 
+        `nan_count` and `percentiles` (a dictionary of estimated percentiles).
+        """
+        # NaN values of the sketch have an infinite priority and are only kept
+        # when the stream has fewer than sketch_size valid values
+        sketch = torch.where(torch.isinf(self.priorities), float('nan'), self.sketch)
+        q = torch.tensor(percentiles, dtype=torch.float64) / 100.
+        quantiles = torch.nanquantile(sketch, q, dim=1) if sketch.shape[1] > 0 else torch.full((len(q), len(self.count)), float('nan'))
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'std': torch.sqrt(self.m2 / (self.count - 1).clamp(min=1)),
+            'min': self.min,
+            'max': self.max,
+            'nan_count': self.nan_count,
+            'percentiles': {p: quantiles[i] for i, p in enumerate(percentiles)},
+        }
+
+class _StatisticsShards(torch.utils.data.IterableDataset):
+    """
+    Computes running statistics over a shard of a dataset in each DataLoader worker.
+    """
+    def __init__(self, dataset, flag: str, batch_size: int, sketch_size: int, seed: int):
+        super().__init__()
+        self.dataset = dataset
+        self.flag = flag
+        self._accessor = KeyAccessor(flag)
+        self.batch_size = batch_size
+        self.sketch_size = sketch_size
+        self.seed = seed
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        stats = RunningStatistics(sketch_size=self.sketch_size, seed=self.seed + worker_id)
+        starts = range(worker_id * self.batch_size, len(self.dataset), num_workers * self.batch_size)
+        for start in starts:
+            # Batched read of the rows of the batch
+            batch = self.dataset[list(range(start, min(start + self.batch_size, len(self.dataset))))]
+            value = self._accessor(batch)
+            if isinstance(value, list):
+                value = torch.stack([torch.as_tensor(v) for v in value])
+            stats.update(value)
+        yield stats
+
+def compute_statistics(
+        dataset,
+        flag: str,
+        batch_size: int = 128,
+        num_workers: int = 8,
+        percentiles: Tuple[float, ...] = (1., 50., 99.),
+        sketch_size: int = 10000,
+        seed: int = 0,
+        cache_dir: Optional[str] = None
+        ) -> Dict[str, Any]:
+    """
+    Computes per-channel statistics of a feature of a dataset in a single pass.
+
+    Each DataLoader worker computes the statistics of its share of the batches with
+    `RunningStatistics`, and the results of all workers are merged. For HF datasets,
+    the result is cached next to the dataset cache files, under a key combining the
+    dataset fingerprint and the arguments.
+
+    Parameters:
+    - dataset: The dataset to compute statistics for, indexable with lists of indices. 
+      Images are assumed to be C x H x W.
+    - flag: The key in the dataset corresponding to the feature of interest, e.g. `image.array`.
+    - batch_size: The number of rows read at once.
+    - num_workers: The number of DataLoader workers computing statistics in parallel.
+    - percentiles: The percentiles to estimate, between 0 and 100.
+    - sketch_size: The number of values per channel kept to estimate percentiles.
+    - seed: The seed of the percentile sketches.
+    - cache_dir: The directory of the cached statistics. Defaults to the directory of the
+      cache files of a HF dataset, and no caching for other datasets.
+
+    Returns:
+    - A dictionary of per-channel `count`, `mean`, `std`, `min`, `max`, `nan_count` and `percentiles`.
+    """
+    if isinstance(dataset, HF_Dataset):
+        # Nested features are flattened so that batches of rows are read as stacked tensors
+        dataset = flatten_dataset(dataset).with_format('torch')
+        if cache_dir is None and len(dataset.cache_files) > 0:
+            cache_dir = os.path.dirname(dataset.cache_files[0]['filename'])
+        fingerprint = dataset._fingerprint
+    else:
+        fingerprint = None
+
+    cache_filename = None
+    if cache_dir is not None and fingerprint is not None:
+        key = hashlib.sha1(f"{fingerprint}-{flag}-{batch_size}-{percentiles}-{sketch_size}-{seed}".encode()).hexdigest()
+        cache_filename = os.path.join(cache_dir, f"statistics-{key}.pt")
+        if os.path.exists(cache_filename):
+            return torch.load(cache_filename)
+
+    stats = RunningStatistics(sketch_size=sketch_size, seed=seed)
+    shards = _StatisticsShards(dataset, flag, batch_size, sketch_size, seed)
+    loader = DataLoader(shards, batch_size=None, num_workers=num_workers)
+    for worker_stats in loader:
+        stats.merge(worker_stats)
+    result = stats.compute(percentiles)
+
+    if cache_filename is not None:
+        try:
+            tmp_filename = f"{cache_filename}.{os.getpid()}.tmp"
+            torch.save(result, tmp_filename)
+            os.replace(tmp_filename, cache_filename)
+        except OSError:
+            pass
+    return result
+
 def compute_dataset_statistics(
         dataset: HF_Dataset, 
         flag: str, 
@@ -44,48 +365,26 @@ def compute_dataset_statistics(
     Returns:
     - A tuple of (mean, std) tensors for the specified feature.
     """
-    dummy = get_nested(dataset[0], flag)
-
-    if len(dummy.shape) == 3:
-        axis = (0, 2, 3)
-        input_channels = dummy.shape[0]
-
-    elif dummy.shape == ():
-        axis = 0
-        input_channels = 1
-
-    else: 
-        raise ValueError('Invalid shape of the feature tensor, only supports images or scalars.')
-
-    # Compute statistics either for the entire dataset loaded in memory or iteratively.
     if loading == 'full':
-        # print(get_nested(dataset, flag))
-        # TODO @Liam this breaks for me because I can't do get_nested(dataset, flag) because dataset is an indexable list (HF Dataset), not a dict.
-        # can only key into an element or batch, not the whole dataset
-        # iterated works fine as it uses batches
-        mean, std = torch.mean(get_nested(dataset, flag), dim=axis), torch.std(get_nested(dataset, flag), dim=axis)
+        stats = compute_statistics(dataset, flag, batch_size=len(dataset), num_workers=0)
     elif loading == 'iterated':
-        mean, mean_sq = torch.zeros(input_channels), torch.zeros(input_channels)
-        dummy_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
-        n_batches = len(dummy_loader)
-
-        for batch in dummy_loader:
-            # added .float() as pytorch can't take a mean of Long (i.e. uint8)
-            mean += torch.mean(get_nested(batch, flag).float(), dim=axis)
-            mean_sq += torch.mean(get_nested(batch, flag).float()**2, dim=axis)
-
-        mean /= n_batches
-        std = (mean_sq / n_batches - mean**2).sqrt()
+        stats = compute_statistics(dataset, flag, batch_size=batch_size, num_workers=num_workers)
     else:
         raise ValueError('Invalid loading method specified.')
-    
-    if len(dummy.shape) == 3:
-        mean = mean[:,None,None]
-        std = std[:,None,None]
+    mean, std = stats['mean'].float(), stats['std'].float()
+
+    dummy = dataset[0]
+    dummy = torch.as_tensor(get_nested(dummy, flag))
+    if dummy.dim() >= 2:
+        # Per-channel statistics, broadcastable to the samples
+        shape = (-1,) + (1,) * (dummy.dim() - 1)
+        mean, std = mean.reshape(shape), std.reshape(shape)
+    else:
+        mean, std = mean[0], std[0]
 
     return mean, std
 
-def normalize_sample(sample, mean, std, dynamic_range, z_score=True):
+def normalize_sample(sample: torch.Tensor, mean: torch.Tensor, std: torch.Tensor, dynamic_range: bool, z_score: bool = True):
     """
     Normalizes a sample, with optional dynamic range compression.
     """
@@ -95,31 +394,145 @@ def normalize_sample(sample, mean, std, dynamic_range, z_score=True):
         sample = torch.arcsinh(sample/3)
     return sample
 
-def denormalize_sample(sample, mean, std, dynamic_range, z_score=True):
+def denormalize_sample(sample: torch.Tensor, mean: torch.Tensor, std: torch.Tensor, dynamic_range: bool, z_score: bool = True):
     """
     Reverses normalization (and optional dynamic range compression) on a sample.
     """
     if dynamic_range:
-        sample = torch.sinh(sample*3)
+        sample = torch.sinh(sample)*3
     if z_score:
         sample = sample * std + mean
     return sample
 
+class Normalization(torch.nn.Module):
+    """
+    Batched normalization layer, with optional dynamic range compression.
+
+    The per-channel mean and std are stored as buffers, so that the layer follows the
+    model to its device and is saved in its checkpoints. The forward pass applies
+    `normalize_sample` to a whole batch, or `denormalize_sample` if `inverse` is True.
+
+    Parameters:
+    - mean: The per-channel mean, of shape (C,).
+    - std: The per-channel standard deviation, of shape (C,).
+    - channel_dims: The number of dimensions after the channel dimension of a sample,
+      e.g. 2 for images of shape C x H x W, and 0 for scalars.
+    - dynamic_range: Whether to apply arcsinh dynamic range compression.
+    - z_score: Whether to apply z-score normalization.
+    - inverse: Whether the layer reverses the normalization.
+    """
+    def __init__(
+            self, 
+            mean: torch.Tensor, 
+            std: torch.Tensor, 
+            channel_dims: int = 2, 
+            dynamic_range: bool = False, 
+            z_score: bool = True, 
+            inverse: bool = False
+            ):
+        super().__init__()
+        shape = (-1,) + (1,) * channel_dims
+        self.register_buffer('mean', torch.as_tensor(mean, dtype=torch.float32).reshape(shape))
+        self.register_buffer('std', torch.as_tensor(std, dtype=torch.float32).reshape(shape))
+        self.channel_dims = channel_dims
+        self.dynamic_range = dynamic_range
+        self.z_score = z_score
+        self.inverse = inverse
+
+    @classmethod
+    def from_statistics(cls, statistics, **kwargs) -> 'Normalization':
+        """
+        Builds the layer from statistics returned by `compute_statistics`, or from the
+        path of a file where they were saved.
+        """
+        if isinstance(statistics, str):
+            statistics = torch.load(statistics)
+        return cls(statistics['mean'], statistics['std'], **kwargs)
+
+    def inverted(self) -> 'Normalization':
+        """
+        Returns the layer reversing this normalization, sharing its statistics.
+        """
+        inverse = Normalization(self.mean.flatten(), self.std.flatten(), 
+                                channel_dims=self.channel_dims, 
+                                dynamic_range=self.dynamic_range, 
+                                z_score=self.z_score, 
+                                inverse=not self.inverse)
+        return inverse.to(self.mean.device)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.inverse:
+            return denormalize_sample(x, self.mean, self.std, self.dynamic_range, z_score=self.z_score)
+        return normalize_sample(x, self.mean, self.std, self.dynamic_range, z_score=self.z_score)
+
 def get_nested(dic, compound_key: str, default=None, raise_on_missing=True):
     """
     Get a nested value from a dictionary using a compound key.
     """
-    # if . in compout_key, split it and get the value
-    if '.' in compound_key:
-        keys = compound_key.split('.')
-        current_value = dic
+    try:
+        return _compile_getter(compound_key)(dic)
+    except (KeyError, TypeError):
+        if raise_on_missing:
+            raise KeyError(f'Key {compound_key} not found in dictionary {dic}.')
+        return default
+
+@functools.lru_cache(maxsize=None)
+def _compile_getter(compound_key: str):
+    """
+    Compiles a compound key like `image.array` into a getter, also accepting 
+    dictionaries flattened with the compound key itself.
+    """
+    path = [operator.itemgetter(key) for key in compound_key.split('.')]
+    if len(path) == 1:
+        return path[0]
+    def getter(dic):
         try:
-            for key in keys:
-                current_value = current_value[key]
-            return current_value
-        except (KeyError, TypeError):
-            if raise_on_missing:
-                raise KeyError(f'Key {compound_key} not found in dictionary {dic}.')
-            return default
-    else:
-        return dic[compound_key]
\ No newline at end of file
+            for get in path:
+                dic = get(dic)
+            return dic
+        except KeyError:
+            return getter.flat(dic)
+    getter.flat = operator.itemgetter(compound_key)
+    return getter
+
+class KeyAccessor:
+    """
+    Getter and setter of one or several compound keys of a batch, compiled once.
+
+    With a single key, e.g. `image.array`, the accessor returns the value of that key.
+    With a list of keys, e.g. for multi-target regression, it returns their values 
+    stacked along a new last dimension, and the setter splits values along it.
+
+    Parameters:
+    - keys: A compound key, or a list of compound keys.
+    """
+    def __init__(self, keys):
+        self.keys = keys
+        self.multiple = not isinstance(keys, str)
+        key_list = list(keys) if self.multiple else [keys]
+        self._getters = [_compile_getter(key) for key in key_list]
+        self._parents = [_compile_getter(key.rsplit('.', 1)[0]) if '.' in key else None for key in key_list]
+        self._names = [key.rsplit('.', 1)[-1] for key in key_list]
+
+    def __getstate__(self):
+        # Compiled getters are rebuilt from the keys, e.g. in DataLoader workers
+        return {'keys': self.keys}
+
+    def __setstate__(self, state):
+        self.__init__(state['keys'])
+
+    def __len__(self):
+        return len(self._getters)
+
+    def __call__(self, batch):
+        if not self.multiple:
+            return self._getters[0](batch)
+        return torch.stack([get(batch) for get in self._getters], dim=-1)
+
+    def set(self, batch, value):
+        """
+        Sets the value of the keys in a batch, in place.
+        """
+        values = value.unbind(dim=-1) if self.multiple else [value]
+        for parent, name, v in zip(self._parents, self._names, values):
+            (parent(batch) if parent is not None else batch)[name] = v
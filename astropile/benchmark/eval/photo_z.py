@@ -3,34 +3,111 @@ import matplotlib.pyplot as plt
 from sklearn.metrics import r2_score
 import lightning as L
 import numpy as np
+import torch
+
+from astropile.benchmark.dataset_utils import KeyAccessor
 
 __all__ = ['PhotozEvalCallback']
 
 class PhotozEvalCallback(L.Callback):
-    """Callback to calculate the R^2 score on the validation set."""
-    def __init__(self):
+    """Callback to calculate the R^2 score and photo-z metrics on the validation set.
+
+    Predictions are taken from the outputs of `validation_step` when it returns a dict 
+    with `y_hat` and `y` entries, and only recomputed with a forward pass otherwise. 
+    Metrics are accumulated in a streaming fashion in preallocated tensors on the device 
+    of the model, and summed across DDP ranks at the end of the epoch.
+
+    In addition to `val_r2`, the bias, scatter and outlier fraction of the normalized 
+    residuals dz = (z_pred - z) / (1 + z) are logged, and their values in bins of true 
+    redshift are stored in `binned_metrics`.
+
+    Args:
+        z_min (float, optional): Lower edge of the redshift bins. Defaults to 0.
+        z_max (float, optional): Upper edge of the redshift bins. Defaults to 2.
+        n_bins (int, optional): Number of redshift bins. Defaults to 10.
+        outlier_threshold (float, optional): Threshold on |dz| above which a prediction is an outlier. Defaults to 0.15.
+    """
+    def __init__(self, 
+                 z_min: float = 0., 
+                 z_max: float = 2., 
+                 n_bins: int = 10, 
+                 outlier_threshold: float = 0.15):
         super().__init__()
-        self.predictions = []
-        self.targets = []
+        self.z_min = z_min
+        self.z_max = z_max
+        self.n_bins = n_bins
+        self.outlier_threshold = outlier_threshold
+        self.binned_metrics = None
+        self._sums = None
+        self._target = None
+
+    def _reset(self, device):
+        # Count, sum of targets, sum of squared targets, sum of squared residuals
+        self._sums = torch.zeros(4, dtype=torch.float64, device=device)
+        # Count, sum of dz, sum of dz^2 and number of outliers per redshift bin
+        self._binned_sums = torch.zeros(self.n_bins, 4, dtype=torch.float64, device=device)
+        self._bin_edges = torch.linspace(self.z_min, self.z_max, self.n_bins + 1, 
+                                         dtype=torch.float64, device=device)
+
+    def on_validation_epoch_start(self, trainer, pl_module):
+        self._reset(pl_module.device)
 
     def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
-        preds = pl_module(batch)
-        targets = batch[pl_module.hparams.target]
-        self.predictions.extend(preds.cpu().numpy())
-        self.targets.extend(targets.cpu().numpy())
+        if isinstance(outputs, dict) and 'y_hat' in outputs:
+            preds, targets = outputs['y_hat'], outputs['y']
+        else:
+            if self._target is None:
+                self._target = KeyAccessor(pl_module.hparams.target)
+            preds, targets = pl_module(batch), self._target(batch)
+        if self._sums is None:
+            self._reset(pl_module.device)
+        preds = preds.detach().reshape(-1).to(self._sums)
+        targets = targets.detach().reshape(-1).to(self._sums)
+
+        self._sums += torch.stack([torch.ones_like(targets).sum(), 
+                                   targets.sum(), 
+                                   (targets**2).sum(), 
+                                   ((targets - preds)**2).sum()])
+
+        dz = (preds - targets) / (1 + targets)
+        bins = torch.bucketize(targets, self._bin_edges[1:-1])
+        self._binned_sums.index_add_(0, bins, torch.stack([torch.ones_like(dz), 
+                                                           dz, 
+                                                           dz**2, 
+                                                           (dz.abs() > self.outlier_threshold).to(dz)], dim=-1))
 
     def on_validation_epoch_end(self, trainer, pl_module):
-        predictions = np.array(self.predictions)
-        targets = np.array(self.targets)
-        r2 = r2_score(targets, predictions)
-
-        # Log the R^2 score
-        pl_module.log('val_r2', r2, on_epoch=True, prog_bar=True, logger=True)
-
-        # Clear the lists for the next epoch
-        self.predictions = []
-        self.targets = []
-
+        if self._sums is None:
+            return
+        sums = trainer.strategy.reduce(self._sums, reduce_op='sum')
+        binned_sums = trainer.strategy.reduce(self._binned_sums, reduce_op='sum')
+        n, sum_y, sum_y2, ss_res = sums
+        ss_tot = sum_y2 - sum_y**2 / n
+        r2 = 1 - ss_res / ss_tot
+
+        count, sum_dz, sum_dz2, outliers = binned_sums.sum(dim=0)
+        bias = sum_dz / count
+        scatter = torch.sqrt(torch.clamp(sum_dz2 / count - bias**2, min=0))
+
+        # Log the R^2 score and the photo-z metrics
+        pl_module.log('val_r2', r2.float(), on_epoch=True, prog_bar=True, logger=True)
+        pl_module.log('val_bias', bias.float(), on_epoch=True, logger=True)
+        pl_module.log('val_scatter', scatter.float(), on_epoch=True, logger=True)
+        pl_module.log('val_outlier_fraction', (outliers / count).float(), on_epoch=True, logger=True)
+
+        count, sum_dz, sum_dz2, outliers = binned_sums.cpu().numpy().T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bin_bias = sum_dz / count
+            self.binned_metrics = {
+                'bin_edges': self._bin_edges.cpu().numpy(),
+                'count': count,
+                'bias': bin_bias,
+                'scatter': np.sqrt(np.clip(sum_dz2 / count - bin_bias**2, 0, None)),
+                'outlier_fraction': outliers / count,
+            }
+
+        # Reset the accumulators for the next epoch
+        self._sums = None
 
 def plot_redshift(
         y: np.ndarray, 
@@ -0,0 +1,239 @@
+"""Data loading throughput of the AstroPile parent samples.
+
+For each parent sample, examples/sec and MB/sec are measured when reading the raw
+HDF5 files, when generating examples with the dataset builder, and when loading
+batches with the `AstroPile` DataLoader. Without `--data_root`, tiny synthetic
+parent samples are generated first, so that the benchmark runs offline.
+
+Usage:
+    python -m astropile.benchmark loading --samples desi hsc --num_workers 4 --output report.json
+    python -m astropile.benchmark loading --baseline report.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from typing import List, Optional
+import numpy as np
+import torch
+import h5py
+import datasets
+
+from astropile.hdf5_utils import is_shared_column
+from astropile.synthetic import SAMPLES, generate_parent_sample
+from astropile.benchmark.dataset import AstroPile
+
+PATHS = ['hdf5', 'generate_examples', 'dataloader']
+
+def _nbytes(value) -> int:
+    """Number of bytes of the arrays contained in a (nested) example or batch."""
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return np.asarray(value).nbytes
+
+def _result(num_examples: int, num_bytes: int, seconds: float) -> dict:
+    return {'examples': num_examples,
+            'seconds': seconds,
+            'examples_per_sec': num_examples / seconds,
+            'mb_per_sec': num_bytes / seconds / 2**20}
+
+def _read_group(group: h5py.Group) -> int:
+    """Read all the datasets of an HDF5 group, and return their number of bytes."""
+    num_bytes = 0
+    for value in group.values():
+        num_bytes += _read_group(value) if isinstance(value, h5py.Group) else _nbytes(value[()])
+    return num_bytes
+
+def benchmark_hdf5(files: List[str], batch_size: int = 128) -> dict:
+    """Read all the columns of the files, `batch_size` rows at a time.
+
+    Files storing one group per object (e.g. MaNGA) are read one object at a time.
+    Columns shared by all the rows of a file are read once per file.
+    """
+    num_examples, num_bytes = 0, 0
+    start = time.perf_counter()
+    for filename in files:
+        with h5py.File(filename, 'r') as data:
+            columns = [v for v in data.values() if isinstance(v, h5py.Dataset)]
+            if len(columns) == 0:
+                for group in data.values():
+                    num_bytes += _read_group(group)
+                num_examples += len(data)
+                continue
+            # Grids shared by all the rows of the file (e.g. the DESI wavelengths) are read once
+            for column in columns:
+                if is_shared_column(column):
+                    num_bytes += column[()].nbytes
+            columns = [column for column in columns if not is_shared_column(column)]
+            num_rows = len(columns[0])
+            for row in range(0, num_rows, batch_size):
+                for column in columns:
+                    num_bytes += column[row:row + batch_size].nbytes
+            num_examples += num_rows
+    return _result(num_examples, num_bytes, time.perf_counter() - start)
+
+def benchmark_generate_examples(builder: datasets.DatasetBuilder) -> dict:
+    """Iterate over the train examples yielded by the `_generate_examples` method of the builder."""
+    # The arguments of _generate_examples are those prepared by the builder itself
+    split_generators = builder._split_generators(datasets.DownloadManager())
+    gen_kwargs = next(s.gen_kwargs for s in split_generators if s.name == 'train')
+    num_examples, num_bytes = 0, 0
+    start = time.perf_counter()
+    for _, example in builder._generate_examples(**gen_kwargs):
+        num_examples += 1
+        num_bytes += _nbytes(example)
+    return _result(num_examples, num_bytes, time.perf_counter() - start)
+
+def benchmark_dataloader(name: str,
+                         data_root: str,
+                         batch_size: int = 128,
+                         num_workers: int = 0,
+                         max_batches: Optional[int] = None) -> dict:
+    """Iterate over the train DataLoader of the `AstroPile` DataModule, once the Arrow dataset is prepared."""
+    datamodule = AstroPile(name,
+                           batch_size=batch_size,
+                           num_workers=num_workers,
+                           local_astropile_root=data_root)
+    datamodule.setup()
+    num_examples, num_bytes = 0, 0
+    # Workers startup is part of the measurement, as it is paid at every epoch
+    start = time.perf_counter()
+    for i, batch in enumerate(datamodule.train_dataloader()):
+        if max_batches is not None and i >= max_batches:
+            break
+        num_examples += len(batch['object_id'])
+        num_bytes += _nbytes(batch)
+    return _result(num_examples, num_bytes, time.perf_counter() - start)
+
+def run_benchmark(data_root: str,
+                  samples: List[str],
+                  paths: List[str] = PATHS,
+                  batch_size: int = 128,
+                  num_workers: int = 0,
+                  max_batches: Optional[int] = None) -> dict:
+    """Measure the loading throughput of the parent samples found in `data_root`.
+
+    Args:
+        data_root (str): Root directory of the local AstroPile datasets.
+        samples (List[str]): Names of the parent samples to benchmark.
+        paths (List[str], optional): Loading paths to benchmark, among `PATHS`. Defaults to all of them.
+        batch_size (int, optional): Number of rows read at once. Defaults to 128.
+        num_workers (int, optional): Number of workers of the DataLoader. Defaults to 0.
+        max_batches (int, optional): Maximum number of batches loaded by the DataLoader. Defaults to None (one epoch).
+
+    Returns:
+        dict: The benchmark configuration, and the results of each sample and loading path.
+    """
+    report = {'config': {'batch_size': batch_size, 'num_workers': num_workers, 'max_batches': max_batches},
+              'results': {}}
+    for name in samples:
+        builder = datasets.load_dataset_builder(os.path.join(data_root, name), trust_remote_code=True)
+        files = list(builder.config.data_files['train'])
+        results = {}
+        if 'hdf5' in paths:
+            results['hdf5'] = benchmark_hdf5(files, batch_size=batch_size)
+        if 'generate_examples' in paths:
+            results['generate_examples'] = benchmark_generate_examples(builder)
+        if 'dataloader' in paths:
+            results['dataloader'] = benchmark_dataloader(name, data_root,
+                                                         batch_size=batch_size,
+                                                         num_workers=num_workers,
+                                                         max_batches=max_batches)
+        report['results'][name] = results
+    return report
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float = 0.2) -> List[str]:
+    """Return the loading paths which are slower than in the baseline by more than `tolerance`.
+
+    Args:
+        report (dict): Report of the current benchmark, as returned by `run_benchmark`.
+        baseline (dict): Report of a previous benchmark.
+        tolerance (float, optional): Allowed relative slowdown in examples/sec. Defaults to 0.2.
+
+    Returns:
+        List[str]: Description of each regression.
+    """
+    regressions = []
+    for name, results in report['results'].items():
+        for path, result in results.items():
+            reference = baseline['results'].get(name, {}).get(path)
+            if reference is None:
+                continue
+            ratio = result['examples_per_sec'] / reference['examples_per_sec']
+            if ratio < 1 - tolerance:
+                regressions.append(f"{name}/{path}: {result['examples_per_sec']:.1f} examples/sec, "
+                                   f"{ratio:.2f}x the baseline of {reference['examples_per_sec']:.1f}")
+    return regressions
+
+def format_report(report: dict, baseline: Optional[dict] = None) -> str:
+    """Format the results of the benchmark as a Markdown table."""
+    lines = ['| sample | path | examples/sec | MB/sec | vs. baseline |', '|---|---|---|---|---|']
+    for name, results in report['results'].items():
+        for path, result in results.items():
+            reference = None if baseline is None else baseline['results'].get(name, {}).get(path)
+            speedup = '' if reference is None else f"{result['examples_per_sec']/reference['examples_per_sec']:.2f}x"
+            lines.append(f"| {name} | {path} | {result['examples_per_sec']:.1f} "
+                         f"| {result['mb_per_sec']:.1f} | {speedup} |")
+    return '\n'.join(lines)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', nargs='+', default=list(SAMPLES))
+    parser.add_argument('--paths', nargs='+', default=PATHS, choices=PATHS)
+    parser.add_argument('--data_root', type=str, default=None,
+                        help='Root of the local AstroPile datasets, tiny synthetic samples are generated if not given')
+    parser.add_argument('--num_objects', type=int, default=512, help='Number of objects of the synthetic samples')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--max_batches', type=int, default=None)
+    parser.add_argument('--output', type=str, default=None, help='Path of the JSON report')
+    parser.add_argument('--baseline', type=str, default=None, help='Path of a previous JSON report')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown from the baseline')
+    args = parser.parse_args(args)
+
+    hf_cache = datasets.config.HF_DATASETS_CACHE
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_root = args.data_root
+        if data_root is None:
+            data_root = tmp_dir
+            for name in args.samples:
+                generate_parent_sample(name, data_root, num_objects=args.num_objects)
+            # Synthetic samples of every run have the same layout, so the Arrow datasets
+            # are cached with them instead of reusing those of previous runs
+            datasets.config.HF_DATASETS_CACHE = os.path.join(tmp_dir, 'hf_cache')
+        try:
+            report = run_benchmark(data_root, args.samples,
+                                   paths=args.paths,
+                                   batch_size=args.batch_size,
+                                   num_workers=args.num_workers,
+                                   max_batches=args.max_batches)
+        finally:
+            datasets.config.HF_DATASETS_CACHE = hf_cache
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(format_report(report, baseline))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare_to_baseline(report, baseline, tolerance=args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,41 @@ import torch
 import torch.nn as nn
 import torchvision.models as models
 from typing import Union, List, Optional
-import torchvision.transforms as transforms
+
+from astropile.benchmark.dataset_utils import Normalization, KeyAccessor
 
 __all__ = ['ConvolutionalModel']
 
+def range_compress(x: torch.Tensor, range_compression_factor: float) -> torch.Tensor:
+    """Compresses the dynamic range of images with an arcsinh, and clamps them to [-1, 1].
+
+    Small fluxes are divided by a small factor, so this should be computed in float32.
+    """
+    x = torch.arcsinh(x / range_compression_factor)*range_compression_factor
+    x = x * 10.0
+    return torch.clamp(x, -1.0, 1.0)
+
+class D4Augmentation(nn.Module):
+    """Applies an independent random element of the dihedral group D4 to each image of a batch.
+
+    Each image is flipped or not, then rotated by a multiple of 90 degrees, using only 
+    tensor flips and `rot90` on the device of the batch, without any interpolation. 
+    Images must be square and of shape (B, C, H, W).
+    """
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # Element of D4 applied to each image: flipped if >= 4, then rotated by (k % 4) * 90 degrees
+        k = torch.randint(0, 8, (x.shape[0],), device=x.device)
+        out = torch.empty_like(x)
+        for t in range(8):
+            mask = k == t
+            if not mask.any():
+                continue
+            x_t = x[mask]
+            if t >= 4:
+                x_t = x_t.flip(-1)
+            out[mask] = torch.rot90(x_t, t % 4, dims=(-2, -1))
+        return out
+
 class _ImageModel(L.LightningModule):
     """This is the base model class for image classification. Note that it does not contain the model architecture itself"""
     def __init__(self, 
@@ -15,6 +46,8 @@ class _ImageModel(L.LightningModule):
                  loss: str = 'mse',
                  target: Union[str, List[str]] = 'Z',
                  range_compression_factor: float = 0.01,
+                 normalization_statistics: Optional[str] = None,
+                 input_key: str = 'image.array',
                  lr: float = 1e-3):
         super().__init__()
 
@@ -23,36 +56,52 @@ class _ImageModel(L.LightningModule):
         else:
             raise ValueError(f"Loss {loss} not supported.")
 
-        # Standard image augmentation
-        self.transform = transforms.Compose([
-            transforms.RandomHorizontalFlip(),
-            transforms.RandomVerticalFlip(),
-            transforms.RandomRotation(90)
-        ])
+        # Accessors of the input images and targets in the batches, with one target per output
+        self.input = KeyAccessor(input_key)
+        self.target = KeyAccessor(target)
+        if self.target.multiple and len(self.target) != output_size:
+            raise ValueError(f"Got {len(self.target)} targets for an output size of {output_size}.")
+
+        # Standard image augmentation, applied on the device of the batch
+        self.augmentation = D4Augmentation()
+
+        # Optional per-channel normalization, from statistics computed once per dataset
+        if normalization_statistics is not None:
+            self.normalization = Normalization.from_statistics(normalization_statistics)
+        else:
+            self.normalization = None
 
     def forward(self, batch):
-        x = batch['image']['array']
-        # Apply range compression to inputs
-        x = torch.arcsinh(x / self.hparams.range_compression_factor)*self.hparams.range_compression_factor
-        x = x * 10.0
-        x = torch.clamp(x, -1.0, 1.0)
-        return self.model(x)
+        x = self.input(batch)
+        # Apply independent random flips and rotations to each training image
+        if self.training:
+            x = self.augmentation(x)
+        # Preprocessing is precision-sensitive, and always runs in float32 even under autocast
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = x.float()
+            if self.normalization is not None:
+                x = self.normalization(x)
+            # Apply range compression to inputs
+            x = range_compress(x, self.hparams.range_compression_factor)
+        if self.hparams.get('channels_last', False):
+            x = x.contiguous(memory_format=torch.channels_last)
+        # Predictions are returned in float32 for the losses and metrics
+        return self.model(x).float()
         
     def training_step(self, batch, batch_idx):
-        y = batch[self.hparams.target]
-        # Apply standard image augmentation
-        batch['image']['array'] = self.transform(batch['image']['array'])
+        y = self.target(batch)
         y_hat = self(batch)
         loss = self.loss(y_hat.squeeze(), y.squeeze())
         self.log('train_loss', loss, on_epoch=True, prog_bar=True)
         return loss
 
     def validation_step(self, batch, batch_idx):
-        y = batch[self.hparams.target]
+        y = self.target(batch)
         y_hat = self(batch)
         loss = self.loss(y_hat.squeeze(), y.squeeze())
         self.log('val_loss', loss, on_epoch=True, prog_bar=True)
-        return loss
+        # Predictions are returned for evaluation callbacks, to avoid a second forward pass
+        return {'loss': loss, 'y_hat': y_hat.detach(), 'y': y}
     
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.lr)
@@ -67,11 +116,24 @@ class ConvolutionalModel(_ImageModel):
                  loss: str = "mse",
                  target: Union[str, List[str]] = 'Z',
                  range_compression_factor: Optional[float] = None,
+                 normalization_statistics: Optional[str] = None,
+                 input_key: str = 'image.array',
+                 channels_last: bool = False,
+                 compile: bool = False,
                  lr: float = 5e-4):
+        """ResNet model for image regression.
+
+        Mixed precision is selected with the `precision` of the Trainer (e.g. `bf16-mixed`),
+        the preprocessing of the images always running in float32. With `channels_last`,
+        the network and its inputs use the channels-last memory format, and with `compile`,
+        the network is compiled with `torch.compile`.
+        """
         super().__init__(input_channels=input_channels, 
                          output_size=output_size, 
                          loss=loss, 
                          target=target,
+                         normalization_statistics=normalization_statistics,
+                         input_key=input_key,
                          lr=lr)
         self.save_hyperparameters()
 
@@ -85,4 +147,10 @@ class ConvolutionalModel(_ImageModel):
             self.model.fc = nn.Linear(512, output_size)
         else:
             raise ValueError(f"Model {self.hparams.name} not supported.")
+
+        if self.hparams.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        if self.hparams.compile:
+            # Compiling in place keeps the parameter names of the checkpoints
+            self.model.compile()
         
\ No newline at end of file
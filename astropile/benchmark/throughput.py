@@ -0,0 +1,115 @@
+"""Training throughput of the image models in different precision and memory format modes.
+
+Usage:
+    python -m astropile.benchmark model --batch_size 32 --steps 10
+"""
+import argparse
+import contextlib
+import time
+from typing import List, Optional
+import torch
+
+from astropile.benchmark.models.image import ConvolutionalModel
+
+# Autocast dtype, channels-last memory format and torch.compile of each mode
+MODES = {
+    'fp32': dict(dtype=None, channels_last=False, compile=False),
+    'bf16': dict(dtype=torch.bfloat16, channels_last=False, compile=False),
+    'fp16': dict(dtype=torch.float16, channels_last=False, compile=False),
+    'channels_last': dict(dtype=None, channels_last=True, compile=False),
+    'bf16_channels_last': dict(dtype=torch.bfloat16, channels_last=True, compile=False),
+    'compile': dict(dtype=None, channels_last=False, compile=True),
+}
+DEFAULT_MODES = ['fp32', 'bf16', 'channels_last', 'bf16_channels_last']
+
+def benchmark_mode(mode: str,
+                   batch_size: int = 32,
+                   image_size: int = 160,
+                   input_channels: int = 3,
+                   steps: int = 10,
+                   warmup: int = 2,
+                   device: str = 'cpu',
+                   seed: int = 0) -> float:
+    """Measure the training throughput of a `ConvolutionalModel` on a synthetic batch.
+
+    Args:
+        mode (str): One of the modes of `MODES`.
+        batch_size (int, optional): Number of images per training step. Defaults to 32.
+        image_size (int, optional): Size in pixels of the square images. Defaults to 160.
+        input_channels (int, optional): Number of channels of the images. Defaults to 3.
+        steps (int, optional): Number of timed training steps. Defaults to 10.
+        warmup (int, optional): Number of training steps run before timing. Defaults to 2.
+        device (str, optional): Device on which to train. Defaults to 'cpu'.
+        seed (int, optional): Seed of the synthetic batch and of the model weights. Defaults to 0.
+
+    Returns:
+        float: Number of images processed per second.
+    """
+    options = MODES[mode]
+    torch.manual_seed(seed)
+    model = ConvolutionalModel(input_channels=input_channels,
+                               range_compression_factor=0.01,
+                               channels_last=options['channels_last'],
+                               compile=options['compile']).to(device)
+    model.train()
+    optimizer = model.configure_optimizers()
+    batch = {'image': {'array': 0.1*torch.randn(batch_size, input_channels, image_size, image_size, device=device)},
+             'Z': torch.rand(batch_size, device=device)}
+
+    if options['dtype'] is not None:
+        autocast = lambda: torch.autocast(device_type=torch.device(device).type, dtype=options['dtype'])
+    else:
+        autocast = contextlib.nullcontext
+
+    def step():
+        optimizer.zero_grad()
+        with autocast():
+            loss = model.loss(model(batch).squeeze(), batch['Z'])
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(warmup):
+        step()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return steps*batch_size / (time.perf_counter() - start)
+
+def run_benchmark(modes: Optional[List[str]] = None, **kwargs) -> dict:
+    """Measure the training throughput of each mode, see `benchmark_mode` for the arguments."""
+    return {mode: benchmark_mode(mode, **kwargs) for mode in (modes or DEFAULT_MODES)}
+
+def format_report(results: dict) -> str:
+    """Format the throughputs of the modes as a Markdown table, relative to the first mode."""
+    reference = next(iter(results.values()))
+    lines = ['| mode | images/sec | speedup |', '|---|---|---|']
+    for mode, throughput in results.items():
+        lines.append(f'| {mode} | {throughput:.1f} | {throughput/reference:.2f}x |')
+    return '\n'.join(lines)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', default=DEFAULT_MODES, choices=list(MODES))
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--image_size', type=int, default=160)
+    parser.add_argument('--input_channels', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args(args)
+
+    results = run_benchmark(modes=args.modes,
+                            batch_size=args.batch_size,
+                            image_size=args.image_size,
+                            input_channels=args.input_channels,
+                            steps=args.steps,
+                            warmup=args.warmup,
+                            device=args.device)
+    print(format_report(results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+from typing import List
+from multiprocessing import Pool
+import numpy as np
+import healpy as hp
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from astropy.table import Table, hstack
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+
+_healpix_nside = 16
+
+def group_by_healpix(healpix: np.ndarray) -> dict:
+    """Return a mapping from healpix index to the rows of a catalog in that cell."""
+    healpix = np.asarray(healpix)
+    order = np.argsort(healpix, kind='stable')
+    cells, starts = np.unique(healpix[order], return_index=True)
+    return dict(zip(cells.tolist(), np.split(order, starts[1:])))
+
+def _match_cell(args):
+    """Matches the objects of a single healpix cell to the candidates of its neighbourhood."""
+    left_rows, left_ra, left_dec, right_rows, right_ra, right_dec, matching_radius = args
+    sc_left = SkyCoord(left_ra, left_dec, unit='deg')
+    sc_right = SkyCoord(right_ra, right_dec, unit='deg')
+    idx, sep2d, _ = sc_left.match_to_catalog_sky(sc_right)
+    mask = sep2d < matching_radius*u.arcsec
+    return left_rows[mask], right_rows[idx[mask]]
+
+def _cell_tasks(cat_left, cat_right, matching_radius, nside):
+    """Yields the matching tasks of each healpix cell of the left catalog."""
+    left_ra, left_dec = np.asarray(cat_left['ra']), np.asarray(cat_left['dec'])
+    right_ra, right_dec = np.asarray(cat_right['ra']), np.asarray(cat_right['dec'])
+    right_cells = group_by_healpix(cat_right['healpix'])
+    for healpix, left_rows in group_by_healpix(cat_left['healpix']).items():
+        # Candidates are searched in the cell itself and its 8 neighbours (-1 if missing)
+        neighbourhood = [healpix] + hp.get_all_neighbours(nside, healpix, nest=True).tolist()
+        right_rows = [right_cells[h] for h in neighbourhood if h in right_cells]
+        if len(right_rows) == 0:
+            continue
+        right_rows = np.concatenate(right_rows)
+        yield (left_rows, left_ra[left_rows], left_dec[left_rows],
+               right_rows, right_ra[right_rows], right_dec[right_rows],
+               matching_radius)
+
+def match_catalogs(cat_left: Table,
+                   cat_right: Table,
+                   matching_radius: float = 1.,
+                   nside: int = _healpix_nside,
+                   num_proc: int = None):
+    """Cross-match two catalogs independently in each healpix cell.
+
+    Each cell of the left catalog is matched against the right catalog objects of
+    that cell and of its neighbours, so that memory is bounded per cell and matches
+    straddling cell borders are recovered. Cells are processed in parallel.
+
+    Args:
+        cat_left (Table): Catalog with `ra`, `dec` (in degrees) and `healpix` columns.
+        cat_right (Table): Catalog with `ra`, `dec` (in degrees) and `healpix` columns.
+        matching_radius (float, optional): The maximum separation in arcseconds for a match to be considered. Defaults to 1.
+        nside (int, optional): The nside of the (nested) healpix indices of the catalogs. Defaults to 16.
+        num_proc (int, optional): Number of processes to use for parallel processing. Defaults to None (no parallelism).
+
+    Returns:
+        tuple: Indices of the matched rows in the left catalog, and of their nearest match in the right catalog.
+
+    Raises:
+        ValueError: If the matching radius is larger than the size of a healpix cell.
+    """
+    if matching_radius*u.arcsec >= hp.max_pixrad(nside)*u.rad:
+        raise ValueError(f"Matching radius of {matching_radius} arcsec is too large for healpix cells of nside={nside}.")
+
+    tasks = _cell_tasks(cat_left, cat_right, matching_radius, nside)
+    if num_proc is not None and num_proc > 1:
+        with Pool(num_proc) as pool:
+            results = list(pool.imap_unordered(_match_cell, tasks))
+    else:
+        results = [_match_cell(task) for task in tasks]
+
+    if len(results) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    idx_left = np.concatenate([r[0] for r in results])
+    idx_right = np.concatenate([r[1] for r in results])
+    # Preserve the order of the left catalog
+    order = np.argsort(idx_left, kind='stable')
+    return idx_left[order], idx_right[order]
+
+def cross_match_catalogs(cat_left: Table,
+                         cat_right: Table,
+                         names: List[str],
+                         matching_radius: float = 1.,
+                         nside: int = _healpix_nside,
+                         num_proc: int = None) -> Table:
+    """Build the cross-matched catalog of two AstroPile catalogs.
+
+    Args:
+        cat_left (Table): The left catalog, with at least `object_id`, `ra`, `dec` and `healpix` columns.
+        cat_right (Table): The right catalog, with at least `object_id`, `ra`, `dec` and `healpix` columns.
+        names (List[str]): Names of the left and right catalogs, used to prefix their columns.
+        matching_radius (float, optional): The maximum separation in arcseconds for a match to be considered. Defaults to 1.
+        nside (int, optional): The nside of the (nested) healpix indices of the catalogs. Defaults to 16.
+        num_proc (int, optional): Number of processes to use for parallel processing. Defaults to None.
+
+    Returns:
+        astropy.table.Table: The matched catalog, with the columns of both catalogs prefixed by their
+        names, the default `object_id`, `ra`, `dec` and `healpix` columns, and grouped by `healpix`.
+    """
+    left_name, right_name = names
+    idx_left, idx_right = match_catalogs(cat_left, cat_right,
+                                         matching_radius=matching_radius,
+                                         nside=nside,
+                                         num_proc=num_proc)
+    matched_catalog = hstack([cat_left[idx_left], cat_right[idx_right]],
+                             table_names=[left_name, right_name],
+                             uniq_col_name='{table_name}_{col_name}')
+    print("Number of matches across healpix region borders: ",
+          np.sum(matched_catalog[f'{left_name}_healpix'] != matched_catalog[f'{right_name}_healpix']))
+    print("Final size of cross-matched catalog: ", len(matched_catalog))
+
+    # Adding default columns to respect format
+    matched_catalog['object_id'] = matched_catalog[left_name+'_object_id']
+    matched_catalog['ra'] = 0.5*(matched_catalog[left_name+'_ra'] +
+                                 matched_catalog[right_name+'_ra'])
+    matched_catalog['dec'] = 0.5*(matched_catalog[left_name+'_dec'] +
+                                  matched_catalog[right_name+'_dec'])
+
+    # Objects straddling a border are assigned to the healpix cell of the left catalog
+    matched_catalog['healpix'] = matched_catalog[left_name+'_healpix']
+    return matched_catalog.group_by(['healpix'])
+
+def _unit_vectors(ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    """Converts sky coordinates in degrees into unit vectors on the sphere."""
+    ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+    return np.stack([np.cos(dec)*np.cos(ra),
+                     np.cos(dec)*np.sin(ra),
+                     np.sin(dec)], axis=-1)
+
+def friends_of_friends(ra: np.ndarray,
+                       dec: np.ndarray,
+                       matching_radius: float = 1.) -> np.ndarray:
+    """Group sources closer than a linking length into friends-of-friends groups.
+
+    All sources are indexed in a single KD-tree on unit vectors, so that groups
+    can be found in one pass regardless of the number of input catalogs.
+
+    Args:
+        ra (np.ndarray): Right ascension of the sources, in degrees.
+        dec (np.ndarray): Declination of the sources, in degrees.
+        matching_radius (float, optional): The linking length in arcseconds. Defaults to 1.
+
+    Returns:
+        np.ndarray: Group label of each source. Labels are numbered in order of first appearance.
+    """
+    n_sources = len(ra)
+    if n_sources == 0:
+        return np.zeros(0, dtype=int)
+    tree = cKDTree(_unit_vectors(np.asarray(ra), np.asarray(dec)))
+    # Chord length corresponding to the matching radius
+    chord = 2*np.sin(np.deg2rad(matching_radius / 3600.) / 2)
+    pairs = tree.query_pairs(chord, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])),
+                       shape=(n_sources, n_sources))
+    _, labels = connected_components(graph, directed=False)
+
+    # Renumber groups by order of first appearance
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=int)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse]
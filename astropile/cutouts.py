@@ -0,0 +1,74 @@
+from typing import List, Optional, Tuple
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+def cutout_corners(x: np.ndarray, y: np.ndarray, size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the pixel indices of the first row and column of square cutouts centered on positions.
+
+    Windows are rounded as in `astropy.nddata.Cutout2D`, so that cutouts are identical to
+    those of `Cutout2D(data, (x, y), size)` when they fully overlap the image.
+
+    Args:
+        x (np.ndarray): Column (x) pixel coordinates of the centers, 0-based.
+        y (np.ndarray): Row (y) pixel coordinates of the centers, 0-based.
+        size (int): Size in pixels of the cutouts.
+
+    Returns:
+        tuple: First row and first column of each cutout, possibly outside of the image.
+    """
+    rows = np.ceil(np.asarray(y, dtype=np.float64) - size / 2.).astype(np.int64)
+    cols = np.ceil(np.asarray(x, dtype=np.float64) - size / 2.).astype(np.int64)
+    return rows, cols
+
+def batch_cutouts(planes: List[np.ndarray],
+                  x: np.ndarray,
+                  y: np.ndarray,
+                  size: int,
+                  fill_value=0,
+                  dtype=None,
+                  out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Extract square cutouts of several image planes at many positions at once.
+
+    All planes must share the same pixel grid, e.g. the bands of a coadd brick, so that
+    pixel positions are computed once for all planes with a single WCS. Cutouts fully
+    inside the planes are gathered with one vectorized selection per plane, and cutouts
+    overlapping the edges are padded with `fill_value`.
+
+    Args:
+        planes (List[np.ndarray]): 2D arrays of identical shape.
+        x (np.ndarray): Column (x) pixel coordinates of the centers, 0-based.
+        y (np.ndarray): Row (y) pixel coordinates of the centers, 0-based.
+        size (int): Size in pixels of the cutouts.
+        fill_value (optional): Value of the pixels outside of the planes. Defaults to 0.
+        dtype (optional): Data type of the cutouts. Defaults to the common type of the planes.
+        out (np.ndarray, optional): Preallocated array of shape (N, len(planes), size, size) to write
+            the cutouts into, e.g. a view of some of the channels of a larger array. Defaults to None.
+
+    Returns:
+        np.ndarray: Cutouts of shape (N, len(planes), size, size).
+    """
+    height, width = planes[0].shape
+    rows, cols = cutout_corners(x, y, size)
+    inside = (rows >= 0) & (cols >= 0) & (rows + size <= height) & (cols + size <= width)
+    if out is None:
+        cutouts = np.full((len(rows), len(planes), size, size), fill_value,
+                          dtype=np.result_type(*planes) if dtype is None else dtype)
+    else:
+        cutouts = out
+        cutouts[~inside] = fill_value
+
+    for k, plane in enumerate(planes):
+        # Strided view of all windows of the plane, gathered without intermediate copies
+        windows = sliding_window_view(plane, (size, size))
+        cutouts[inside, k] = windows[rows[inside], cols[inside]]
+
+    for i in np.flatnonzero(~inside):
+        row_min, row_max = max(rows[i], 0), min(rows[i] + size, height)
+        col_min, col_max = max(cols[i], 0), min(cols[i] + size, width)
+        if row_min >= row_max or col_min >= col_max:
+            # No overlap with the planes
+            continue
+        for k, plane in enumerate(planes):
+            cutouts[i, k, row_min - rows[i]:row_max - rows[i], col_min - cols[i]:col_max - cols[i]] = \
+                plane[row_min:row_max, col_min:col_max]
+    return cutouts
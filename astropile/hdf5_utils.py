@@ -0,0 +1,267 @@
+import os
+import numpy as np
+import h5py
+
+def index_filename(filename: str, id_key: str = 'object_id') -> str:
+    """Return the path of the object id index stored alongside an HDF5 file."""
+    return f"{filename}.{id_key}.index.npy"
+
+def _build_object_index(ids: np.ndarray) -> np.ndarray:
+    """Sorts a column of object ids into a structured (id, row) array."""
+    # Variable length strings come out of h5py as objects, and non-native byte
+    # orders would force numpy to copy the index on every search. Going through
+    # the dtype string also drops the h5py metadata, which cannot be saved.
+    if ids.dtype.kind == 'O':
+        ids = ids.astype(np.bytes_)
+    id_dtype = np.dtype(ids.dtype.str).newbyteorder('=')
+    sort_index = np.argsort(ids, kind='stable')
+    index = np.empty(len(ids), dtype=np.dtype([('id', id_dtype), ('row', np.int64)], align=True))
+    index['id'] = ids[sort_index]
+    index['row'] = sort_index
+    return index
+
+def save_array(filename: str, array: np.ndarray):
+    """Save a numpy array to a `.npy` file atomically."""
+    # Writing to a temporary file first so that concurrent readers never see a partial file
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_filename, filename)
+
+def _save_object_index(filename: str, id_key: str, index: np.ndarray):
+    save_array(index_filename(filename, id_key), index)
+
+def write_object_index(filename: str, id_key: str = 'object_id'):
+    """Write the sorted object id index of an AstroPile HDF5 file next to it.
+
+    The index is a structured numpy array with fields `id` (sorted object ids) and
+    `row` (row of each id in the HDF5 file), saved as `<filename>.<id_key>.index.npy`.
+
+    Args:
+        filename (str): Path to the HDF5 file, e.g. `healpix=123/001-of-001.hdf5`.
+        id_key (str, optional): Name of the object id column. Defaults to 'object_id'.
+
+    Raises:
+        ValueError: If the object ids of the file are not unique.
+    """
+    with h5py.File(filename, 'r') as data:
+        index = _build_object_index(data[id_key][:])
+    duplicated = index['id'][1:] == index['id'][:-1]
+    if np.any(duplicated):
+        raise ValueError(f"{filename} contains {np.sum(duplicated)} duplicated values of {id_key}, "
+                         f"e.g. {index['id'][1:][duplicated][0]}.")
+    _save_object_index(filename, id_key, index)
+
+def write_shared_column(hdf5_file: h5py.File, key: str, value: np.ndarray):
+    """Write a column shared by all the rows of an AstroPile HDF5 file, e.g. a wavelength grid.
+
+    The column is stored once, instead of once per row, and flagged with a `shared`
+    attribute so that readers can broadcast it to each row.
+
+    Args:
+        hdf5_file (h5py.File): An AstroPile HDF5 file open for writing.
+        key (str): Name of the column.
+        value (np.ndarray): Value of the column for every row.
+    """
+    hdf5_file.create_dataset(key, data=value).attrs['shared'] = True
+
+def is_shared_column(dset: h5py.Dataset) -> bool:
+    """Return True if an HDF5 column was written with `write_shared_column`."""
+    return bool(dset.attrs.get('shared', False))
+
+def write_shard(filename: str, catalog):
+    """Write the columns of a catalog to an uncompressed HDF5 shard, atomically.
+
+    Shards are meant to be written independently by concurrent workers, and assembled
+    into a single file with `merge_shards` once all workers are done.
+
+    Args:
+        filename (str): Path to the shard.
+        catalog (astropy.table.Table or dict): Columns to write, with one row per object.
+    """
+    keys = catalog.colnames if hasattr(catalog, 'colnames') else list(catalog.keys())
+    # Readers only ever see complete shards
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with h5py.File(tmp_filename, 'w') as hdf5_file:
+        for key in keys:
+            hdf5_file.create_dataset(key, data=catalog[key])
+    os.replace(tmp_filename, filename)
+
+def merge_shards(shards, filename: str, compression: str = 'gzip', id_key: str = None):
+    """Concatenate HDF5 shards with the same columns into a single file, in one pass.
+
+    Datasets of the output file are created once with their final size, and the rows
+    of each shard are copied to their offset, instead of resizing the datasets for each
+    shard. Fixed-length strings are widened to the longest string of all shards.
+
+    The output file may itself be one of the shards, e.g. to append new shards to it.
+    Nothing is written when there are no shards.
+
+    Args:
+        shards (List[str]): Paths to the shards, in the order of the output rows.
+        filename (str): Path to the output HDF5 file, replaced if it exists.
+        compression (str, optional): Compression of the output datasets. Defaults to 'gzip'.
+        id_key (str, optional): Name of the object id column. If given, rows whose id is already
+            in a previous shard are dropped, e.g. when appending the shards of a rerun. Defaults to None.
+    """
+    if len(shards) == 0:
+        return
+
+    # Layout of the output file, from the metadata of the shards and their ids only
+    lengths, masks, dtypes, shapes = [], [], {}, {}
+    seen_ids = None
+    for shard in shards:
+        with h5py.File(shard, 'r') as data:
+            keys = list(data.keys())
+            mask = slice(None)
+            if id_key is not None:
+                ids = data[id_key][:]
+                mask = np.ones(len(ids), dtype=bool)
+                if seen_ids is not None:
+                    mask = ~np.isin(ids, seen_ids)
+                seen_ids = ids if seen_ids is None else np.concatenate([seen_ids, ids[mask]])
+                lengths.append(int(np.sum(mask)))
+            else:
+                lengths.append(data[keys[0]].shape[0])
+            masks.append(mask)
+            for key in keys:
+                dtype = data[key].dtype
+                dtypes[key] = dtype if key not in dtypes else np.result_type(dtypes[key], dtype)
+                shapes[key] = data[key].shape[1:]
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with h5py.File(tmp_filename, 'w') as hdf5_file:
+        for key in dtypes:
+            hdf5_file.create_dataset(key, shape=(offsets[-1], *shapes[key]), dtype=dtypes[key],
+                                     compression=compression, chunks=True)
+        for shard, mask, start, stop in zip(shards, masks, offsets[:-1], offsets[1:]):
+            with h5py.File(shard, 'r') as data:
+                for key in dtypes:
+                    hdf5_file[key][start:stop] = data[key][:][mask]
+    os.replace(tmp_filename, filename)
+
+def load_object_index(data: h5py.File, id_key: str = 'object_id') -> np.ndarray:
+    """Return the sorted object id index of an open AstroPile HDF5 file.
+
+    The index sidecar is memory-mapped when it exists and is up to date. Otherwise,
+    the index is computed from the id column and persisted for subsequent calls if
+    the file system allows it.
+
+    Args:
+        data (h5py.File): An open AstroPile HDF5 file.
+        id_key (str, optional): Name of the object id column. Defaults to 'object_id'.
+
+    Returns:
+        np.ndarray: Structured array with fields `id` and `row`, sorted by `id`.
+    """
+    filename = data.filename
+    sidecar = index_filename(filename, id_key)
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(filename):
+        return np.load(sidecar, mmap_mode='r')
+
+    index = _build_object_index(data[id_key][:])
+    try:
+        _save_object_index(filename, id_key, index)
+    except OSError:
+        # Read-only dataset, the index is only kept in memory
+        pass
+    return index
+
+def find_rows(data: h5py.File, object_ids, id_key: str = 'object_id') -> np.ndarray:
+    """Map requested object ids to their row indices in an AstroPile HDF5 file.
+
+    Only the index sidecar is searched, in O(k log n) for k requested ids, so the
+    full id column of the file does not need to be read.
+
+    Args:
+        data (h5py.File): An open AstroPile HDF5 file.
+        object_ids (array-like): Object ids to look up.
+        id_key (str, optional): Name of the object id column. Defaults to 'object_id'.
+
+    Returns:
+        np.ndarray: Row index of each requested id, in the requested order.
+
+    Raises:
+        KeyError: If some of the requested ids are not present in the file.
+    """
+    index = load_object_index(data, id_key)
+    keys, pos, found = _search_object_index(index, object_ids)
+    if not np.all(found):
+        raise KeyError(f"Object ids {keys[~found][:10]} not found in {data.filename}.")
+    return np.asarray(index['row'][pos])
+
+def contains_ids(data: h5py.File, object_ids, id_key: str = 'object_id') -> np.ndarray:
+    """Return a boolean mask of the requested object ids present in an AstroPile HDF5 file.
+
+    Args:
+        data (h5py.File): An open AstroPile HDF5 file.
+        object_ids (array-like): Object ids to look up.
+        id_key (str, optional): Name of the object id column. Defaults to 'object_id'.
+
+    Returns:
+        np.ndarray: True for each requested id found in the file.
+    """
+    _, _, found = _search_object_index(load_object_index(data, id_key), object_ids)
+    return found
+
+def _search_object_index(index: np.ndarray, object_ids):
+    """Binary search of object ids in a sorted object id index."""
+    ids = index['id']
+    keys = np.asarray(object_ids)
+    if keys.dtype.kind == 'U' and ids.dtype.kind == 'S':
+        keys = np.char.encode(keys)
+    if len(keys) == 0 or len(ids) == 0:
+        return keys, np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+    pos = np.clip(np.searchsorted(ids, keys), 0, len(ids) - 1)
+    return keys, pos, ids[pos] == keys
+
+DEFAULT_BATCH_SIZE = 128
+
+def read_rows(data: h5py.File, rows, keys) -> dict:
+    """Read the requested rows of several columns of an AstroPile HDF5 file.
+
+    Each column is read with a single selection: a contiguous block when the
+    requested rows are dense, and a sorted fancy selection otherwise.
+
+    Args:
+        data (h5py.File): An open AstroPile HDF5 file.
+        rows (array-like): Row indices to read, in any order and possibly repeated.
+        keys (List[str]): Names of the columns to read.
+
+    Returns:
+        dict: Mapping from column name to an array of values in the requested order.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) == 0:
+        return {k: data[k][:0] for k in keys}
+    # h5py only supports strictly increasing indices for fancy selections
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    start, stop = unique_rows[0], unique_rows[-1] + 1
+    if stop - start <= 2 * len(unique_rows):
+        # Reading the whole block is cheaper than a point selection
+        return {k: data[k][start:stop][rows - start] for k in keys}
+    return {k: data[k][unique_rows][inverse] for k in keys}
+
+def iter_rows(data: h5py.File, rows, keys, batch_size: int = DEFAULT_BATCH_SIZE):
+    """Iterate over rows of an AstroPile HDF5 file, reading columns in batches.
+
+    Rows are yielded in the requested order, but columns are read at most
+    `batch_size` rows at a time with `read_rows`, instead of one read per
+    column and per row.
+
+    Args:
+        data (h5py.File): An open AstroPile HDF5 file.
+        rows (array-like): Row indices to read, e.g. as returned by `find_rows`.
+        keys (List[str]): Names of the columns to read.
+        batch_size (int, optional): Maximum number of rows held in memory at once. Defaults to DEFAULT_BATCH_SIZE.
+
+    Yields:
+        dict: Mapping from column name to the value of that column for the current row.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    keys = list(dict.fromkeys(keys))
+    for start in range(0, len(rows), batch_size):
+        columns = read_rows(data, rows[start:start + batch_size], keys)
+        for n in range(min(batch_size, len(rows) - start)):
+            yield {k: v[n] for k, v in columns.items()}
@@ -0,0 +1,340 @@
+"""Synthetic AstroPile parent samples, to test and profile the pipeline without downloading survey data.
+
+Usage:
+    python -m astropile.synthetic desi hsc --output_dir synthetic --num_objects 100000 --num_healpix 16
+    python -m astropile.synthetic gaia --output_dir synthetic --density 1000 --healpix 1570 1571
+"""
+import os
+import shutil
+import argparse
+import importlib.util
+from typing import Dict, Iterator, List, Optional
+import numpy as np
+import healpy as hp
+import h5py
+import datasets
+
+from astropile.hdf5_utils import write_object_index, write_shared_column
+
+_healpix_nside = 16
+
+# Default location of the dataset builder scripts, in the scripts folder of the repository
+_SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+
+# Approximate size of the blocks of rows generated and written at once
+_CHUNK_BYTES = 2**27
+
+def _load_builder_module(script: str):
+    """Import a dataset builder script as a module."""
+    name = os.path.splitext(os.path.basename(script))[0]
+    spec = importlib.util.spec_from_file_location(f"_astropile_synthetic_{name}", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def _builder_class(module) -> type:
+    """Return the dataset builder class defined in a builder script module."""
+    for value in vars(module).values():
+        if (isinstance(value, type) and issubclass(value, datasets.GeneratorBasedBuilder)
+            and value.__module__ == module.__name__):
+            return value
+    raise ValueError(f"No dataset builder found in {module.__file__}.")
+
+def sky_positions(healpix: np.ndarray, rng: np.random.Generator, nside: int = _healpix_nside):
+    """Draw one random sky position inside each of the given nested healpix cells.
+
+    Positions are drawn among the sub-pixels of the cells at a resolution finer than
+    an arcsecond, so that they always fall in the requested cell.
+
+    Args:
+        healpix (np.ndarray): Nested healpix index of the cell of each position.
+        rng (np.random.Generator): Random number generator.
+        nside (int, optional): The nside of the healpix indices. Defaults to 16.
+
+    Returns:
+        tuple: Right ascension and declination of the positions, in degrees.
+    """
+    # Nested sub-pixels of a cell at nside * 2**order are contiguous
+    order = int(np.log2(2**18 // nside))
+    subpixels = np.asarray(healpix, dtype=np.int64) * 4**order + rng.integers(0, 4**order, size=len(healpix))
+    ra, dec = hp.pix2ang(nside * 2**order, subpixels, nest=True, lonlat=True)
+    return ra, dec
+
+def _desi_columns(module, n: int, rng: np.random.Generator) -> Dict[str, np.ndarray]:
+    """Synthetic columns of the DESI parent sample."""
+    length = _builder_class(module)._spectrum_length
+    columns = {
+        'spectrum_flux': rng.normal(size=(n, length)).astype(np.float32),
+        'spectrum_ivar': rng.uniform(0.5, 2., size=(n, length)).astype(np.float32),
+        'spectrum_lsf_sigma': np.full((n, length), 1., dtype=np.float32),
+        'spectrum_mask': rng.random((n, length)) < 0.01,
+    }
+    for f in module._FLOAT_FEATURES:
+        columns[f] = rng.normal(size=n).astype(np.float32)
+    columns['Z'] = rng.uniform(0., 2., size=n).astype(np.float32)
+    for f in module._BOOL_FEATURES:
+        # Flags are stored as integers, 0 meaning no problem
+        columns[f] = (rng.random(n) < 0.05).astype(np.int64)
+    return columns
+
+def _desi_grids(module) -> Dict[str, np.ndarray]:
+    """Synthetic columns shared by all the spectra of a DESI file."""
+    length = _builder_class(module)._spectrum_length
+    # The coadded brz wavelength grid has a constant 0.8 Angstrom step
+    return {'spectrum_lambda': (3600. + 0.8 * np.arange(length)).astype(np.float32)}
+
+def _hsc_columns(module, n: int, rng: np.random.Generator) -> Dict[str, np.ndarray]:
+    """Synthetic columns of the HSC parent sample."""
+    builder = _builder_class(module)
+    bands, size = builder._bands, builder._image_size
+    shape = (n, len(bands), size, size)
+    columns = {
+        'image_band': np.array([[f'hsc-{b.lower()}'.encode('utf-8') for b in bands]] * n,
+                               dtype=h5py.string_dtype('utf-8', 5)),
+        'image_array': (0.01 * rng.normal(size=shape)).astype(np.float32),
+        'image_ivar': rng.uniform(1e3, 1e4, size=shape).astype(np.float32),
+        'image_mask': rng.random(shape) < 0.01,
+        'image_psf_fwhm': rng.uniform(0.5, 1., size=(n, len(bands))).astype(np.float32),
+        'image_scale': np.full((n, len(bands)), 0.168, dtype=np.float32),
+    }
+    for f in module._FLOAT_FEATURES:
+        columns[f] = rng.normal(size=n).astype(np.float32)
+    return columns
+
+def _gaia_columns(module, n: int, rng: np.random.Generator, num_coefficients: int = 110) -> Dict[str, np.ndarray]:
+    """Synthetic columns of the Gaia parent sample, with concatenated BP and RP XP coefficients."""
+    columns = {
+        'coeff': rng.normal(size=(n, num_coefficients)).astype(np.float32),
+        'coeff_error': rng.uniform(0.01, 0.1, size=(n, num_coefficients)).astype(np.float32),
+    }
+    for f in (module._PHOTOMETRY_FEATURES + module._ASTROMETRY_FEATURES + module._RV_FEATURES
+              + module._GSPPHOT_FEATURES + module._FLAG_FEATURES + module._CORRECTION_FEATURES):
+        columns[f] = rng.normal(size=n).astype(np.float32)
+    return columns
+
+def _plasticc_columns(module, n: int, rng: np.random.Generator, sequence_length: int = 100) -> Dict[str, np.ndarray]:
+    """Synthetic columns of the PLAsTiCC parent sample, with light curves of shape (bands, 3, sequence_length)."""
+    num_bands = len(module._BANDS)
+    time = np.sort(rng.uniform(59580., 60675., size=(n, num_bands, sequence_length)), axis=-1)
+    flux = rng.normal(size=(n, num_bands, sequence_length))
+    flux_err = rng.uniform(0.1, 1., size=(n, num_bands, sequence_length))
+    columns = {'lightcurve': np.stack([time, flux, flux_err], axis=2).astype(np.float32)}
+    for f in module._FLOAT_FEATURES:
+        columns[f] = rng.uniform(0., 2., size=n).astype(np.float32)
+    columns['obj_type'] = rng.choice(list(module._CLASS_MAPPING), size=n)
+    return columns
+
+def _manga_group(module, rng: np.random.Generator, num_spaxels: int = 64) -> Dict[str, np.ndarray]:
+    """Synthetic datasets of the group of a single MaNGA cube, with `num_spaxels` spaxels."""
+    builder = _builder_class(module)
+    length, size = builder._spectrum_size, builder._image_size
+    num_filters = len(builder._image_filters)
+    units = 'S32'
+
+    # Spectra of the spaxels have the (1, length) shape of the features of the builder
+    spaxels = np.zeros(num_spaxels, dtype=[
+        ('flux', 'f4', (1, length)), ('ivar', 'f4', (1, length)), ('mask', 'i8', (1, length)),
+        ('lsf_sigma', 'f4', (1, length)), ('lambda', 'f4', (1, length)),
+        ('x', 'i8'), ('y', 'i8'), ('spaxel_idx', 'i8'), ('flux_units', units), ('lambda_units', units),
+        ('skycoo_x', 'f4'), ('skycoo_y', 'f4'), ('ellcoo_r', 'f4'), ('ellcoo_rre', 'f4'),
+        ('ellcoo_rkpc', 'f4'), ('ellcoo_theta', 'f4'), ('skycoo_units', units),
+        ('ellcoo_r_units', units), ('ellcoo_rre_units', units), ('ellcoo_rkpc_units', units),
+        ('ellcoo_theta_units', units)])
+    spaxels['flux'] = rng.normal(size=(num_spaxels, 1, length))
+    spaxels['ivar'] = rng.uniform(0.5, 2., size=(num_spaxels, 1, length))
+    spaxels['lsf_sigma'] = 1.
+    # The LOGCUBE wavelength grid is logarithmic, from 3622 to 10354 Angstrom
+    spaxels['lambda'] = np.logspace(np.log10(3622.), np.log10(10354.), length)
+    spaxels['spaxel_idx'] = np.arange(num_spaxels)
+    spaxels['x'], spaxels['y'] = spaxels['spaxel_idx'] % size, spaxels['spaxel_idx'] // size
+    for f in ['skycoo_x', 'skycoo_y', 'ellcoo_r', 'ellcoo_rre', 'ellcoo_rkpc', 'ellcoo_theta']:
+        spaxels[f] = rng.normal(size=num_spaxels)
+    spaxels['flux_units'] = b'1e-17 erg/s/cm^2/Angstrom/spaxel'
+    spaxels['lambda_units'] = b'Angstrom'
+
+    images = np.zeros(num_filters, dtype=[
+        ('image_band', 'S5'), ('image_array', 'f4', (size, size)), ('image_array_units', units),
+        ('image_psf', 'f4', (size, size)), ('image_psf_units', units),
+        ('image_scale', 'f8'), ('image_scale_units', units)])
+    images['image_band'] = [f.lower().encode('utf-8') for f in builder._image_filters]
+    images['image_array'] = rng.normal(size=(num_filters, size, size))
+    images['image_psf'] = rng.uniform(size=(num_filters, size, size))
+    images['image_array_units'] = images['image_psf_units'] = b'nanomaggies/pixel'
+    images['image_scale'], images['image_scale_units'] = 0.5, b'arcsec'
+
+    maps = np.zeros(2, dtype=[
+        ('group', units), ('label', units), ('array', 'f4', (size, size)),
+        ('ivar', 'f4', (size, size)), ('mask', 'f4', (size, size)), ('array_units', units)])
+    maps['group'], maps['label'] = [b'stellar_vel', b'emline_gflux'], [b'stellar_vel', b'ha_6564']
+    maps['array'] = rng.normal(size=(2, size, size))
+    maps['ivar'] = 1.
+    maps['array_units'] = [b'km/s', b'1e-17 erg/s/spaxel/cm^2']
+
+    return {'z': rng.uniform(0., 0.15), 'spaxel_size': 0.5, 'spaxel_size_unit': b'arcsec',
+            'spaxels': spaxels, 'images': images, 'maps': maps}
+
+# Builder script, directory of the default config, file name, object id column and synthetic
+# columns of each parent sample. Samples stored with one HDF5 group per object define `group`,
+# and columns shared by all the rows of a file, stored once per file, are given by `grids`.
+SAMPLES = {
+    'desi': dict(script='desi/desi.py', config='edr_sv3', columns=_desi_columns, grids=_desi_grids),
+    'hsc': dict(script='hsc/hsc.py', config='pdr3_dud_22.5', columns=_hsc_columns),
+    'gaia': dict(script='gaia/gaia.py', config='gaia', id_key='source_id', columns=_gaia_columns),
+    'plasticc': dict(script='plasticc/plasticc.py', config='', filename='train_01.hdf5', columns=_plasticc_columns),
+    'manga': dict(script='manga/manga.py', config='out/manga', group=_manga_group),
+}
+
+def _cell_counts(cells: np.ndarray,
+                 rng: np.random.Generator,
+                 num_objects: Optional[int] = None,
+                 density: Optional[float] = None) -> np.ndarray:
+    """Number of objects in each healpix cell, for a total number of objects or a sky density."""
+    if (num_objects is None) == (density is None):
+        raise ValueError("Exactly one of num_objects and density should be given.")
+    if density is not None:
+        return rng.poisson(density * hp.nside2pixarea(_healpix_nside, degrees=True), size=len(cells))
+    return rng.multinomial(num_objects, np.ones(len(cells)) / len(cells))
+
+def _chunks(num_rows: int, row_bytes: int) -> Iterator[slice]:
+    chunk_size = max(1, _CHUNK_BYTES // max(row_bytes, 1))
+    for start in range(0, num_rows, chunk_size):
+        yield slice(start, min(start + chunk_size, num_rows))
+
+def _write_columns(filename: str, columns_fn, num_rows: int, ids: np.ndarray, id_key: str,
+                   cell: int, position_rng: np.random.Generator, rng: np.random.Generator,
+                   grids: Optional[Dict[str, np.ndarray]] = None):
+    """Write the rows of a healpix cell to a columnar HDF5 file, one chunk of rows at a time."""
+    # Schema of the rows, from a single generated row
+    row = columns_fn(1, np.random.default_rng(0))
+    row_bytes = sum(v.nbytes for v in row.values())
+    with h5py.File(filename, 'w') as hdf5_file:
+        for key, value in (grids or {}).items():
+            write_shared_column(hdf5_file, key, value)
+        for key, value in row.items():
+            hdf5_file.create_dataset(key, shape=(num_rows, *value.shape[1:]), dtype=value.dtype)
+        for key, dtype in [(id_key, np.int64), ('ra', np.float64), ('dec', np.float64), ('healpix', np.int64)]:
+            if key not in hdf5_file:
+                hdf5_file.create_dataset(key, shape=(num_rows,), dtype=dtype)
+
+        for chunk in _chunks(num_rows, row_bytes):
+            n = chunk.stop - chunk.start
+            columns = columns_fn(n, rng)
+            columns['ra'], columns['dec'] = sky_positions(np.full(n, cell), position_rng)
+            columns['healpix'] = np.full(n, cell)
+            columns[id_key] = ids[chunk]
+            for key, value in columns.items():
+                hdf5_file[key][chunk] = value
+    write_object_index(filename, id_key=id_key)
+
+def _write_groups(filename: str, group_fn, num_rows: int, ids: np.ndarray,
+                  cell: int, position_rng: np.random.Generator, rng: np.random.Generator):
+    """Write the objects of a healpix cell to an HDF5 file with one group per object."""
+    ra, dec = sky_positions(np.full(num_rows, cell), position_rng)
+    with h5py.File(filename, 'w') as hdf5_file:
+        for n in range(num_rows):
+            object_id = str(ids[n])
+            group = hdf5_file.create_group(object_id, track_order=True)
+            values = {'object_id': object_id, 'ra': ra[n], 'dec': dec[n], 'healpix': cell, **group_fn(rng)}
+            for key, value in values.items():
+                group.create_dataset(key, data=value)
+
+def generate_parent_sample(name: str,
+                           output_dir: str,
+                           num_objects: Optional[int] = 1000,
+                           density: Optional[float] = None,
+                           num_healpix: int = 4,
+                           healpix: Optional[List[int]] = None,
+                           seed: int = 0,
+                           sky_seed: int = 0,
+                           scripts_dir: str = _SCRIPTS_DIR,
+                           **options) -> List[str]:
+    """Write a synthetic parent sample with the layout and columns expected by its dataset builder.
+
+    The sample is written as `<output_dir>/<name>/<config>/healpix=<index>/001-of-001.hdf5`
+    files (or the file name expected by the builder), with their object id index, and the
+    builder script is copied to `<output_dir>/<name>` so that the sample can be loaded like
+    a local AstroPile dataset. Rows are generated and written in chunks, so that memory
+    does not grow with the size of the sample.
+
+    Positions in a cell only depend on `sky_seed`, so that the first objects of each cell
+    coincide across samples generated with the same `sky_seed` and cells, e.g. to profile
+    cross-matching with a controlled number of matches.
+
+    Args:
+        name (str): Name of the parent sample, one of `SAMPLES`.
+        output_dir (str): Root directory of the synthetic AstroPile datasets.
+        num_objects (int, optional): Total number of objects of the sample. Defaults to 1000.
+        density (float, optional): Sky density of objects per square degree, used instead of `num_objects`. Defaults to None.
+        num_healpix (int, optional): Number of random healpix cells over which objects are spread. Defaults to 4.
+        healpix (List[int], optional): Nested healpix indices of the cells, used instead of `num_healpix`. Defaults to None.
+        seed (int, optional): Seed of the random number generator of the data. Defaults to 0.
+        sky_seed (int, optional): Seed of the random number generator of the cells and positions. Defaults to 0.
+        scripts_dir (str, optional): Directory of the dataset builder scripts. Defaults to the scripts of the repository.
+        **options: Sample-specific sizes, e.g. `sequence_length` for PLAsTiCC or `num_spaxels` for MaNGA.
+
+    Returns:
+        List[str]: Paths of the written HDF5 files.
+    """
+    if name not in SAMPLES:
+        raise ValueError(f"Unknown parent sample {name}, expected one of {list(SAMPLES)}.")
+    sample = SAMPLES[name]
+    script = os.path.join(scripts_dir, sample['script'])
+    module = _load_builder_module(script)
+    rng = np.random.default_rng(seed)
+    if density is not None:
+        num_objects = None
+
+    dataset_dir = os.path.join(output_dir, name)
+    os.makedirs(dataset_dir, exist_ok=True)
+    shutil.copy(script, dataset_dir)
+
+    if healpix is None:
+        sky_rng = np.random.default_rng(sky_seed)
+        healpix = sky_rng.choice(hp.nside2npix(_healpix_nside), size=num_healpix, replace=False)
+    cells = np.sort(np.asarray(healpix, dtype=np.int64))
+    counts = _cell_counts(cells, rng, num_objects=num_objects, density=density)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    filenames = []
+    for cell, count, offset in zip(cells, counts, offsets):
+        if count == 0:
+            continue
+        filename = os.path.join(dataset_dir, sample['config'], f"healpix={cell}",
+                                sample.get('filename', '001-of-001.hdf5'))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        ids = np.arange(offset, offset + count, dtype=np.int64)
+        position_rng = np.random.default_rng([sky_seed, int(cell)])
+        if 'group' in sample:
+            _write_groups(filename, lambda rng: sample['group'](module, rng, **options),
+                          count, ids, cell, position_rng, rng)
+        else:
+            _write_columns(filename, lambda n, rng: sample['columns'](module, n, rng, **options),
+                           count, ids, sample.get('id_key', 'object_id'), cell, position_rng, rng,
+                           grids=sample['grids'](module) if 'grids' in sample else None)
+        filenames.append(filename)
+    return filenames
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('samples', nargs='+', choices=list(SAMPLES))
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--num_objects', type=int, default=1000)
+    parser.add_argument('--density', type=float, default=None, help='Objects per square degree, instead of num_objects')
+    parser.add_argument('--num_healpix', type=int, default=4)
+    parser.add_argument('--healpix', type=int, nargs='+', default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sky_seed', type=int, default=0)
+    args = parser.parse_args(args)
+
+    for i, name in enumerate(args.samples):
+        filenames = generate_parent_sample(name, args.output_dir,
+                                           num_objects=args.num_objects,
+                                           density=args.density,
+                                           num_healpix=args.num_healpix,
+                                           healpix=args.healpix,
+                                           seed=args.seed + i,
+                                           sky_seed=args.sky_seed)
+        print(f"Wrote {len(filenames)} files of {name} in {os.path.join(args.output_dir, name)}")
+
+if __name__ == "__main__":
+    main()
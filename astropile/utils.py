@@ -1,31 +1,93 @@
 import os
-from datasets import DatasetBuilder, Dataset
+import re
+import glob
+import hashlib
+import json
+import time
+from collections import defaultdict
+import datasets
+from datasets import DatasetBuilder, Dataset, IterableDataset, concatenate_datasets
+from datasets.arrow_writer import ArrowWriter
 from astropy.table import Table, hstack, vstack
 from astropy.coordinates import SkyCoord
 from astropy import units as u
-from typing import List
+from typing import List, Dict
 from functools import partial
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from multiprocess import Pool as ProcessPool
 import numpy as np
 import h5py
 import pandas as pd
 from astropy import units
 
-def _file_to_catalog(filename: str, keys: List[str]):
+from astropile.crossmatch import cross_match_catalogs, friends_of_friends, group_by_healpix
+from astropile.hdf5_utils import contains_ids, save_array
+
+# Matches a `healpix=<index>` directory in a data file path
+_HEALPIX_DIR = re.compile(r'(?:^|[/\\])healpix=(\d+)(?=[/\\])')
+
+def _read_catalog(filename: str, keys: List[str]) -> np.ndarray:
+    """Reads the requested columns of an HDF5 file into a structured array."""
     with h5py.File(filename, 'r') as data:
-        return Table({k: data[k] for k in keys})
+        columns = [data[k][:] for k in keys]
+    # Variable length strings are stored as fixed length bytes, and the h5py
+    # dtype metadata is dropped so that the array can be saved
+    columns = [c.astype(np.bytes_) if c.dtype.kind == 'O' else c for c in columns]
+    dtype = np.dtype([(k, np.dtype(c.dtype.str).newbyteorder('='), c.shape[1:])
+                      for k, c in zip(keys, columns)])
+    catalog = np.empty(len(columns[0]), dtype=dtype)
+    for k, c in zip(keys, columns):
+        catalog[k] = c
+    return catalog
+
+def _catalog_cache_filename(cache_dir: str, filename: str, keys: List[str]) -> str:
+    """Return the cache file of the catalog of a data file, keyed by its mtime, size and the requested keys."""
+    stat = os.stat(filename)
+    file_hash = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+    keys_hash = hashlib.sha1(','.join(keys).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, file_hash, f"{keys_hash}-{stat.st_mtime_ns}-{stat.st_size}.npy")
+
+def _file_to_catalog(filename: str, keys: List[str], cache_dir: str = None) -> np.ndarray:
+    if cache_dir is None:
+        return _read_catalog(filename, keys)
+
+    cache_filename = _catalog_cache_filename(cache_dir, filename, keys)
+    if os.path.exists(cache_filename):
+        return np.load(cache_filename, mmap_mode='r')
+
+    catalog = _read_catalog(filename, keys)
+    try:
+        # Entries of previous versions of the data file are outdated
+        keys_hash = os.path.basename(cache_filename).split('-')[0]
+        for outdated in glob.glob(os.path.join(os.path.dirname(cache_filename), f"{keys_hash}-*.npy")):
+            os.remove(outdated)
+        os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+        save_array(cache_filename, catalog)
+    except OSError:
+        # Read-only cache, the catalog is only kept in memory
+        pass
+    return catalog
 
 def get_catalog(dset: DatasetBuilder,
                 keys: List[str] = ['object_id', 'ra', 'dec', 'healpix'],
                 split: str = 'train',
-                num_proc: int = 1):
+                num_proc: int = None,
+                cache_dir: str = None,
+                use_cache: bool = True):
     """Return the catalog of a given astropile parent sample.
+
+    Only the requested columns are read, and the catalog of each data file is cached
+    in a compact columnar `.npy` file keyed by the file mtime and size and by the
+    requested keys. Repeated calls only read the data files that changed since the
+    last call, and files are read concurrently by a pool of threads.
     
     Args:
         dset (GeneratorBasedBuilder): An AstroPile dataset builder.
         keys (List[str], optional): List of column names to include in the catalog. Defaults to ['object_id', 'ra', 'dec', 'healpix'].
         split (str, optional): The split of the dataset to retrieve the catalog from. Defaults to 'train'.
-        num_proc (int, optional): Number of processes to use for parallel processing. Defaults to 1.
+        num_proc (int, optional): Number of threads used to read the data files. Defaults to None (chosen by `concurrent.futures.ThreadPoolExecutor`).
+        cache_dir (str, optional): Directory of the catalog cache. Defaults to `astropile_catalogs` in the datasets cache.
+        use_cache (bool, optional): Whether to use the catalog cache. Defaults to True.
 
     Returns:
         astropy.table.Table: The catalog of the parent sample.
@@ -35,14 +97,102 @@ def get_catalog(dset: DatasetBuilder,
     """
     if not dset.config.data_files:
         raise ValueError(f"At least one data file must be specified, but got data_files={dset.config.data_files}")
-    catalogs = []
-    if num_proc > 1:
-        with Pool(num_proc) as pool:
-            catalogs = pool.map(partial(_file_to_catalog, keys=keys), dset.config.data_files[split])
+    if not use_cache:
+        cache_dir = None
+    elif cache_dir is None:
+        cache_dir = os.path.join(datasets.config.HF_DATASETS_CACHE, 'astropile_catalogs')
+    keys = list(keys)
+    files = dset.config.data_files[split]
+    if num_proc is not None and num_proc <= 1:
+        catalogs = [_file_to_catalog(filename, keys, cache_dir) for filename in files]
     else:
-        for filename in dset.config.data_files[split]:
-            catalogs.append(_file_to_catalog(filename, keys=keys))
-    return vstack(catalogs)
+        with ThreadPoolExecutor(max_workers=num_proc) as executor:
+            catalogs = list(executor.map(partial(_file_to_catalog, keys=keys, cache_dir=cache_dir), files))
+    return Table(np.concatenate(catalogs))
+
+def get_healpix_files(dset: DatasetBuilder, split: str = 'train') -> Dict[int, List[str]]:
+    """Return the data files of a given astropile parent sample, indexed by healpix cell.
+
+    The healpix index of each file is parsed from its `healpix=<index>/` directory.
+    Several files can belong to the same cell, for instance when a dataset config
+    combines several surveys stored side by side.
+
+    Args:
+        dset (GeneratorBasedBuilder): An AstroPile dataset builder.
+        split (str, optional): The split of the dataset to retrieve the files from. Defaults to 'train'.
+
+    Returns:
+        Dict[int, List[str]]: Mapping from healpix index to the list of files of that cell.
+
+    Raises:
+        ValueError: If no data files are specified in the dataset builder, or if a file is not in a healpix directory.
+    """
+    if not dset.config.data_files:
+        raise ValueError(f"At least one data file must be specified, but got data_files={dset.config.data_files}")
+    healpix_files = defaultdict(list)
+    for filename in dset.config.data_files[split]:
+        match = _HEALPIX_DIR.search(filename)
+        if match is None:
+            raise ValueError(f"Could not find the healpix index of data file {filename}")
+        healpix_files[int(match.group(1))].append(filename)
+    return dict(healpix_files)
+
+def _locate_objects(files: List[str], object_ids) -> np.ndarray:
+    """Return for each object id the position of the file containing it in a list of files."""
+    if len(files) == 1:
+        return np.zeros(len(object_ids), dtype=int)
+    file_idx = -np.ones(len(object_ids), dtype=int)
+    for i, filename in enumerate(files):
+        with h5py.File(filename, 'r') as data:
+            file_idx[(file_idx < 0) & contains_ids(data, object_ids)] = i
+    if np.any(file_idx < 0):
+        raise KeyError(f"Object ids {np.asarray(object_ids)[file_idx < 0][:10]} not found in {files}")
+    return file_idx
+
+def _cross_matched_examples(left: DatasetBuilder, right: DatasetBuilder):
+    """Return a generator function of merged examples for groups of a cross-matched catalog."""
+    # Retrieve the files of both datasets, indexed by healpix cell
+    healpix_files_left = get_healpix_files(left)
+    healpix_files_right = get_healpix_files(right)
+    # Create a generator function that merges the two generators
+    def _generate_examples(groups):
+        for group in groups:
+            files_left = healpix_files_left[group['healpix'][0]]
+            files_right = healpix_files_right[group[right.config.name+'_healpix'][0]]
+            # When a cell is stored in several files, split the group by file on both sides
+            group['_left_file'] = _locate_objects(files_left, group[left.config.name+'_object_id'])
+            group['_right_file'] = _locate_objects(files_right, group[right.config.name+'_object_id'])
+            for subgroup in group.group_by(['_left_file', '_right_file']).groups:
+                generators = [
+                            # Build generators that only reads the files corresponding to the current healpix index
+                            left._generate_examples(
+                                            files=[files_left[subgroup['_left_file'][0]]],
+                                            object_ids=[subgroup[left.config.name+'_object_id']]),
+                            right._generate_examples(
+                                            files=[files_right[subgroup['_right_file'][0]]],
+                                            object_ids=[subgroup[right.config.name+'_object_id']])
+                        ]
+                # Retrieve the generators for both datasets
+                for i, examples in enumerate(zip(*generators)):
+                    left_id, example_left = examples[0]
+                    right_id, example_right = examples[1]
+                    assert str(subgroup[i][left.config.name+'_object_id']) in left_id, "There was an error in the cross-matching generation."
+                    assert str(subgroup[i][right.config.name+'_object_id']) in right_id, "There was an error in the cross-matching generation."
+                    example_left.update(example_right)
+                    yield example_left
+    
+    return _generate_examples
+
+def _cross_matched_info(left: DatasetBuilder, right: DatasetBuilder):
+    """Return the features and description of the cross-matched dataset of two datasets."""
+    # Merging the features of both datasets
+    features = left.info.features.copy()
+    features.update(right.info.features)
+
+    # Generating a description for the new dataset based on the two parent datasets
+    description = (f"Cross-matched dataset between {left.info.builder_name}:{left.info.config_name} and {right.info.builder_name}:{left.info.config_name}.\nBelow are the original descriptions\n\n"
+                   f"{left.info.description}\n\n{right.info.description}")
+    return features, description
 
 def cross_match_datasets(left : DatasetBuilder, 
                          right : DatasetBuilder,
@@ -50,7 +200,9 @@ def cross_match_datasets(left : DatasetBuilder,
                          keep_in_memory : bool = False,
                          matching_radius : float = 1., 
                          return_catalog_only : bool = False,
-                         num_proc : int = None):
+                         num_proc : int = None,
+                         streaming : bool = False,
+                         matched_catalog : Table = None):
     """ Utility function to generate a new cross-matched dataset from two AstroPile 
     datasets.
 
@@ -61,6 +213,12 @@ def cross_match_datasets(left : DatasetBuilder,
         keep_in_memory (bool, optional): If True, the cross-matched dataset will be kept in memory. Defaults to False.
         matching_radius (float, optional): The maximum separation in arcseconds for a match to be considered. Defaults to 1.
         return_catalog_only (bool, optional): If True, only the cross-matched catalog will be returned. Defaults to False.
+        num_proc (int, optional): Number of processes used for cross-matching and generating the dataset. Defaults to None.
+        streaming (bool, optional): If True, return an IterableDataset reading the merged examples lazily from the
+            source files instead of writing the cross-matched dataset to the cache. Each (healpix, healpix) group of
+            the matched catalog is a shard, so that DataLoader workers read disjoint groups. Defaults to False.
+        matched_catalog (Table, optional): A cross-matched catalog, or a subset of its rows, as returned with
+            `return_catalog_only=True`. If given, the catalogs are not matched again. Defaults to None.
 
     Returns:
         tuple: A tuple containing the cross-matched catalog and the new dataset.
@@ -73,80 +231,31 @@ def cross_match_datasets(left : DatasetBuilder,
         right_dataset = ...
         matched_catalog, new_dataset = cross_match_datasets(left_dataset, right_dataset)
     """
-    # Access the catalogs for both datasets
-    cat_left = get_catalog(left)
-    cat_left['sc'] = SkyCoord(cat_left['ra'], 
-                              cat_left['dec'], unit='deg')
-    
-    cat_right = get_catalog(right)
-    cat_right['sc'] = SkyCoord(cat_right['ra'],
-                               cat_right['dec'], unit='deg')
-
-    # Cross match the catalogs and restricting them to matches
-    idx, sep2d, _ = cat_left['sc'].match_to_catalog_sky(cat_right['sc'])
-    mask = sep2d < matching_radius*u.arcsec
-    cat_left = cat_left[mask]
-    cat_right = cat_right[idx[mask]]
-    assert len(cat_left) == len(cat_right), "There was an error in the cross-matching."
-    print("Initial number of matches: ", len(cat_left))
-    matched_catalog = hstack([cat_left, cat_right], 
-                             table_names=[left.config.name, right.config.name],
-                             uniq_col_name='{table_name}_{col_name}')
-    # Remove objects that were matched between the two catalogs but fall under different healpix indices
-    mask = matched_catalog[f'{left.config.name}_healpix'] == matched_catalog[f'{right.config.name}_healpix']
-    matched_catalog = matched_catalog[mask]
-    print("Number of matches lost at healpix region borders: ", len(cat_left) - len(matched_catalog))
-    print("Final size of cross-matched catalog: ", len(matched_catalog))
-
-    # Adding default columns to respect format
-    matched_catalog['object_id'] = matched_catalog[left.config.name+'_object_id']
-    matched_catalog['ra'] = 0.5*(matched_catalog[left.config.name+'_ra'] +
-                                 matched_catalog[right.config.name+'_ra'])
-    matched_catalog['dec'] = 0.5*(matched_catalog[left.config.name+'_dec'] +
-                                 matched_catalog[right.config.name+'_dec'])
-    
-    # Check that all matches have the same healpix index
-    assert np.all(matched_catalog[left.config.name+'_healpix'] == matched_catalog[right.config.name+'_healpix']), "There was an error in the cross-matching."
-    matched_catalog['healpix'] = matched_catalog[left.config.name+'_healpix']
-    matched_catalog = matched_catalog.group_by(['healpix'])
+    if matched_catalog is None:
+        # Access the catalogs for both datasets
+        cat_left = get_catalog(left)
+        cat_right = get_catalog(right)
+
+        # Cross match the catalogs cell by cell, including matches across cell borders
+        matched_catalog = cross_match_catalogs(cat_left, cat_right,
+                                               names=[left.config.name, right.config.name],
+                                               matching_radius=matching_radius,
+                                               num_proc=num_proc)
 
     if return_catalog_only:
         return matched_catalog
 
-    # Retrieve the list of files of both datasets
-    files_left = left.config.data_files['train']
-    files_right = right.config.data_files['train']
-    catalog_groups = [group for group in matched_catalog.groups]
-    # Create a generator function that merges the two generators
-    def _generate_examples(groups):
-        for group in groups:
-            healpix = group['healpix'][0]
-            generators = [
-                        # Build generators that only reads the files corresponding to the current healpix index
-                        left._generate_examples(
-                                        files=[files_left[[i for i in range(len(files_left)) if f'healpix={healpix}'in files_left[i]][0]]],
-                                        object_ids=[group[left.config.name+'_object_id']]),
-                        right._generate_examples(
-                                        files=[files_right[[i for i in range(len(files_right)) if f'healpix={healpix}'in files_right[i]][0]]],
-                                        object_ids=[group[right.config.name+'_object_id']])
-                    ]
-            # Retrieve the generators for both datasets
-            for i, examples in enumerate(zip(*generators)):
-                left_id, example_left = examples[0]
-                right_id, example_right = examples[1]
-                assert str(group[i][left.config.name+'_object_id']) in left_id, "There was an error in the cross-matching generation."
-                assert str(group[i][right.config.name+'_object_id']) in right_id, "There was an error in the cross-matching generation."
-                example_left.update(example_right)
-                yield example_left
-    
-    # Merging the features of both datasets
-    features = left.info.features.copy()
-    features.update(right.info.features)
+    # Matches across healpix borders read the left and right objects from different cells
+    catalog_groups = [group for group in matched_catalog.group_by(['healpix', right.config.name+'_healpix']).groups]
+    _generate_examples = _cross_matched_examples(left, right)
+    features, description = _cross_matched_info(left, right)
+
+    if streaming:
+        # Examples are generated on the fly, groups being split across workers
+        return IterableDataset.from_generator(_generate_examples,
+                                              features,
+                                              gen_kwargs={'groups':catalog_groups})
 
-    # Generating a description for the new dataset based on the two parent datasets
-    description = (f"Cross-matched dataset between {left.info.builder_name}:{left.info.config_name} and {right.info.builder_name}:{left.info.config_name}.\nBelow are the original descriptions\n\n"
-                   f"{left.info.description}\n\n{right.info.description}")
-    
     # Create the new dataset
     return Dataset.from_generator(_generate_examples,
                                                    features,
@@ -157,6 +266,206 @@ def cross_match_datasets(left : DatasetBuilder,
                                                    description=description)
 
 
+# Files of a cross-match output directory: the matching parameters, written when the
+# directory is created, the matched catalog shared by all the tasks, and the manifest
+# of the shards, written once all of them are complete
+_PARAMS_FILENAME = 'cross_match.json'
+_CATALOG_FILENAME = 'matched_catalog.npy'
+_CATALOG_FAILED_FILENAME = 'matched_catalog.failed'
+_MANIFEST_FILENAME = 'manifest.json'
+
+def _shard_filename(output_dir: str, healpix: int) -> str:
+    return os.path.join(output_dir, f'healpix={healpix}.arrow')
+
+def _done_filename(output_dir: str, healpix: int) -> str:
+    return os.path.join(output_dir, f'healpix={healpix}.done')
+
+def _save_json(filename: str, value):
+    """Save a JSON file atomically."""
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp_filename, filename)
+
+def _completed_shards(output_dir: str, cells: List[int]) -> Dict[int, int]:
+    """Return the number of examples of the completed shards among the given cells."""
+    completed = {}
+    for healpix in cells:
+        # Each shard records its own completion, so that tasks never write to a shared file
+        done_filename = _done_filename(output_dir, healpix)
+        if os.path.exists(done_filename) and os.path.exists(_shard_filename(output_dir, healpix)):
+            with open(done_filename) as f:
+                completed[healpix] = json.load(f)['num_examples']
+    return completed
+
+def _write_shard(args):
+    """Writes the merged examples of one healpix cell of a matched catalog to an Arrow file."""
+    left, right, shard_catalog, healpix, output_dir = args
+    _generate_examples = _cross_matched_examples(left, right)
+    features, _ = _cross_matched_info(left, right)
+    groups = shard_catalog.group_by(['healpix', right.config.name+'_healpix']).groups
+
+    # Writing to a temporary file first so that a crash never leaves a partial shard
+    shard_filename = _shard_filename(output_dir, healpix)
+    tmp_filename = f"{shard_filename}.{os.getpid()}.tmp"
+    writer = ArrowWriter(features=features, path=tmp_filename)
+    try:
+        for example in _generate_examples(groups):
+            writer.write(features.encode_example(example))
+        num_examples, _ = writer.finalize()
+    finally:
+        writer.close()
+    os.replace(tmp_filename, shard_filename)
+    _save_json(_done_filename(output_dir, healpix), {'healpix': healpix, 'num_examples': num_examples})
+    return healpix, num_examples
+
+def _cross_match_params(left: DatasetBuilder, right: DatasetBuilder, matching_radius: float) -> dict:
+    return {'left': [left.name, left.config.name],
+            'right': [right.name, right.config.name],
+            'matching_radius': matching_radius}
+
+def materialize_cross_match(left: DatasetBuilder,
+                            right: DatasetBuilder,
+                            output_dir: str,
+                            matching_radius: float = 1.,
+                            num_proc: int = None,
+                            proc_id: int = None,
+                            num_tasks: int = None,
+                            poll_interval: float = 10.,
+                            timeout: float = 3600.):
+    """Write the cross-matched dataset of two AstroPile datasets as resumable per-healpix shards.
+
+    Each healpix cell of the matched catalog is written atomically to its own
+    `healpix=<index>.arrow` file, and marked as complete by a `healpix=<index>.done` file.
+    Rerunning the function skips the completed shards, and the cells can be distributed
+    over several tasks, e.g. SLURM tasks with `proc_id=SLURM_PROCID` and `num_tasks=SLURM_NTASKS`.
+    The matched catalog is computed once, by the first task, and cached in `output_dir`
+    so that all tasks agree on the cells. A `manifest.json` file listing all the cells is
+    written once all the shards are complete.
+
+    Args:
+        left (GeneratorBasedBuilder): The left dataset to be cross-matched.
+        right (GeneratorBasedBuilder): The right dataset to be cross-matched.
+        output_dir (str): The directory to write the shards and manifest to.
+        matching_radius (float, optional): The maximum separation in arcseconds for a match to be considered. Defaults to 1.
+        num_proc (int, optional): Number of processes used for cross-matching and writing the shards. Defaults to None.
+        proc_id (int, optional): Index of the current task, which only writes the cells assigned to it. Defaults to None (all cells).
+        num_tasks (int, optional): Total number of tasks the cells are distributed over. Defaults to None.
+        poll_interval (float, optional): Seconds between checks for the matched catalog, for tasks
+            waiting on the first one. Defaults to 10.
+        timeout (float, optional): Maximum number of seconds to wait for the first task to write
+            the matched catalog. Defaults to 3600.
+
+    Returns:
+        Dataset: The cross-matched dataset if all shards are complete, None otherwise.
+
+    Raises:
+        ValueError: If `proc_id` is given without `num_tasks`, or if `output_dir` contains
+            the cross-match of other datasets or with another matching radius.
+        RuntimeError: If the first task failed to compute the matched catalog.
+        TimeoutError: If the matched catalog is not written within `timeout` seconds.
+    """
+    if proc_id is not None and num_tasks is None:
+        raise ValueError("The total number of tasks must be given along with proc_id.")
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Shards written with other parameters must not be mixed with the new ones
+    params = _cross_match_params(left, right, matching_radius)
+    params_filename = os.path.join(output_dir, _PARAMS_FILENAME)
+    if not os.path.exists(params_filename):
+        _save_json(params_filename, params)
+    with open(params_filename) as f:
+        existing_params = json.load(f)
+    if existing_params != params:
+        raise ValueError(f"{output_dir} contains a cross-match with parameters {existing_params}, "
+                         f"which differ from {params}.")
+
+    # The matched catalog is computed by the first task only, and read by all the others
+    catalog_filename = os.path.join(output_dir, _CATALOG_FILENAME)
+    failed_filename = os.path.join(output_dir, _CATALOG_FAILED_FILENAME)
+    start_time = time.time()
+    if not os.path.exists(catalog_filename) and proc_id in (None, 0):
+        if os.path.exists(failed_filename):
+            os.remove(failed_filename)
+        try:
+            matched_catalog = cross_match_datasets(left, right,
+                                                   matching_radius=matching_radius,
+                                                   return_catalog_only=True,
+                                                   num_proc=num_proc)
+            save_array(catalog_filename, matched_catalog.as_array())
+        except Exception as e:
+            # Signals the failure to the tasks waiting for the catalog
+            _save_json(failed_filename, {'error': repr(e)})
+            raise
+    while not os.path.exists(catalog_filename):
+        # Failures of previous runs, older than this task, are ignored
+        if os.path.exists(failed_filename) and os.path.getmtime(failed_filename) >= start_time:
+            with open(failed_filename) as f:
+                error = json.load(f)['error']
+            raise RuntimeError(f"The first task failed to compute the matched catalog: {error}")
+        if time.time() - start_time > timeout:
+            raise TimeoutError(f"{catalog_filename} was not written within {timeout} seconds.")
+        print(f"Waiting for the first task to write {catalog_filename}")
+        time.sleep(poll_interval)
+    matched_catalog = Table(np.load(catalog_filename))
+    cells = sorted(set(matched_catalog['healpix'].tolist()))
+
+    # Select the cells of this task that are not already completed
+    completed = _completed_shards(output_dir, cells)
+    if proc_id is not None:
+        cells_to_process = cells[proc_id::num_tasks]
+    else:
+        cells_to_process = cells
+    cells_to_process = [healpix for healpix in cells_to_process if healpix not in completed]
+    print(f"Writing {len(cells_to_process)} shards, {len(completed)} out of {len(cells)} already completed")
+
+    healpix_rows = group_by_healpix(matched_catalog['healpix'])
+    tasks = ((left, right, matched_catalog[healpix_rows[healpix]], healpix, output_dir)
+             for healpix in cells_to_process)
+    if num_proc is not None and num_proc > 1:
+        with ProcessPool(num_proc) as pool:
+            for _ in pool.imap_unordered(_write_shard, tasks):
+                pass
+    else:
+        for task in tasks:
+            _write_shard(task)
+
+    completed = _completed_shards(output_dir, cells)
+    if any(healpix not in completed for healpix in cells):
+        print("Some shards are still missing, rerun to complete the cross-matched dataset")
+        return None
+    _save_json(os.path.join(output_dir, _MANIFEST_FILENAME),
+               {**params, 'shards': {str(healpix): completed[healpix] for healpix in cells}})
+    return load_cross_match(output_dir)
+
+def is_cross_match(path: str) -> bool:
+    """Return True if `path` is an output directory of `materialize_cross_match`."""
+    return os.path.exists(os.path.join(path, _PARAMS_FILENAME))
+
+def load_cross_match(output_dir: str) -> Dataset:
+    """Load the cross-matched dataset written by `materialize_cross_match`.
+
+    Args:
+        output_dir (str): The directory containing the shards and manifest.
+
+    Returns:
+        Dataset: The concatenation of all the shards.
+
+    Raises:
+        ValueError: If the shards are not all complete.
+    """
+    manifest_filename = os.path.join(output_dir, _MANIFEST_FILENAME)
+    if not os.path.exists(manifest_filename):
+        raise ValueError(f"The cross-match in {output_dir} is not complete, "
+                         "rerun materialize_cross_match to write the missing shards.")
+    with open(manifest_filename) as f:
+        cells = [int(healpix) for healpix in json.load(f)['shards']]
+    missing = [healpix for healpix in cells if not os.path.exists(_shard_filename(output_dir, healpix))]
+    if len(missing) > 0:
+        raise ValueError(f"Shards of the healpix cells {missing[:10]} are missing from {output_dir}.")
+    return concatenate_datasets([Dataset.from_file(_shard_filename(output_dir, healpix))
+                                 for healpix in sorted(cells)])
+
 def extract_cat_params(cat: DatasetBuilder):
     """This just grabs the ra, dec, and healpix columns from a catalogue."""
     cat = get_catalog(cat)
@@ -176,6 +485,11 @@ def build_master_catalog(cats: list[DatasetBuilder], names: list[str], matching_
     name1_idx, name2_idx, ..., nameN_idx are the indices of the sources in the
     corresponding catalogue.
 
+    Sources of all catalogues are matched in a single pass by friends-of-friends
+    grouping. The position and healpix index of a master source are taken from
+    the first catalogue it appears in, and if a group contains several sources
+    of the same catalogue, the first one is referenced.
+
     Parameters
     ----------
     cats : list[DatasetBuilder]
@@ -197,64 +511,31 @@ def build_master_catalog(cats: list[DatasetBuilder], names: list[str], matching_
     if len(cats) != len(names):
         raise ValueError("The number of catalogues and names must be the same.")
 
-    # Set the columns for the master catalogue
-    master_cat = pd.DataFrame(
-        columns=["ra", "dec", "healpix"] + names + [f"{name}_idx" for name in names]
-    )
-
-    for cat, name in zip(cats, names):
-        # Extract the relevant columns
-        cat = extract_cat_params(cat)
-
-        # Match the catalogues
-        master_coords = SkyCoord(master_cat.loc[:, "ra"], master_cat.loc[:, "dec"], unit="deg")
-        cat_coords = SkyCoord(cat.loc[:, "ra"], cat.loc[:, "dec"], unit="deg")
-        idx, sep2d, _ = master_coords.match_to_catalog_sky(cat_coords)
-        mask = sep2d < matching_radius * units.arcsec
-
-        # Update the matching columns
-        master_cat.loc[mask, name] = True
-        master_cat.loc[mask, name + "_idx"] = idx[mask]
-
-        # Add new rows to the master catalogue
-        if len(master_cat) == 0:
-            # keep everything for first catalogue
-            mask = np.zeros(len(cat), dtype=bool)
-        else:
-            # match to master catalogue so far
-            idx, sep2d, _ = cat_coords.match_to_catalog_sky(master_coords)
-            mask = sep2d < matching_radius * units.arcsec
-        idx = np.arange(len(cat), dtype=int)
-        name_data = []
-        name_idx_data = []
-        for subname in names:
-            if subname != name:
-                # Add rows for each catalogue. These are False becaue they didn't match
-                name_data.append(np.zeros(np.sum(~mask), dtype=bool))
-                name_idx_data.append(-np.ones(np.sum(~mask), dtype=int))
-            else:
-                # Add rows for the current catalogue. These are True because they are the current catalogue
-                name_data.append(np.ones(np.sum(~mask), dtype=bool))
-                name_idx_data.append(idx[~mask])
-        # Collect the new rows into a DataFrame
-        append_cat = pd.DataFrame(
-            columns=["ra", "dec", "healpix"] + names + [f"{name}_idx" for name in names],
-            data=np.stack(
-                [cat.loc[~mask, col] for col in ["ra", "dec", "healpix"]]
-                + name_data
-                + name_idx_data
-            ).T,
-        )
-
-        # Append the new rows to the master catalogue
-        master_cat = pd.concat([master_cat, append_cat], ignore_index=True)
-
-    # Convert the columns to the correct data types
-    master_cat["ra"] = master_cat["ra"].astype(float)
-    master_cat["dec"] = master_cat["dec"].astype(float)
-    master_cat["healpix"] = master_cat["healpix"].astype(int)
+    # Extract the relevant columns of all catalogues
+    cats = [extract_cat_params(cat) for cat in cats]
+    sizes = [len(cat) for cat in cats]
+    ra = np.concatenate([cat["ra"].to_numpy(dtype=float) for cat in cats])
+    dec = np.concatenate([cat["dec"].to_numpy(dtype=float) for cat in cats])
+    healpix = np.concatenate([cat["healpix"].to_numpy(dtype=int) for cat in cats])
+    catalog_id = np.repeat(np.arange(len(cats)), sizes)
+    row_idx = np.concatenate([np.arange(size, dtype=int) for size in sizes])
+
+    # Match all the catalogues at once
+    labels = friends_of_friends(ra, dec, matching_radius=matching_radius)
+    n_sources = labels.max() + 1 if len(labels) > 0 else 0
+
+    # Sources are concatenated in catalogue order, so the first member of each
+    # group comes from the first catalogue containing it
+    _, first = np.unique(labels, return_index=True)
+    master_cat = {"ra": ra[first], "dec": dec[first], "healpix": healpix[first]}
+    indices = {}
+    for i, name in enumerate(names):
+        mask = catalog_id == i
+        groups, first_in_cat = np.unique(labels[mask], return_index=True)
+        indices[name] = -np.ones(n_sources, dtype=int)
+        indices[name][groups] = row_idx[mask][first_in_cat]
+        master_cat[name] = indices[name] >= 0
     for name in names:
-        master_cat[name] = master_cat[name].astype(bool)
-        master_cat[f"{name}_idx"] = master_cat[f"{name}_idx"].astype(int)
+        master_cat[f"{name}_idx"] = indices[name]
 
-    return master_cat
+    return pd.DataFrame(master_cat)
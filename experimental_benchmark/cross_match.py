@@ -1,7 +1,7 @@
 import os
 import argparse
 import datasets
-from astropile.utils import cross_match_datasets
+from astropile.utils import materialize_cross_match
 
 
 def cross_match(
@@ -23,16 +23,21 @@ def cross_match(
 
     print(f'Cross-matching datasets with matching radius {matching_radius} arcseconds...')
 
-    # Cross-match datasets
-    dset = cross_match_datasets(
+    # Check if ran as part of a slurm job, if so, only the shards of the procid will be processed
+    slurm_procid = int(os.getenv('SLURM_PROCID')) if 'SLURM_PROCID' in os.environ else None
+    slurm_ntasks = int(os.getenv('SLURM_NTASKS', 1)) if slurm_procid is not None else None
+
+    # Cross-match datasets, completed shards are skipped when resuming
+    materialize_cross_match(
         left,
         right,
+        cache_dir,
         matching_radius=matching_radius,
         num_proc=num_proc,
+        proc_id=slurm_procid,
+        num_tasks=slurm_ntasks,
     )
 
-    dset.save_to_disk(cache_dir)
-
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Cross-match two datasets')
@@ -33,7 +33,8 @@ class PROVABGSModel(L.LightningModule):
         y_hat = self(x)
         loss = F.huber_loss(y_hat, y)
         self.log('val_loss', loss, on_epoch=True, prog_bar=True)
-        return loss
+        # Predictions are returned for R2ScoreCallback, to avoid a second forward pass
+        return {'loss': loss, 'y_hat': y_hat.detach(), 'y': y}
     
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.hparams.lr)
@@ -1,37 +1,53 @@
 import seaborn as sns
 import matplotlib.pyplot as plt
-from sklearn.metrics import r2_score
 import lightning as L
 import numpy as np
+import torch
 
 
 class R2ScoreCallback(L.Callback):
-    """Callback to calculate the R^2 score on the validation set."""
+    """Callback to calculate the R^2 score on the validation set.
+
+    Predictions are taken from the outputs of `validation_step` when it returns a dict 
+    with `y_hat` and `y`, and sums of targets and residuals are accumulated on device 
+    and summed across DDP ranks at the end of the epoch.
+    """
     def __init__(
         self,
         properties: list = ['Z_HP', 'Z_MW', 'TAGE_MW', 'AVG_SFR', 'LOG_MSTAR'] # should be same as in dataset
     ):
         super().__init__()
         self.properties = properties
-        self.predictions = []
-        self.targets = []
+        self.sums = None
+
+    def on_validation_epoch_start(self, trainer, pl_module):
+        self.sums = None
 
     def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
-        img, z = batch
-        targets = z
-        preds = pl_module(img)
-        self.predictions.extend(preds.cpu().numpy())
-        self.targets.extend(targets.cpu().numpy())
+        if isinstance(outputs, dict) and 'y_hat' in outputs:
+            preds, targets = outputs['y_hat'], outputs['y']
+        else:
+            img, targets = batch
+            preds = pl_module(img)
+        preds = preds.detach().double()
+        targets = targets.detach().double()
+        if self.sums is None:
+            # Count, sum of targets, sum of squared targets and sum of squared residuals per property
+            self.sums = torch.zeros(4, targets.shape[1], dtype=torch.float64, device=targets.device)
+        self.sums += torch.stack([torch.ones_like(targets).sum(dim=0),
+                                  targets.sum(dim=0),
+                                  (targets**2).sum(dim=0),
+                                  ((targets - preds)**2).sum(dim=0)])
 
     def on_validation_epoch_end(self, trainer, pl_module):
-        predictions = np.array(self.predictions)
-        targets = np.array(self.targets)
+        if self.sums is None:
+            return
+        n, sum_y, sum_y2, ss_res = trainer.strategy.reduce(self.sums, reduce_op='sum')
+        r2 = 1 - ss_res / (sum_y2 - sum_y**2 / n)
 
         # Log the R^2 score for each property
-        for i in range(predictions.shape[1]):
-            r2 = r2_score(targets[:, i], predictions[:, i])
-            pl_module.log(f'{self.properties[i]} R^2', r2, on_epoch=True, prog_bar=True, logger=True)
+        for i in range(r2.shape[0]):
+            pl_module.log(f'{self.properties[i]} R^2', r2[i].float(), on_epoch=True, prog_bar=True, logger=True)
 
-        # Clear the lists for the next epoch
-        self.predictions = []
-        self.targets = []
\ No newline at end of file
+        # Reset the sums for the next epoch
+        self.sums = None
\ No newline at end of file
@@ -17,6 +17,7 @@ from datasets.data_files import DataFilesPatternsDict
 import itertools
 import h5py
 import numpy as np
+from astropile.hdf5_utils import find_rows, iter_rows
 
 # Find for instance the citation on arxiv or on the dataset repo/website
 _CITATION = """\
@@ -164,6 +165,9 @@ class APOGEE(datasets.GeneratorBasedBuilder):
 
     DEFAULT_CONFIG_NAME = "apogee"
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 128
+
     @classmethod
     def _info(self):
         """Defines the features available in this dataset."""
@@ -230,40 +234,39 @@ class APOGEE(datasets.GeneratorBasedBuilder):
         for j, file in enumerate(files):
             with h5py.File(file, "r") as data:
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j])
                 else:
-                    keys = data["object_id"][:]
-
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"][:])
-                sorted_ids = data["object_id"][:][sort_index]
+                    rows = range(len(data["object_id"]))
 
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                # Columns to read in batches for all requested rows
+                keys = (["spectrum_flux", "spectrum_ivar", "spectrum_lsf_sigma", "spectrum_lambda", "spectrum_bitmask",
+                        "pseudo_continuum_spectrum_flux", "pseudo_continuum_spectrum_ivar", "object_id"]
+                        + _FLOAT_FEATURES + _FLUX_FEATURES)
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
 
                     # Parse spectrum data
                     example = {
                         "spectrum": {
-                            "flux": data["spectrum_flux"][i],
-                            "ivar": data["spectrum_ivar"][i],
-                            "lsf_sigma": data["spectrum_lsf_sigma"][i], 
-                            "lambda": data["spectrum_lambda"][i],
-                            "pix_bitmask": data["spectrum_bitmask"][i],
-                            "pseudo_continuum_flux": data["pseudo_continuum_spectrum_flux"][i],
-                            "pseudo_continuum_ivar": data["pseudo_continuum_spectrum_ivar"][i],
+                            "flux": row["spectrum_flux"],
+                            "ivar": row["spectrum_ivar"],
+                            "lsf_sigma": row["spectrum_lsf_sigma"], 
+                            "lambda": row["spectrum_lambda"],
+                            "pix_bitmask": row["spectrum_bitmask"],
+                            "pseudo_continuum_flux": row["pseudo_continuum_spectrum_flux"],
+                            "pseudo_continuum_ivar": row["pseudo_continuum_spectrum_ivar"],
                         }
                     }
                     # Add all other requested features
                     for f in _FLOAT_FEATURES:
-                        example[f] = data[f][i].astype("float32")
+                        example[f] = row[f].astype("float32")
 
                     # Add all other requested features
                     for f in _FLUX_FEATURES:
                         for n, b in enumerate(self._flux_filters):
-                            example[f"{f}_{b}"] = data[f"{f}"][i][n].astype("float32")
+                            example[f"{f}_{b}"] = row[f"{f}"][n].astype("float32")
 
                     # Add object_id
-                    example["object_id"] = str(data["object_id"][i])
+                    example["object_id"] = str(row["object_id"])
 
-                    yield str(data["object_id"][i]), example
+                    yield str(row["object_id"]), example
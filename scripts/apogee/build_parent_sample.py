@@ -8,6 +8,7 @@ from tqdm import tqdm
 import healpy as hp
 import h5py
 import urllib
+from astropile.hdf5_utils import write_object_index
 
 _healpix_nside = 16
 
@@ -232,6 +233,9 @@ def save_in_standard_format(args):
     with h5py.File(output_filename, "w") as hdf5_file:
         for key in catalog.colnames:
             hdf5_file.create_dataset(key.lower(), data=catalog[key])
+
+    # Save the sorted object id index alongside the data
+    write_object_index(output_filename)
     return 1
 
 
@@ -17,6 +17,7 @@ from datasets.data_files import DataFilesPatternsDict
 import itertools
 import h5py
 import numpy as np
+from astropile.hdf5_utils import find_rows, iter_rows
 
 _CITATION = """\
 @misc{rehemtulla2024zwicky,
@@ -164,6 +165,9 @@ class BTSbot(datasets.GeneratorBasedBuilder):
     _image_size = 63
     _views = ['science', 'reference', 'difference']
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 128
+
     @classmethod
     def _info(self):
         """ Defines the features available in this dataset.
@@ -222,37 +226,34 @@ class BTSbot(datasets.GeneratorBasedBuilder):
         for j, file in enumerate(files):
             with h5py.File(file, "r") as data:
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j])
                 else:
-                    keys = data["object_id"]
-                
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"])
-                sorted_ids = data["object_id"][:][sort_index]
+                    rows = range(len(data["object_id"]))
 
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog 
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                # Columns to read in batches for all requested rows
+                keys = ["image_triplet"] + _FLOAT_FEATURES + _INT_FEATURES + _BOOL_FEATURES + _STRING_FEATURES
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
                     # Parse image data
                     example = {
                         'image': [
                             {
                                 'band': data['band'],
                                 'view': view,
-                                'array': data['image_triplet'][i, :, :, j],
+                                'array': row['image_triplet'][:, :, j],
                                 'scale': data['image_scale'],
                             }
                             for j, view in enumerate(self._views)
                         ]
                     }
                     for f in _FLOAT_FEATURES:
-                        example[f] = data[f][i].astype('float32')
+                        example[f] = row[f].astype('float32')
                     for f in _INT_FEATURES:
                         # NOTE: includes object_id
-                        example[f] = data[f][i].astype('int64')
+                        example[f] = row[f].astype('int64')
                     for f in _BOOL_FEATURES:
-                        example[f] = data[f][i].astype('bool')
+                        example[f] = row[f].astype('bool')
                     for f in _STRING_FEATURES:
-                        example[f] = data[f][i].astype('str')
+                        example[f] = row[f].astype('str')
 
-                    yield str(data['object_id'][i]), example
\ No newline at end of file
+                    yield str(row['object_id']), example
\ No newline at end of file
@@ -21,6 +21,7 @@ from datasets.data_files import DataFilesPatternsDict
 import itertools
 import h5py
 import numpy as np
+from astropile.hdf5_utils import find_rows, iter_rows
 
 _CITATION = """\
 @ARTICLE{2010ApJS..189...37E,
@@ -83,6 +84,9 @@ class CHANDRA(datasets.GeneratorBasedBuilder):
 
     DEFAULT_CONFIG_NAME = "spectra"
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 128
+
     #_spectrum_length = 7781
 
     @classmethod
@@ -123,36 +127,33 @@ class CHANDRA(datasets.GeneratorBasedBuilder):
         for j, file in enumerate(files):
             with h5py.File(file, "r") as data:
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j])
                 else:
-                    keys = data["object_id"]
-                
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"])
-                sorted_ids = data["object_id"][:][sort_index]
-
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog 
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                    rows = range(len(data["object_id"]))
+
+                # Columns to read in batches for all requested rows
+                keys = (["spectrum_ene", "spectrum_ene_hi", "spectrum_ene_lo", "spectrum_flux", "spectrum_flux_err", "object_id"]
+                        + _FLOAT_FEATURES)
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
                     
                     # Parse spectrum data
                     example = {
                         "spectrum": 
                             {
-                                "ene_center_bin": data['spectrum_ene'][i], 
-                                "ene_high_bin": data['spectrum_ene_hi'][i],
-                                "ene_low_bin": data['spectrum_ene_lo'][i],
-                                "flux": data['spectrum_flux'][i],
-                                "flux_error": data['spectrum_flux_err'][i],
+                                "ene_center_bin": row['spectrum_ene'], 
+                                "ene_high_bin": row['spectrum_ene_hi'],
+                                "ene_low_bin": row['spectrum_ene_lo'],
+                                "flux": row['spectrum_flux'],
+                                "flux_error": row['spectrum_flux_err'],
                             }
                     }
                     # Add all other requested features
                     for f in _FLOAT_FEATURES:
-                        example[f] = data[f][i].astype("float32")
-
-                    assert data['object_id'][i] == k
+                        example[f] = row[f].astype("float32")
 
                     # Add object_id
+                    k = row['object_id']
                     example["object_id"] = k
 
                     yield k, example
@@ -1,19 +1,23 @@
 import os
 import argparse
 import numpy as np
-from astropy.table import Table, join
-from scipy.optimize import curve_fit
+from astropy.table import Table
 import desispec.io
 from desispec import coaddition
 import h5py
 import healpy as hp
-from tqdm.contrib.concurrent import process_map
+from multiprocessing import Pool
+from tqdm import tqdm
+from astropile.hdf5_utils import write_object_index, write_shared_column
 
 # Set the log level to warning to avoid too much output
 os.environ["DESI_LOGLEVEL"] = "WARNING"
 
 _healpix_nside = 16
 
+# Columns shared by all the spectra of a file, stored once per file instead of once per row
+_SHARED_KEYS = ["spectrum_lambda"]
+
 
 def selection_fn(catalog):
     """Returns a mask for the catalog based on the selection function"""
@@ -32,6 +36,35 @@ def find_matching_indices(arr1, arr2):
     return matching_indices
 
 
+def lsf_sigma_from_resolution(resolution_data):
+    """Returns the width of the line spread function of each spectrum at each wavelength,
+    in pixel units, from the second moment of the diagonals of its resolution matrix.
+
+    The resolution data of shape (N, ndiag, nwave) stores, for each wavelength pixel, the
+    response of the ndiag nearest pixels, at offsets ndiag // 2 down to -(ndiag // 2).
+    Negative responses are ignored, and pixels without any response get a width of 0.
+    """
+    ndiag = resolution_data.shape[-2]
+    offsets = (ndiag // 2 - np.arange(ndiag)).astype(np.float32)
+    weights = np.clip(resolution_data, 0, None)
+
+    norm = weights.sum(axis=-2)
+    valid = norm > 0
+    mean = np.divide(
+        np.einsum("...kj,k->...j", weights, offsets),
+        norm,
+        out=np.zeros_like(norm),
+        where=valid,
+    )
+    second_moment = np.divide(
+        np.einsum("...kj,k->...j", weights, offsets**2),
+        norm,
+        out=np.zeros_like(norm),
+        where=valid,
+    )
+    return np.sqrt(np.clip(second_moment - mean**2, 0, None)).astype(np.float32)
+
+
 def processing_fn(args):
     """Parallel processing function reading a spectrum file and returning the spectra
     of all requested targets in that file.
@@ -56,14 +89,8 @@ def processing_fn(args):
 
     tgt_ids = np.array(combined_spectra.target_ids())[reordering_idx]
 
-    # Get an averaged estimated Gaussian line spread function
-    # TODO: Actually properly estimate the line spread function of each spectrum
-    lsf = res.mean(axis=-1).mean(axis=0)
-
-    def _gauss(x, a, x0, sigma):
-        return a * np.exp(-((x - x0) ** 2) / (2 * sigma**2))
-
-    popt, pcov = curve_fit(_gauss, np.arange(len(lsf)), lsf, p0=[1, 5, 1])
+    # Width of the line spread function of each spectrum at each wavelength
+    lsf_sigma = lsf_sigma_from_resolution(res)
 
     assert np.all(tgt_ids == target_ids), (
         "There was an error in reading the requested spectra from the file",
@@ -76,74 +103,143 @@ def processing_fn(args):
     # Return the results
     return {
         "TARGETID": tgt_ids,
-        "spectrum_lambda": np.repeat(
-            wavelength.reshape([1, -1]), len(tgt_ids), axis=0
-        ).astype(np.float32),
+        "spectrum_lambda": wavelength,  # Shared by all the spectra of the file
         "spectrum_flux": flux,
         "spectrum_ivar": ivar,
         "spectrum_mask": (mask > 0) | (ivar < 1e-6),
-        "spectrum_lsf_sigma": popt[2]
-        * np.ones(
-            shape=[len(tgt_ids), len(wavelength)], dtype=np.float32
-        ),  # The sigma of the estimated Gaussian line spread function, in pixel units
+        "spectrum_lsf_sigma": lsf_sigma,  # In pixel units
         "spectrum_lsf": res,
     }
 
 
-def save_in_standard_format(args):
-    """This function takes care of iterating through the different input files
-    corresponding to this healpix index, and exporting the data in standard format.
+def read_work_item(args):
+    """Reads the spectra of one coadd file, and returns them along with the healpix
+    index and the offset at which they are written in its output file.
+    """
+    healpix_idx, offset, filename, target_ids = args
+    return healpix_idx, offset, processing_fn((filename, target_ids))
+
+
+class HealpixWriter:
+    """Writes the spectra of all the coadd files of a healpix index into a single HDF5 file,
+    as they are read, so that no more than one coadd file worth of spectra is kept in memory.
     """
-    catalog, output_filename, desi_data_path = args
-    # Create the output directory if it does not exist
-    if not os.path.exists(os.path.dirname(output_filename)):
-        os.makedirs(os.path.dirname(output_filename))
 
+    def __init__(self, catalog, output_filename, num_files):
+        self.catalog = catalog
+        self.output_filename = output_filename
+        self.num_remaining = num_files
+        # Written to a temporary file, so that incomplete files are never mistaken for outputs
+        self.tmp_filename = f"{output_filename}.{os.getpid()}.tmp"
+
+    def _create(self, spectra):
+        """Creates the datasets of the output file, once the shape of the spectra is known"""
+        if not os.path.exists(os.path.dirname(self.output_filename)):
+            os.makedirs(os.path.dirname(self.output_filename), exist_ok=True)
+        with h5py.File(self.tmp_filename, "w") as hdf5_file:
+            for key in self.catalog.colnames:
+                hdf5_file.create_dataset(key, data=self.catalog[key])
+            for key, value in spectra.items():
+                if key == "TARGETID":
+                    continue
+                if key in _SHARED_KEYS:
+                    write_shared_column(hdf5_file, key, value)
+                    continue
+                hdf5_file.create_dataset(
+                    key, shape=(len(self.catalog), *value.shape[1:]), dtype=value.dtype
+                )
+
+    def write(self, offset, spectra):
+        """Writes the spectra of one coadd file, starting at row `offset`. Returns True
+        once the spectra of all the coadd files of the healpix index have been written.
+        """
+        if not os.path.exists(self.tmp_filename):
+            self._create(spectra)
+
+        # Making sure the spectra land on the rows of their targets
+        assert np.all(
+            spectra["TARGETID"]
+            == self.catalog["TARGETID"][offset : offset + len(spectra["TARGETID"])]
+        ), "There was an error in matching the spectra to the catalog"
+
+        with h5py.File(self.tmp_filename, "a") as hdf5_file:
+            for key, value in spectra.items():
+                if key == "TARGETID":
+                    continue
+                if key in _SHARED_KEYS:
+                    assert np.array_equal(hdf5_file[key][:], value), (
+                        f"{key} differs between the coadd files of {self.output_filename}"
+                    )
+                    continue
+                hdf5_file[key][offset : offset + len(value)] = value
+
+        self.num_remaining -= 1
+        if self.num_remaining > 0:
+            return False
+
+        os.replace(self.tmp_filename, self.output_filename)
+        # Save the sorted object id index alongside the data
+        write_object_index(self.output_filename)
+        return True
+
+
+def save_in_standard_format(catalog, output_dir, desi_data_path, num_processes=1):
+    """This function takes care of reading all the input coadd files, and exporting
+    the data in standard format, with one file per healpix index.
+
+    All (healpix index, coadd file) pairs are read by a single pool of processes,
+    starting with the largest files so that the run is not bound by a few dense
+    healpix indices, and the spectra are streamed to the writer of their healpix index.
+    """
     # Rename columns to match the standard format
     catalog["ra"] = catalog["TARGET_RA"]
     catalog["dec"] = catalog["TARGET_DEC"]
     catalog["object_id"] = catalog["TARGETID"]
 
-    # Extract the spectra by looping over all files
-    catalog = catalog.group_by(["SURVEY", "PROGRAM", "HEALPIX"])
-
-    # Preparing the arguments for the parallel processing
-    map_args = []
-    for group in catalog.groups:
-        survey = group["SURVEY"][0]
-        program = group["PROGRAM"][0]
-        healpix = group["HEALPIX"][0]
-        target_ids = np.array(group["TARGETID"])
-        map_args += [
-            (
-                os.path.join(
-                    desi_data_path, f"coadd-{survey}-{program}-{healpix}.fits"
-                ),
-                target_ids,
-            )
-        ]
-
-    # Process all files
-    results = []
-    for args in map_args:
-        results.append(processing_fn(args))
-
-    # Aggregate all spectra into an astropy table
-    spectra = Table(
-        {k: np.concatenate([d[k] for d in results], axis=0) for k in results[0].keys()}
+    # Order the objects by healpix index, and by coadd file within each healpix index,
+    # so that the spectra of each coadd file are written to a contiguous block of rows
+    catalog = catalog.group_by(["healpix", "SURVEY", "PROGRAM", "HEALPIX"])
+    healpix_indices, healpix_starts, healpix_counts = np.unique(
+        catalog["healpix"], return_index=True, return_counts=True
     )
 
-    # Join on target id with the input catalog
-    catalog = join(catalog, spectra, keys="TARGETID", join_type="inner")
+    # Preparing the work items, one per (healpix index, coadd file) pair, with the
+    # offset of the spectra of the coadd file in the output file of the healpix index
+    healpix_starts = dict(zip(healpix_indices, healpix_starts))
+    work_items, sizes = [], []
+    for file_group, row in zip(catalog.groups, catalog.groups.indices[:-1]):
+        survey = file_group["SURVEY"][0]
+        program = file_group["PROGRAM"][0]
+        healpix = file_group["HEALPIX"][0]
+        filename = os.path.join(desi_data_path, f"coadd-{survey}-{program}-{healpix}.fits")
+        healpix_idx = file_group["healpix"][0]
+        work_items.append(
+            (healpix_idx, row - healpix_starts[healpix_idx], filename, np.array(file_group["TARGETID"]))
+        )
+        sizes.append(os.path.getsize(filename))
 
-    # Making sure we didn't lose anyone
-    assert len(catalog) == len(spectra), "There was an error in the join operation"
+    # Preparing the writers of each healpix index
+    num_files = dict(zip(*np.unique([item[0] for item in work_items], return_counts=True)))
+    writers = {}
+    for healpix_idx, count in zip(healpix_indices, healpix_counts):
+        group_filename = os.path.join(
+            output_dir, "edr_sv3/healpix={}/001-of-001.hdf5".format(healpix_idx)
+        )
+        start = healpix_starts[healpix_idx]
+        writers[healpix_idx] = HealpixWriter(
+            catalog[start : start + count], group_filename, num_files[healpix_idx]
+        )
 
-    # Save all columns to disk in HDF5 format
-    with h5py.File(output_filename, "w") as hdf5_file:
-        for key in catalog.colnames:
-            hdf5_file.create_dataset(key, data=catalog[key])
-    return 1
+    # Largest files first, so that the smallest ones fill the tail of the run
+    work_items = [work_items[i] for i in np.argsort(sizes, kind="stable")[::-1]]
+
+    num_done = 0
+    with Pool(num_processes) as pool:
+        for healpix_idx, offset, spectra in tqdm(
+            pool.imap_unordered(read_work_item, work_items), total=len(work_items)
+        ):
+            num_done += writers[healpix_idx].write(offset, spectra)
+    return num_done
 
 
 def main(args):
@@ -160,25 +256,12 @@ def main(args):
         nest=True,
     )
 
-    # Extract the spectra by looping over all files
-    catalog = catalog.group_by(["healpix"])
-
-    # Preparing the arguments for the parallel processing
-    map_args = []
-    for group in catalog.groups:
-        # Create a filename for the group
-        group_filename = os.path.join(
-            args.output_dir,
-            "edr_sv3/healpix={}/001-of-001.hdf5".format(group["healpix"][0]),
-        )
-        map_args.append((group, group_filename, args.desi_data_path))
-
-    # Run the parallel processing
-    results = process_map(
-        save_in_standard_format, map_args, max_workers=args.num_processes
+    # Read all the spectra in parallel, and export them by healpix index
+    num_done = save_in_standard_format(
+        catalog, args.output_dir, args.desi_data_path, num_processes=args.num_processes
     )
 
-    if sum(results) != len(map_args):
+    if num_done != len(np.unique(catalog["healpix"])):
         print(
             "There was an error in the parallel processing, some files may not have been processed correctly"
         )
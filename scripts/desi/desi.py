@@ -17,6 +17,7 @@ from datasets.data_files import DataFilesPatternsDict
 import itertools
 import h5py
 import numpy as np
+from astropile.hdf5_utils import find_rows, iter_rows
 
 # TODO: Add BibTeX citation
 # Find for instance the citation on arxiv or on the dataset repo/website
@@ -88,6 +89,9 @@ class DESI(datasets.GeneratorBasedBuilder):
 
     _spectrum_length = 7781
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 128
+
     @classmethod
     def _info(self):
         """Defines the features available in this dataset."""
@@ -130,41 +134,44 @@ class DESI(datasets.GeneratorBasedBuilder):
         for j, file in enumerate(files):
             with h5py.File(file, "r") as data:
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j])
                 else:
-                    keys = data["object_id"][:]
-                
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"][:])
-                sorted_ids = data["object_id"][:][sort_index]
-
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog 
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                    rows = range(len(data["object_id"]))
+
+                # Wavelength grid shared by all the spectra of the file, older files store it for each row
+                shared_lambda = data["spectrum_lambda"].ndim == 1
+                wavelength = data["spectrum_lambda"][:] if shared_lambda else None
+
+                # Columns to read in batches for all requested rows
+                keys = (["spectrum_flux", "spectrum_ivar", "spectrum_lsf_sigma", "spectrum_mask", "object_id"]
+                        + ([] if shared_lambda else ["spectrum_lambda"])
+                        + _FLOAT_FEATURES + _BOOL_FEATURES)
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
                     
                     # Parse spectrum data
                     example = {
                         "spectrum": 
                             {
-                                "flux": data['spectrum_flux'][i], 
-                                "ivar": data['spectrum_ivar'][i],
-                                "lsf_sigma": data['spectrum_lsf_sigma'][i],
-                                "lambda": data['spectrum_lambda'][i],
-                                "mask": data['spectrum_mask'][i],
+                                "flux": row['spectrum_flux'], 
+                                "ivar": row['spectrum_ivar'],
+                                "lsf_sigma": row['spectrum_lsf_sigma'],
+                                "lambda": wavelength if shared_lambda else row['spectrum_lambda'],
+                                "mask": row['spectrum_mask'],
                             }
                     }
                     # Add all other requested features
                     for f in _FLOAT_FEATURES:
-                        example[f] = data[f][i].astype("float32")
+                        example[f] = row[f].astype("float32")
 
                     # Add all boolean flags
                     for f in _BOOL_FEATURES:
-                        example[f] = not bool(data[f][i])    # if flag is 0, then no problem
+                        example[f] = not bool(row[f])    # if flag is 0, then no problem
 
                     # Add object_id
-                    example["object_id"] = str(data["object_id"][i])
+                    example["object_id"] = str(row["object_id"])
 
-                    yield str(data["object_id"][i]), example
+                    yield str(row["object_id"]), example
 
 
     def _split_generators(self, dl_manager):
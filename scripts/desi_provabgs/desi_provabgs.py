@@ -23,6 +23,7 @@ from datasets.data_files import DataFilesPatternsDict
 import itertools
 import h5py
 import numpy as np
+from astropile.hdf5_utils import find_rows, iter_rows
 
 _CITATION = """\
 @article{hahn2023desi,
@@ -86,6 +87,9 @@ class PROVABGS(datasets.GeneratorBasedBuilder):
 
     DEFAULT_CONFIG_NAME = "provabgs"  # It's not mandatory to have a default configuration. Just use one if it make sense.
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 128
+
     def _info(self):
         """Defines the dataset info."""
         features = datasets.Features(
@@ -126,30 +130,28 @@ class PROVABGS(datasets.GeneratorBasedBuilder):
         for j, file_path in enumerate(files):
             with h5py.File(file_path, "r") as data:    
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j])
                 else:
-                    keys = data["object_id"]
-
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"])
-                sorted_ids = data["object_id"][:][sort_index]
+                    rows = range(len(data["object_id"]))
 
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog 
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                # Columns to read in batches for all requested rows
+                keys = (["ra", "dec", "PROVABGS_MCMC", "PROVABGS_THETA_BF", "PROVABGS_LOGMSTAR_BF", "object_id"]
+                        + _FLOAT_FEATURES)
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
 
                     example = {
-                        "ra": data["ra"][i].astype(np.float32),
-                        "dec": data["dec"][i].astype(np.float32),
-                        'PROVABGS_MCMC': data['PROVABGS_MCMC'][i].astype(np.float32),
-                        'PROVABGS_THETA_BF': data['PROVABGS_THETA_BF'][i].astype(np.float32),
-                        'LOG_MSTAR': data['PROVABGS_LOGMSTAR_BF'][i].astype(np.float32),
+                        "ra": row["ra"].astype(np.float32),
+                        "dec": row["dec"].astype(np.float32),
+                        'PROVABGS_MCMC': row['PROVABGS_MCMC'].astype(np.float32),
+                        'PROVABGS_THETA_BF': row['PROVABGS_THETA_BF'].astype(np.float32),
+                        'LOG_MSTAR': row['PROVABGS_LOGMSTAR_BF'].astype(np.float32),
                     }
 
                     for key in _FLOAT_FEATURES:
-                        example[key] = data[key][i].astype(np.float64).squeeze()
+                        example[key] = row[key].astype(np.float64).squeeze()
 
                     # Add object id
-                    example["object_id"] = str(data["object_id"][i])
+                    example["object_id"] = str(row["object_id"])
 
-                    yield str(data["object_id"][i]), example
+                    yield str(row["object_id"]), example
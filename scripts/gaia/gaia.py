@@ -4,6 +4,7 @@ import datasets
 from datasets import Features, Sequence, Value
 from datasets.data_files import DataFilesPatternsDict
 import h5py
+from astropile.hdf5_utils import find_rows, iter_rows
 
 _CITATION = """\
 @ARTICLE{2023A&A...674A...1G,
@@ -140,6 +141,9 @@ class Gaia(datasets.GeneratorBasedBuilder):
 
     DEFAULT_CONFIG_NAME = "gaia_dr3"
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 1024
+
     @classmethod
     def _info(self):
         """Defines the features available in this dataset."""
@@ -179,34 +183,32 @@ class Gaia(datasets.GeneratorBasedBuilder):
         for j, file in enumerate(files):
             with h5py.File(file, "r") as data:
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j], id_key="source_id")
                 else:
-                    keys = data["source_id"][:]
-
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["source_id"][:])
-                sorted_ids = data["source_id"][:][sort_index]
+                    rows = range(len(data["source_id"]))
 
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                # Columns to read in batches for all requested rows
+                keys = (["source_id", "healpix", "ra", "dec"] + _SPECTRUM_FEATURES + _PHOTOMETRY_FEATURES
+                        + _ASTROMETRY_FEATURES + _RV_FEATURES + _GSPPHOT_FEATURES + _FLAG_FEATURES + _CORRECTION_FEATURES)
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
 
-                    s_id = data["source_id"][i]
+                    s_id = row["source_id"]
 
                     example = {
                         "spectral_coefficients": {
-                            f: data[f][i] for f in _SPECTRUM_FEATURES
+                            f: row[f] for f in _SPECTRUM_FEATURES
                         },
-                        "photometry": {f: data[f][i] for f in _PHOTOMETRY_FEATURES},
-                        "astrometry": {f: data[f][i] for f in _ASTROMETRY_FEATURES},
-                        "radial_velocity": {f: data[f][i] for f in _RV_FEATURES},
-                        "gspphot": {f: data[f][i] for f in _GSPPHOT_FEATURES},
-                        "flags": {f: data[f][i] for f in _FLAG_FEATURES},
-                        "corrections": {f: data[f][i] for f in _CORRECTION_FEATURES},
+                        "photometry": {f: row[f] for f in _PHOTOMETRY_FEATURES},
+                        "astrometry": {f: row[f] for f in _ASTROMETRY_FEATURES},
+                        "radial_velocity": {f: row[f] for f in _RV_FEATURES},
+                        "gspphot": {f: row[f] for f in _GSPPHOT_FEATURES},
+                        "flags": {f: row[f] for f in _FLAG_FEATURES},
+                        "corrections": {f: row[f] for f in _CORRECTION_FEATURES},
                         "object_id": s_id,
-                        "healpix": data["healpix"][i],
-                        "ra": data["ra"][i],
-                        "dec": data["dec"][i],
+                        "healpix": row["healpix"],
+                        "ra": row["ra"],
+                        "dec": row["dec"],
                     }
 
                     yield int(s_id), example
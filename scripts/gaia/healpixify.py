@@ -3,6 +3,7 @@ import os
 import h5py
 import healpy as hp
 import numpy as np
+from astropile.hdf5_utils import write_object_index
 
 _healpix_nside = 16
 
@@ -23,6 +24,9 @@ def save_in_standard_format(args):
 
     catalog.close()
 
+    # Save the sorted source id index alongside the data
+    write_object_index(output_filename, id_key="source_id")
+
     return 1
 
 
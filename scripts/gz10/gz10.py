@@ -21,6 +21,7 @@ from datasets.data_files import DataFilesPatternsDict
 import itertools
 import h5py
 import numpy as np
+from astropile.hdf5_utils import find_rows, iter_rows
 
 _CITATION = """\
 @article{walmsley2022galaxy,
@@ -77,6 +78,9 @@ class GZ10(datasets.GeneratorBasedBuilder):
     _image_size = 256
     _n_samples = 17736
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 32
+
     def _info(self):
         """Defines the dataset info."""
         features = datasets.Features(
@@ -123,32 +127,31 @@ class GZ10(datasets.GeneratorBasedBuilder):
         for j, file_path in enumerate(files):
             with h5py.File(file_path, "r") as data:
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j])
                 else:
-                    keys = data["object_id"]
-
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"])
-                sorted_ids = data["object_id"][:][sort_index]
+                    rows = range(len(data["object_id"]))
 
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                # Columns to read in batches for all requested rows
+                keys = ["ans", "dec", "ra", "redshift", "object_id"]
+                if self.config.name == "gz10_rgb_images":
+                    keys += ["images", "pxscale"]
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
 
                     example = {
-                        "gz10_label": data["ans"][i].astype(np.int32),
-                        "dec": data["dec"][i].astype(np.float32),
-                        "ra": data["ra"][i].astype(np.float32),
-                        "redshift": data["redshift"][i].astype(np.float32),
+                        "gz10_label": row["ans"].astype(np.int32),
+                        "dec": row["dec"].astype(np.float32),
+                        "ra": row["ra"].astype(np.float32),
+                        "redshift": row["redshift"].astype(np.float32),
                     }
 
                     if (
                         self.config.name == "gz10_rgb_images"
                     ):
-                        example["rgb_image"] = data["images"][i]
-                        example["rgb_pixel_scale"] = data["pxscale"][i]
+                        example["rgb_image"] = row["images"]
+                        example["rgb_pixel_scale"] = row["pxscale"]
 
                     # Add object id
-                    example["object_id"] = str(data["object_id"][i])
+                    example["object_id"] = str(row["object_id"])
 
-                    yield str(data["object_id"][i]), example
+                    yield str(row["object_id"]), example
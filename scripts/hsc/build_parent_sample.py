@@ -1,4 +1,5 @@
 import os
+import glob
 import argparse
 from astropy.table import Table, join
 import astropy.units as u
@@ -9,9 +10,9 @@ import numpy as np
 import h5py
 from tqdm import tqdm
 from astropy.wcs import WCS
-from astropy.nddata import Cutout2D
 from astropy.io import fits
-from filelock import FileLock
+from astropile.hdf5_utils import write_object_index, write_shard, merge_shards
+from astropile.cutouts import batch_cutouts
 
 HSC_PIXEL_SCALE = 0.168 # Size of a pixel in arcseconds
 
@@ -31,9 +32,6 @@ def _processing_fn(args):
 
     # Loop over the bricks
     for patch_cat in patches.groups:
-        # Create a cutout for each object in the brick
-        out_images = []
-
         tract = patch_cat['tract'][0]
         patch = patch_cat['patch'][0]
         patch = f"{patch // 100},{patch % 10}"
@@ -59,93 +57,53 @@ def _processing_fn(args):
             print(f"Failed to load image for patch {tract}, {patch}: {e}")
             continue
 
-        for obj in patch_cat:
-            # Create a cutout for each band
-            ra, dec = obj['ra'], obj['dec']
-
-            # Build image
-            image = []
-            for band in _filters:
-                wcs = WCS(images[band]['image'].header)
-                x, y = wcs.all_world2pix(ra, dec, 1)
-                position = (x, y)
-                size = (_image_size, _image_size)
-                image.append(Cutout2D(images[band]['image'].data, position, size, wcs=wcs).data)
-            image = np.stack(image, axis=0)
-
-            # Build inverse variance
-            var = []
-            for band in _filters:
-                wcs = WCS(images[band]['var'].header)
-                x, y = wcs.all_world2pix(ra, dec, 1)
-                position = (x, y)
-                size = (_image_size, _image_size)
-                var.append(Cutout2D(images[band]['var'].data, position, size, wcs=wcs).data)
-            var = np.stack(var, axis=0)
-
-            mask = []
-            for band in _filters:
-                wcs = WCS(images[band]['mask'].header)
-                x, y = wcs.all_world2pix(ra, dec, 1)
-                position = (x, y)
-                size = (_image_size, _image_size)
-                mask.append(Cutout2D(images[band]['mask'].data, position, size, wcs=wcs).data)
-            mask = np.stack(mask, axis=0)
-
-            # Compute the PSF FWHM in arcsec
-            psf_fwhm = []
-            for f in _filters:
-                b = f.lower().split('-')[-1]
-                psf_mxx = obj[f'{b}_sdssshape_psf_shape11'].filled(fill_value=0)
-                psf_myy = obj[f'{b}_sdssshape_psf_shape22'].filled(fill_value=0)
-                psf_mxy = obj[f'{b}_sdssshape_psf_shape12'].filled(fill_value=0)
-                psf_fwhm.append(2.355 * (psf_mxx * psf_myy - psf_mxy**2)**(0.25)) # in arcsec
-            psf_fwhm = np.nan_to_num(np.array(psf_fwhm).astype(np.float32))
-
-            out_images.append({
-                    'object_id': obj['object_id'],
-                    'image_band': np.array([f.lower().encode("utf-8") for f in _filters], dtype=_utf8_filter_type),
-                    'image_ivar': np.nan_to_num(1./var),
-                    'image_array': image,
-                    'image_mask': mask.astype('bool'),
-                    'image_psf_fwhm': psf_fwhm,
-                    'image_scale': np.array([_pixel_scale for f in _filters]).astype(np.float32),
-            })
-
-        # If we didn't find any images, we return 0
-        if len(out_images) == 0:
-            continue
-
-        # Aggregate all images into an astropy table
-        images = Table({k: [d[k] for d in out_images] for k in out_images[0].keys()})
+        # Cutouts of all objects of the patch at once, with a single WCS per band shared
+        # by the image, variance and mask planes, padded on the edges of the patch
+        n_objects = len(patch_cat)
+        shape = (n_objects, len(_filters), _image_size, _image_size)
+        image = np.zeros(shape, dtype=np.float32)
+        var = np.zeros(shape, dtype=np.float32)
+        mask = np.zeros(shape, dtype=bool)
+        ra, dec = np.asarray(patch_cat['ra']), np.asarray(patch_cat['dec'])
+        for k, band in enumerate(_filters):
+            wcs = WCS(images[band]['image'].header)
+            x, y = wcs.all_world2pix(ra, dec, 1)
+            batch_cutouts([images[band]['image'].data], x, y, _image_size, out=image[:, k:k+1])
+            # Missing pixels have an infinite variance, i.e. a null inverse variance
+            batch_cutouts([images[band]['var'].data], x, y, _image_size, fill_value=np.inf, out=var[:, k:k+1])
+            batch_cutouts([images[band]['mask'].data], x, y, _image_size, out=mask[:, k:k+1])
+
+        # Compute the PSF FWHM in arcsec
+        psf_fwhm = []
+        for f in _filters:
+            b = f.lower().split('-')[-1]
+            psf_mxx = np.ma.filled(patch_cat[f'{b}_sdssshape_psf_shape11'], fill_value=0)
+            psf_myy = np.ma.filled(patch_cat[f'{b}_sdssshape_psf_shape22'], fill_value=0)
+            psf_mxy = np.ma.filled(patch_cat[f'{b}_sdssshape_psf_shape12'], fill_value=0)
+            psf_fwhm.append(2.355 * (psf_mxx * psf_myy - psf_mxy**2)**(0.25)) # in arcsec
+        psf_fwhm = np.nan_to_num(np.stack(psf_fwhm, axis=-1).astype(np.float32))
+
+        images = Table({
+            'object_id': np.asarray(patch_cat['object_id']),
+            'image_band': np.array([[f.lower().encode("utf-8") for f in _filters]] * n_objects, dtype=_utf8_filter_type),
+            'image_ivar': np.nan_to_num(1./var),
+            'image_array': image,
+            'image_mask': mask,
+            'image_psf_fwhm': psf_fwhm,
+            'image_scale': np.full((n_objects, len(_filters)), _pixel_scale, dtype=np.float32),
+        })
 
         # Join on object_id with the input catalog
         catalog = join(source_catalog, images, 'object_id', join_type='inner')
             
-        # Create the output directory if it does not exist
-        out_path = os.path.dirname(group_filename)
-        if not os.path.exists(out_path):
-            os.makedirs(out_path, exist_ok=True)
-
-        with FileLock(group_filename + ".lock"):
-            if os.path.exists(group_filename):
-                # Load the existing file and concatenate the data with current data
-                with h5py.File(group_filename, 'a') as hdf5_file:
-                    for key in catalog.colnames:
-                        shape = catalog[key].shape
-                        hdf5_file[key].resize(hdf5_file[key].shape[0] + shape[0], axis=0)
-                        hdf5_file[key][-shape[0]:] = catalog[key]
-            else:           
-                # This is the first time we write the file, so we define the datasets
-                with h5py.File(group_filename, 'w') as hdf5_file:
-                    for key in catalog.colnames:
-                        shape = catalog[key].shape
-                        if len(shape) == 1:
-                            hdf5_file.create_dataset(key, data=catalog[key], compression="gzip", chunks=True, maxshape=(None,))
-                        else:
-                            hdf5_file.create_dataset(key, data=catalog[key], compression="gzip", chunks=True, maxshape=(None, *shape[1:]))
-
-        del catalog, images, out_images
+        # Each patch is written to its own shard, so that workers never wait on each other,
+        # the shards of the healpix index are merged into group_filename by merge_shards_fn
+        shard_dir = os.path.join(os.path.dirname(group_filename), 'shards')
+        os.makedirs(shard_dir, exist_ok=True)
+        shard_name = f"{tract}-{patch_cat['patch'][0]}-{np.min(patch_cat['object_id'])}.hdf5"
+        write_shard(os.path.join(shard_dir, shard_name), catalog)
+
+        del catalog, images, image, var, mask
 
     return 1
 
@@ -182,6 +140,39 @@ def extract_cutouts(parent_sample, data_dir,  output_dir, num_processes=1, proc_
     else:
         print("Warning, unexpected number of results, some files may not have been exported as expected")
 
+def merge_shards_fn(shard_dir):
+    """ Merge the shards of a healpix index into its final HDF5 file
+    """
+    shards = sorted(glob.glob(os.path.join(shard_dir, '*.hdf5')))
+    if len(shards) == 0:
+        os.rmdir(shard_dir)
+        return 1
+
+    # Rows merged by a previous run are kept, as the first input of the merge,
+    # and the rows of objects extracted again by a rerun are dropped
+    group_filename = os.path.join(os.path.dirname(shard_dir), '001-of-001.hdf5')
+    inputs = [group_filename] + shards if os.path.exists(group_filename) else shards
+    merge_shards(inputs, group_filename, id_key='object_id')
+
+    # Save the sorted object id index of the merged file
+    write_object_index(group_filename)
+
+    for shard in shards:
+        os.remove(shard)
+    os.rmdir(shard_dir)
+    return 1
+
+def merge_healpix_files(output_dir, num_processes=1):
+    """ Merge the shards written by extract_cutouts, once all the cutouts are extracted
+    """
+    shard_dirs = sorted(glob.glob(os.path.join(output_dir, 'healpix=*', 'shards')))
+    with Pool(num_processes) as pool:
+        results = pool.map(merge_shards_fn, shard_dirs)
+
+    if np.sum(results) == len(shard_dirs):
+        print('Done!')
+    else:
+        print("Warning, unexpected number of results, some files may not have been merged as expected")
 
 def main(args):
 
@@ -193,6 +184,10 @@ def main(args):
     # Check if ran as part of a slurm job, if so, only the procid will be processed
     slurm_procid = int(os.getenv('SLURM_PROCID')) if 'SLURM_PROCID' in os.environ else None
 
+    if args.merge_only:
+        merge_healpix_files(output_path, num_processes=args.num_processes)
+        return
+
     # Login to the HSC archive
     archive = hsc.Hsc(dr=args.dr, rerun=args.rerun)
 
@@ -222,6 +217,10 @@ def main(args):
     extract_cutouts(catalog_filename, data_dir, output_path, 
                     num_processes=args.num_processes, proc_id=slurm_procid, nsplits=args.nsplits)
 
+    # Tasks of a slurm job only write shards, which are merged with --merge_only once all tasks are done
+    if slurm_procid is None:
+        merge_healpix_files(output_path, num_processes=args.num_processes)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Takes an SQL query file, runs the query, and returns the cutouts for the objects in the query')
     parser.add_argument('query_file', type=str, help='The path to the SQL query file')
@@ -233,5 +232,6 @@ if __name__ == '__main__':
     parser.add_argument('--rerun', type=str, default='pdr3_dud', help='The rerun to use')
     parser.add_argument('--dr', type=str, default='pdr3', help='The data release to use')
     parser.add_argument('--tiny', action='store_true', help='Use a tiny version of the catalog for testing purposes')
+    parser.add_argument('--merge_only', action='store_true', help='Only merge the shards of already extracted cutouts')
     args = parser.parse_args()
     main(args)
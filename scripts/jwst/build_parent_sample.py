@@ -14,6 +14,7 @@ from astropy.nddata.utils import Cutout2D
 from astropy.table import Table, join
 from astropy.wcs import WCS
 from bs4 import BeautifulSoup
+from astropile.hdf5_utils import write_object_index
 
 _healpix_nside = 16
 
@@ -356,6 +357,9 @@ def _processing_fn(args):
             for key in catalog.colnames:
                 hdf5_file.create_dataset(key, data=catalog[key])
 
+        # Save the sorted object id index alongside the data
+        write_object_index(group_filename)
+
     print("saved hdf5", directory_path)
 
     return 1
@@ -18,6 +18,7 @@ import h5py
 import numpy as np
 from datasets import Array2D, Features, Sequence, Value
 from datasets.data_files import DataFilesPatternsDict
+from astropile.hdf5_utils import find_rows, iter_rows
 
 # TODO: Add BibTeX citation
 # Find for instance the citation on arxiv or on the dataset repo/website
@@ -4974,6 +4975,9 @@ class JWST(datasets.GeneratorBasedBuilder):
 
     VERSION = _VERSION
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 32
+
     """ datasets.BuilderConfig(
             name="all",
             version=VERSION,
@@ -5165,25 +5169,23 @@ class JWST(datasets.GeneratorBasedBuilder):
             print(file)
             with h5py.File(file, "r") as data:
                 if object_ids is not None:
-                    keys = object_ids[j]
-
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j])
                 else:
-                    keys = data["object_id"]
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"])
-                sorted_ids = data["object_id"][:][sort_index]
+                    rows = range(len(data["object_id"]))
 
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                # Columns to read in batches for all requested rows
+                keys = (["image_band", "image_array", "image_psf_fwhm", "image_scale", "object_id"]
+                        + self.config.float_features)
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
                     # Parse image data
                     example = {
                         "image": [
                             {
-                                "band": data["image_band"][i][j].decode("utf-8"),
-                                "array": data["image_array"][i][j],
-                                "psf_fwhm": data["image_psf_fwhm"][i][j],
-                                "scale": data["image_scale"][i][j],
+                                "band": row["image_band"][j].decode("utf-8"),
+                                "array": row["image_array"][j],
+                                "psf_fwhm": row["image_psf_fwhm"][j],
+                                "scale": row["image_scale"][j],
                             }
                             for j, _ in enumerate(self.config.bands)
                         ]
@@ -5192,13 +5194,13 @@ class JWST(datasets.GeneratorBasedBuilder):
                     # Add all other requested features
                     for f in self.config.float_features:
                         try:
-                            len(data[f][i])
+                            len(row[f])
                             example[f] = 0.0
                         except:
-                            example[f] = data[f][i].astype("float32")
+                            example[f] = row[f].astype("float32")
 
                     # Add object_id
 
-                    example["object_id"] = str(data["object_id"][i])
+                    example["object_id"] = str(row["object_id"])
 
-                    yield str(data["object_id"][i]), example
+                    yield str(row["object_id"]), example
@@ -1,9 +1,9 @@
 from astropy.io import fits
 from astropy.table import Table, join, vstack, hstack
 from astropy.wcs import WCS
-from astropy.nddata import Cutout2D
 from multiprocessing import Pool
-from filelock import FileLock
+from astropile.hdf5_utils import write_object_index, write_shard, merge_shards
+from astropile.cutouts import batch_cutouts
 import healpy as hp
 from tqdm import tqdm
 import numpy as np
@@ -97,9 +97,6 @@ def _processing_fn(args):
 
     # Loop over the bricks
     for brick in bricks.groups:
-        # Create a cutout for each object in the brick
-        out_images = []
-
         brick_name = brick['BRICKNAME'][0]
         brick_group = brick_name[:3]
         # Load all the images for this brick
@@ -125,74 +122,40 @@ def _processing_fn(args):
             maskclean &= (data & 2**bit)==0
         images['maskbits'].data = maskclean.astype(data.dtype)
 
-        for obj in brick:
-            # Create a cutout for each band
-            ra, dec = obj['RA'], obj['DEC']
-            wcs = WCS(images['image-g'].header)
-            x, y = wcs.all_world2pix(ra, dec, 1)
-            position = (x, y)
-            size = (_cutout_size, _cutout_size)
-
-            # Build image
-            image = []
-            for band in ['image-g', 'image-r', 'image-i', 'image-z']:
-                image.append(Cutout2D(images[band].data, position, size, wcs=wcs).data)
-            image = np.stack(image, axis=0)
-
-            # Build inverse variance
-            invvar = []
-            for band in ['invvar-g', 'invvar-r', 'invvar-i', 'invvar-z']:
-                invvar.append(Cutout2D(images[band].data, position, size, wcs=wcs).data)
-            invvar = np.stack(invvar, axis=0)
-
-            # Build mask
-            mask = Cutout2D(images['maskbits'].data, position, size, wcs=wcs).data
-
-            out_images.append({
-                    'object_id': np.array(f'{obj["BRICKNAME"]}-{obj["OBJID"]}', dtype=_utf8_filter_typeb),
-                    'gid': obj['gid'],
-                    'image_band': np.array([f.lower().encode("utf-8") for f in _filters], dtype=_utf8_filter_type),
-                    'image_ivar': invvar,
-                    'image_array': image,
-                    'image_mask': mask.astype('bool'),
-                    'image_psf_fwhm': np.array([obj[f'PSFSIZE_{b}'] for b in ['G', 'R', 'I', 'Z']]),
-                    'image_scale': np.array([_pixel_scale for f in _filters]).astype(np.float32),
-            })
-
-        # If we didn't find any images, we return 0
-        if len(out_images) == 0:
-            continue
-
-        # Aggregate all images into an astropy table
-        images = Table({k: [d[k] for d in out_images] for k in out_images[0].keys()})
+        # Pixel positions of all objects of the brick, with a single WCS shared by all bands
+        wcs = WCS(images['image-g'].header)
+        x, y = wcs.all_world2pix(np.asarray(brick['RA']), np.asarray(brick['DEC']), 1)
+
+        # Cutouts of all objects at once, padded with zeros on the edges of the brick
+        image = batch_cutouts([images[band].data for band in ['image-g', 'image-r', 'image-i', 'image-z']],
+                                x, y, _cutout_size)
+        invvar = batch_cutouts([images[band].data for band in ['invvar-g', 'invvar-r', 'invvar-i', 'invvar-z']],
+                                 x, y, _cutout_size)
+        mask = batch_cutouts([images['maskbits'].data], x, y, _cutout_size)[:, 0]
+
+        n_objects = len(brick)
+        images = Table({
+            'object_id': np.array([f'{name}-{objid}' for name, objid in zip(brick['BRICKNAME'], brick['OBJID'])],
+                                  dtype=_utf8_filter_typeb),
+            'gid': np.asarray(brick['gid']),
+            'image_band': np.array([[f.lower().encode("utf-8") for f in _filters]] * n_objects, dtype=_utf8_filter_type),
+            'image_ivar': invvar,
+            'image_array': image,
+            'image_mask': mask.astype('bool'),
+            'image_psf_fwhm': np.stack([np.asarray(brick[f'PSFSIZE_{b}']) for b in ['G', 'R', 'I', 'Z']], axis=-1),
+            'image_scale': np.full((n_objects, len(_filters)), _pixel_scale, dtype=np.float32),
+        })
 
         # Join on object_id with the input catalog
         catalog = join(group, images, 'gid', join_type='inner')
             
-        # Create the output directory if it does not exist
-        out_path = os.path.dirname(group_filename)
-        if not os.path.exists(out_path):
-            os.makedirs(out_path)
-
-        with FileLock(group_filename + ".lock"):
-            if os.path.exists(group_filename):
-                # Load the existing file and concatenate the data with current data
-                with h5py.File(group_filename, 'a') as hdf5_file:
-                    for key in catalog.colnames:
-                        shape = catalog[key].shape
-                        hdf5_file[key].resize(hdf5_file[key].shape[0] + shape[0], axis=0)
-                        hdf5_file[key][-shape[0]:] = catalog[key]
-            else:           
-                # This is the first time we write the file, so we define the datasets
-                with h5py.File(group_filename, 'w') as hdf5_file:
-                    for key in catalog.colnames:
-                        shape = catalog[key].shape
-                        if len(shape) == 1:
-                            hdf5_file.create_dataset(key, data=catalog[key], compression="gzip", chunks=True, maxshape=(None,))
-                        else:
-                            hdf5_file.create_dataset(key, data=catalog[key], compression="gzip", chunks=True, maxshape=(None, *shape[1:]))
-
-        del catalog, images, out_images
+        # Each brick is written to its own shard, so that workers never wait on each other,
+        # the shards of the healpix index are merged into group_filename by merge_shards_fn
+        shard_dir = os.path.join(os.path.dirname(group_filename), 'shards')
+        os.makedirs(shard_dir, exist_ok=True)
+        write_shard(os.path.join(shard_dir, f'{brick_name}-{np.min(brick["OBJID"])}.hdf5'), catalog)
+
+        del catalog, images, image, invvar, mask
 
     return 1
 
@@ -225,6 +188,40 @@ def extract_cutouts(parent_sample, legacysurvey_root_dir,  output_dir, num_proce
     else:
         print("Warning, unexpected number of results, some files may not have been exported as expected")
 
+def merge_shards_fn(shard_dir):
+    """ Merge the shards of a healpix index into its final HDF5 file
+    """
+    shards = sorted(glob.glob(os.path.join(shard_dir, '*.hdf5')))
+    if len(shards) == 0:
+        os.rmdir(shard_dir)
+        return 1
+
+    # Rows merged by a previous run are kept, as the first input of the merge,
+    # and the rows of objects extracted again by a rerun are dropped
+    group_filename = os.path.join(os.path.dirname(shard_dir), '001-of-001.hdf5')
+    inputs = [group_filename] + shards if os.path.exists(group_filename) else shards
+    merge_shards(inputs, group_filename, id_key='object_id')
+
+    # Save the sorted object id index of the merged file
+    write_object_index(group_filename)
+
+    for shard in shards:
+        os.remove(shard)
+    os.rmdir(shard_dir)
+    return 1
+
+def merge_healpix_files(output_dir, num_processes=1):
+    """ Merge the shards written by extract_cutouts, once all the cutouts are extracted
+    """
+    shard_dirs = sorted(glob.glob(os.path.join(output_dir, 'dr10_south_21', 'healpix=*', 'shards')))
+    with Pool(num_processes) as pool:
+        results = pool.map(merge_shards_fn, shard_dirs)
+
+    if np.sum(results) == len(shard_dirs):
+        print('Done!')
+    else:
+        print("Warning, unexpected number of results, some files may not have been merged as expected")
+
 def main(args):
     # Create the output directory if it doesn't exist
     if not os.path.exists(args.output_dir):
@@ -233,6 +230,10 @@ def main(args):
     # Check if ran as part of a slurm job, if so, only the procid will be processed
     slurm_procid = int(os.getenv('SLURM_PROCID')) if 'SLURM_PROCID' in os.environ else None
 
+    if args.merge_only:
+        merge_healpix_files(args.output_dir, num_processes=args.num_processes)
+        return
+
     # Build the catalogs
     catalog_files = build_catalog_dr10_south(args.data_dir, args.output_dir, 
                                              num_processes=args.num_processes,
@@ -247,6 +248,10 @@ def main(args):
         extract_cutouts(sample, args.data_dir, args.output_dir, 
                         num_processes=args.num_processes, proc_id=slurm_procid, healpix_idx=args.healpix_idx)
 
+    # Tasks of a slurm job only write shards, which are merged with --merge_only once all tasks are done
+    if slurm_procid is None:
+        merge_healpix_files(args.output_dir, num_processes=args.num_processes)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Builds a catalog for the Legacy Survey images from DR10.')
     parser.add_argument('data_dir', type=str, help='Path to the local copy of the data')
@@ -255,6 +260,7 @@ if __name__ == '__main__':
     parser.add_argument('--catalog_only', action='store_true', help='Only compile the catalog, do not extract cutouts')
     parser.add_argument('--nsplits', type=int, default=10, help='Number of splits for the catalog')
     parser.add_argument('--healpix_idx', nargs="+", type=int, default=None, help='List of healpix indices to process')
+    parser.add_argument('--merge_only', action='store_true', help='Only merge the shards of already extracted cutouts')
     args = parser.parse_args()
     print(args.healpix_idx)
     main(args)
@@ -16,6 +16,7 @@ from datasets import Features, Value, Array2D, Sequence
 from datasets.data_files import DataFilesPatternsDict
 import h5py
 import numpy as np
+from astropile.hdf5_utils import find_rows, iter_rows
 
 # TODO: Add BibTeX citation
 # Find for instance the citation on arxiv or on the dataset repo/website
@@ -80,6 +81,9 @@ class DECaLS(datasets.GeneratorBasedBuilder):
     _image_size = 160
     _bands = ['DES-G', 'DES-R', 'DES-I', 'DES-Z']
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 32
+
     @classmethod
     def _info(self):
         """ Defines the features available in this dataset.
@@ -131,33 +135,31 @@ class DECaLS(datasets.GeneratorBasedBuilder):
         for j, file in enumerate(files):
             with h5py.File(file, "r") as data:
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j])
                 else:
-                    keys = data["object_id"]
-                
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"])
-                sorted_ids = data["object_id"][:][sort_index]
-
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog 
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                    rows = range(len(data["object_id"]))
+
+                # Columns to read in batches for all requested rows
+                keys = (["image_band", "image_array", "image_mask", "image_ivar", "image_psf_fwhm", "image_scale", "TYPE", "object_id"]
+                        + _FLOAT_FEATURES)
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
                     # Parse image data
-                    example = {'image':  [{'band': data['image_band'][i][j].decode('utf-8'),
-                               'array': data['image_array'][i][j],
-                               'mask': data['image_mask'][i],
-                               'ivar': data['image_ivar'][i][j],
-                               'psf_fwhm': data['image_psf_fwhm'][i][j],
-                               'scale': data['image_scale'][i][j]} for j, _ in enumerate( self._bands )]
+                    example = {'image':  [{'band': row['image_band'][j].decode('utf-8'),
+                               'array': row['image_array'][j],
+                               'mask': row['image_mask'],
+                               'ivar': row['image_ivar'][j],
+                               'psf_fwhm': row['image_psf_fwhm'][j],
+                               'scale': row['image_scale'][j]} for j, _ in enumerate( self._bands )]
                     }
                     # Add all other requested features
                     for f in _FLOAT_FEATURES:
-                        example[f] = data[f][i].astype('float32')
+                        example[f] = row[f].astype('float32')
                     
                     # Add object type
-                    example['TYPE'] = data['TYPE'][i].decode('utf-8')
+                    example['TYPE'] = row['TYPE'].decode('utf-8')
 
                     # Add object_id
-                    example["object_id"] = str(data["object_id"][i])
+                    example["object_id"] = str(row["object_id"])
 
-                    yield str(data['object_id'][i]), example
\ No newline at end of file
+                    yield str(row['object_id']), example
\ No newline at end of file
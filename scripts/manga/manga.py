@@ -62,6 +62,9 @@ class MaNGA(datasets.GeneratorBasedBuilder):
 
     DEFAULT_CONFIG_NAME = "manga"
 
+    # Each example holds a full data cube, so only a few are buffered before being written to Arrow
+    DEFAULT_WRITER_BATCH_SIZE = 16
+
     _image_size = 96
     _image_filters = ['G', 'R', 'I', 'Z']
     _spectrum_size = 4563
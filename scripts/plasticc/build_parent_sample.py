@@ -9,6 +9,7 @@ import h5py
 import pandas as pd
 import healpy as hp
 import pdb
+from astropile.hdf5_utils import write_object_index
 
 _healpix_nside = 16
 
@@ -82,6 +83,9 @@ def save_in_standard_format(args):
             for key in objects.colnames:
                 hdf5_file.create_dataset(key, data=objects[key])
 
+        # Save the sorted object id index alongside the data
+        write_object_index(group_filename)
+
     return 1
 
 def download_plasticc_data(output_path, tiny=False):
@@ -18,6 +18,7 @@ from pathlib import Path
 import itertools
 import h5py
 import numpy as np
+from astropile.hdf5_utils import find_rows, iter_rows
 
 _CITATION = """\
 @article{Kessler_2019,
@@ -104,6 +105,9 @@ class PLAsTiCC(datasets.GeneratorBasedBuilder):
 
     DEFAULT_CONFIG_NAME = "train_only"
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 128
+
     @classmethod
     def _info(self):
         """ Defines the features available in this dataset.
@@ -159,19 +163,16 @@ class PLAsTiCC(datasets.GeneratorBasedBuilder):
         for j, file in enumerate(files):
             with h5py.File(file, "r") as data:
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j])
                 else:
-                    keys = data["object_id"]
-
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"])
-                sorted_ids = data["object_id"][:][sort_index]
+                    rows = range(len(data["object_id"]))
 
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
-                    # data['lightcurve'][i] is a single lightcurve of shape n_bands x 3 x seq_len
-                    lightcurve = data['lightcurve'][i]
+                # Columns to read in batches for all requested rows
+                keys = ["lightcurve", "object_id"] + _FLOAT_FEATURES + _STR_FEATURES
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
+                    # row['lightcurve'] is a single lightcurve of shape n_bands x 3 x seq_len
+                    lightcurve = row['lightcurve']
                     n_bands, _, seq_len = lightcurve.shape
                     band_arr = np.array([np.ones(seq_len) * band for band in range(n_bands)]).flatten().astype('int')
                     # convert to dict of lists
@@ -183,14 +184,14 @@ class PLAsTiCC(datasets.GeneratorBasedBuilder):
                         }}
                     # Add all other requested features
                     for f in _FLOAT_FEATURES:
-                        example[f] = data[f][i].astype('float32')
+                        example[f] = row[f].astype('float32')
                     for f in _STR_FEATURES:
                         if f == "obj_type":
-                            example[f] = _CLASS_MAPPING[data[f][i]]
+                            example[f] = _CLASS_MAPPING[row[f]]
                         else:
-                            example[f] = data[f][i].astype('str')
+                            example[f] = row[f].astype('str')
 
                     # Add object_id
-                    example["object_id"] = str(data["object_id"][i])
+                    example["object_id"] = str(row["object_id"])
 
-                    yield str(data['object_id'][i]), example
+                    yield str(row['object_id']), example
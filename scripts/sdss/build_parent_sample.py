@@ -7,6 +7,7 @@ from multiprocessing import Pool
 from tqdm import tqdm
 import healpy as hp
 import h5py
+from astropile.hdf5_utils import write_object_index
 
 _healpix_nside = 16
 
@@ -117,6 +118,9 @@ def save_in_standard_format(args):
     with h5py.File(output_filename, 'w') as hdf5_file:
         for key in catalog.colnames:
             hdf5_file.create_dataset(key, data=catalog[key])
+
+    # Save the sorted object id index alongside the data
+    write_object_index(output_filename)
     return 1
 
 def main(args):
@@ -17,6 +17,7 @@ from datasets.data_files import DataFilesPatternsDict
 import itertools
 import h5py
 import numpy as np
+from astropile.hdf5_utils import find_rows, iter_rows
 
 # TODO: Add BibTeX citation
 # Find for instance the citation on arxiv or on the dataset repo/website
@@ -132,6 +133,9 @@ class SDSS(datasets.GeneratorBasedBuilder):
 
     _flux_filters = ['U', 'G', 'R', 'I', 'Z']
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 128
+
     @classmethod
     def _info(self):
         """Defines the features available in this dataset."""
@@ -194,42 +198,40 @@ class SDSS(datasets.GeneratorBasedBuilder):
         for j, file in enumerate(files):
             with h5py.File(file, "r") as data:
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j])
                 else:
-                    keys = data["object_id"][:]
-
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"][:])
-                sorted_ids = data["object_id"][:][sort_index]
+                    rows = range(len(data["object_id"]))
 
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                # Columns to read in batches for all requested rows
+                keys = (["spectrum_flux", "spectrum_ivar", "spectrum_lsf_sigma", "spectrum_lambda", "spectrum_mask", "object_id"]
+                        + _FLOAT_FEATURES + _FLUX_FEATURES + _BOOL_FEATURES)
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
 
                     # Parse spectrum data
                     example = {
                         "spectrum": {
-                            "flux": data["spectrum_flux"][i].reshape([-1,1]),
-                            "ivar": data["spectrum_ivar"][i].reshape([-1,1]),
-                            "lsf_sigma": data["spectrum_lsf_sigma"][i].reshape([-1,1]),
-                            "lambda": data["spectrum_lambda"][i].reshape([-1,1]),
-                            "mask": data["spectrum_mask"][i].reshape([-1,1]),
+                            "flux": row["spectrum_flux"].reshape([-1,1]),
+                            "ivar": row["spectrum_ivar"].reshape([-1,1]),
+                            "lsf_sigma": row["spectrum_lsf_sigma"].reshape([-1,1]),
+                            "lambda": row["spectrum_lambda"].reshape([-1,1]),
+                            "mask": row["spectrum_mask"].reshape([-1,1]),
                         }
                     }
                     # Add all other requested features
                     for f in _FLOAT_FEATURES:
-                        example[f] = data[f][i].astype("float32").newbyteorder('=')
+                        example[f] = row[f].astype("float32").newbyteorder('=')
 
                     # Add all other requested features
                     for f in _FLUX_FEATURES:
                         for n, b in enumerate(self._flux_filters):
-                            example[f"{f}_{b}"] = data[f"{f}"][i][n].astype("float32").newbyteorder('=')
+                            example[f"{f}_{b}"] = row[f"{f}"][n].astype("float32").newbyteorder('=')
 
                     # Add all boolean flags
                     for f in _BOOL_FEATURES:
-                        example[f] = bool(data[f][i])
+                        example[f] = bool(row[f])
 
                     # Add object_id
-                    example["object_id"] = str(data["object_id"][i])
+                    example["object_id"] = str(row["object_id"])
 
-                    yield str(data["object_id"][i]), example
+                    yield str(row["object_id"]), example
@@ -7,6 +7,7 @@ import h5py
 import healpy as hp
 import numpy as np
 from multiprocessing import Pool
+from astropile.hdf5_utils import write_object_index
 
 CATALOG_COLUMNS = [
     'inds',
@@ -95,6 +96,8 @@ def _processing_fn(args):
         for key in catalog.colnames:
             hdf5_file.create_dataset(key, data=catalog[key])
 
+    # Save the sorted object id index alongside the data
+    write_object_index(output_filename)
     return 1
 
 def save_in_standard_format(catalog_filename, sample_name, data_path, output_dir, num_processes=None):
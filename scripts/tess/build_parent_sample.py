@@ -9,6 +9,7 @@ import h5py
 import healpy as hp
 from astropy.units import cds
 from quality import TESSQualityFlags
+from astropile.hdf5_utils import write_object_index
 
 _healpix_nside = 16
 
@@ -100,6 +101,9 @@ def save_in_standard_format(args):
     with h5py.File(output_filename, 'w') as hdf5_file:
         for key in catalog.colnames:
             hdf5_file.create_dataset(key, data=catalog[key])
+
+    # Save the sorted object id index alongside the data
+    write_object_index(output_filename)
     return 1
 
 def main(args):
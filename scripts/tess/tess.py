@@ -4,6 +4,7 @@ from datasets.data_files import DataFilesPatternsDict
 import itertools
 import h5py
 import numpy as np
+from astropile.hdf5_utils import find_rows, iter_rows
 
 # TODO: Add BibTeX citation
 # Find for instance the citation on arxiv or on the dataset repo/website
@@ -74,6 +75,9 @@ class TESS(datasets.GeneratorBasedBuilder):
 
     DEFAULT_CONFIG_NAME = "all"
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 128
+
     @classmethod
     def _info(self):
         """Defines the features available in this dataset."""
@@ -141,31 +145,28 @@ class TESS(datasets.GeneratorBasedBuilder):
         for j, file in enumerate(itertools.chain.from_iterable(files)):
             with h5py.File(file, "r") as data:
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j])
                 else:
-                    keys = data["object_id"][:]
-
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"][:])
-                sorted_ids = data["object_id"][:][sort_index]
+                    rows = range(len(data["object_id"]))
 
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                # Columns to read in batches for all requested rows
+                keys = ["time", "flux", "flux_err", "object_id"] + _FLOAT_FEATURES
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
 
                     # Parse light curve data
                     example = {
                         "lightcurve": {
-                            "time": data["time"][i],
-                            "flux": data["flux"][i],
-                            "flux_err": data["flux_err"][i],
+                            "time": row["time"],
+                            "flux": row["flux"],
+                            "flux_err": row["flux_err"],
                         }
                     }
                     # Add all other requested features
                     for f in _FLOAT_FEATURES:
-                        example[f] = data[f][i].astype("float32")
+                        example[f] = row[f].astype("float32")
 
                     # Add object_id
-                    example["object_id"] = str(data["object_id"][i])
+                    example["object_id"] = str(row["object_id"])
 
-                    yield str(data["object_id"][i]), example
+                    yield str(row["object_id"]), example
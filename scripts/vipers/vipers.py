@@ -24,6 +24,7 @@ from datasets import Features, Value, Array2D, Sequence
 import itertools
 import h5py
 import numpy as np
+from astropile.hdf5_utils import find_rows, iter_rows
 
 _CITATION = """\
 @article{scodeggio2018vimos,
@@ -79,6 +80,9 @@ class VIPERS(datasets.GeneratorBasedBuilder):
 
     DEFAULT_CONFIG_NAME = "all"  # It's not mandatory to have a default configuration. Just use one if it make sense.
 
+    # Number of rows read at once from the HDF5 files by _generate_examples
+    _batch_size = 128
+
     def _info(self):
         """Defines the dataset info."""
         features = datasets.Features(
@@ -121,31 +125,28 @@ class VIPERS(datasets.GeneratorBasedBuilder):
         for j, file_path in enumerate(files):
             with h5py.File(file_path, "r") as data:    
                 if object_ids is not None:
-                    keys = object_ids[j]
+                    # Look up the requested ids in the sorted object id index
+                    rows = find_rows(data, object_ids[j])
                 else:
-                    keys = data["object_id"]
-
-                # Preparing an index for fast searching through the catalog
-                sort_index = np.argsort(data["object_id"])
-                sorted_ids = data["object_id"][:][sort_index]
+                    rows = range(len(data["object_id"]))
 
-                for k in keys:
-                    # Extract the indices of requested ids in the catalog 
-                    i = sort_index[np.searchsorted(sorted_ids, k)]
+                # Columns to read in batches for all requested rows
+                keys = ["spectrum_flux", "spectrum_noise", "spectrum_wave", "spectrum_mask", "object_id"] + _FLOAT_FEATURES
+                for row in iter_rows(data, rows, keys, batch_size=self._batch_size):
 
                     example = {
                         "spectrum": {
-                            "flux": data["spectrum_flux"][i] * 1e17, # normalize
-                            "ivar": 1/(data["spectrum_noise"][i] * 1e34), # normalize
-                            "lambda": data["spectrum_wave"][i],
-                            "mask": data["spectrum_mask"][i]
+                            "flux": row["spectrum_flux"] * 1e17, # normalize
+                            "ivar": 1/(row["spectrum_noise"] * 1e34), # normalize
+                            "lambda": row["spectrum_wave"],
+                            "mask": row["spectrum_mask"]
                         }
                     }
 
                     for key in _FLOAT_FEATURES:
-                        example[key] = data[key][i].astype(np.float64)
+                        example[key] = row[key].astype(np.float64)
 
                     # Add object id
-                    example["object_id"] = str(data["object_id"][i])
+                    example["object_id"] = str(row["object_id"])
 
-                    yield str(data["object_id"][i]), example
\ No newline at end of file
+                    yield str(row["object_id"]), example
\ No newline at end of file
@@ -0,0 +1,102 @@
+import os
+import glob
+import time
+import shutil
+import pytest
+import datasets
+
+import astropile.utils
+from astropile.synthetic import generate_parent_sample
+from astropile.utils import materialize_cross_match
+from astropile.benchmark.dataset import AstroPile
+
+# Synthetic positions are random, so a large radius matches every object of a cell
+_MATCHING_RADIUS = 3600.
+
+
+@pytest.fixture(scope='module')
+def builders(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('astropile'))
+    generate_parent_sample('desi', root, num_objects=60, num_healpix=3, seed=0)
+    generate_parent_sample('hsc', root, num_objects=60, num_healpix=3, seed=1)
+    left = datasets.load_dataset_builder(os.path.join(root, 'desi'), trust_remote_code=True)
+    right = datasets.load_dataset_builder(os.path.join(root, 'hsc'), trust_remote_code=True)
+    return root, left, right
+
+
+def _setup(root, name):
+    datamodule = AstroPile(name, local_astropile_root=root, batch_size=4)
+    datamodule.setup()
+    return datamodule
+
+
+def test_complete_cross_match(builders):
+    root, left, right = builders
+    dset = materialize_cross_match(left, right, os.path.join(root, 'complete'),
+                                   matching_radius=_MATCHING_RADIUS)
+    datamodule = _setup(root, 'complete')
+    num_rows = len(datamodule.train_dataset) + len(datamodule.val_dataset) + len(datamodule.test_dataset)
+    assert num_rows == len(dset)
+
+
+def test_incomplete_cross_match_raises(builders):
+    root, left, right = builders
+    # Only the first of two tasks has run, so no manifest is written
+    assert materialize_cross_match(left, right, os.path.join(root, 'incomplete'),
+                                   matching_radius=_MATCHING_RADIUS, proc_id=0, num_tasks=2) is None
+    with pytest.raises(ValueError, match="not complete"):
+        _setup(root, 'incomplete')
+
+
+def test_missing_shard_raises(builders):
+    root, left, right = builders
+    output_dir = os.path.join(root, 'missing')
+    materialize_cross_match(left, right, output_dir, matching_radius=_MATCHING_RADIUS)
+    os.remove(sorted(glob.glob(os.path.join(output_dir, 'healpix=*.arrow')))[0])
+    with pytest.raises(ValueError, match="missing"):
+        _setup(root, 'missing')
+
+
+def test_other_parameters_raise(builders):
+    root, left, right = builders
+    output_dir = os.path.join(root, 'parameters')
+    materialize_cross_match(left, right, output_dir, matching_radius=_MATCHING_RADIUS)
+    with pytest.raises(ValueError, match="differ"):
+        materialize_cross_match(left, right, output_dir, matching_radius=1.)
+    shutil.rmtree(output_dir)
+
+
+def test_waiting_task_times_out(builders):
+    root, left, right = builders
+    # The first task never writes the matched catalog
+    with pytest.raises(TimeoutError):
+        materialize_cross_match(left, right, os.path.join(root, 'timeout'), matching_radius=_MATCHING_RADIUS,
+                                proc_id=1, num_tasks=2, poll_interval=0.1, timeout=0.3)
+
+
+def test_waiting_task_raises_on_first_task_failure(builders, monkeypatch):
+    root, left, right = builders
+    output_dir = os.path.join(root, 'failure')
+
+    def _fail(*args, **kwargs):
+        raise MemoryError("cross-match failed")
+
+    # A failure marker left by a previous run is ignored
+    os.makedirs(output_dir)
+    with open(os.path.join(output_dir, 'matched_catalog.failed'), 'w') as f:
+        f.write('{"error": "previous run"}')
+    os.utime(os.path.join(output_dir, 'matched_catalog.failed'), (0, 0))
+    with pytest.raises(TimeoutError):
+        materialize_cross_match(left, right, output_dir, matching_radius=_MATCHING_RADIUS,
+                                proc_id=1, num_tasks=2, poll_interval=0.1, timeout=0.3)
+
+    monkeypatch.setattr(astropile.utils, 'cross_match_datasets', _fail)
+    with pytest.raises(MemoryError):
+        materialize_cross_match(left, right, output_dir, matching_radius=_MATCHING_RADIUS,
+                                proc_id=0, num_tasks=2)
+    # Tasks started before the failure see the marker of the first task
+    failed_time = time.time() + 60
+    os.utime(os.path.join(output_dir, 'matched_catalog.failed'), (failed_time, failed_time))
+    with pytest.raises(RuntimeError, match="cross-match failed"):
+        materialize_cross_match(left, right, output_dir, matching_radius=_MATCHING_RADIUS,
+                                proc_id=1, num_tasks=2, poll_interval=0.1, timeout=10)